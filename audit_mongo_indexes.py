@@ -0,0 +1,225 @@
+import json
+import argparse
+from tqdm import tqdm
+from pymongo import MongoClient
+from build_qa_mongo_db import QA_COLLECTION_NAME
+from build_mongo_db import DB_NAME, COLLECTION_NAME
+from utils.mongo_query_utils import (
+    build_dialogue_page_pipeline,
+    build_dialogue_query,
+    build_dialogue_stats_pipeline,
+    conditions_to_dialogue_filters,
+    get_context_query,
+)
+
+
+def build_query_shapes(condition_type, condition_value):
+    """
+    (query name, pipeline) pairs issued by the retriever and the visualizer
+    for one set of conditions
+    """
+    dialogue_query = build_dialogue_query(
+        **conditions_to_dialogue_filters(condition_type, condition_value)
+    )
+    return [
+        ("get_context_query", [get_context_query(condition_type, condition_value)]),
+        (
+            "get_dialogues.list",
+            [
+                {"$match": dialogue_query},
+                {"$sort": {"timestamp": -1}},
+                {"$limit": 200},
+            ],
+        ),
+        ("get_dialogues.page", build_dialogue_page_pipeline(dialogue_query, 10)),
+        ("get_dialogues.stats", build_dialogue_stats_pipeline(dialogue_query)),
+    ]
+
+
+def explain_pipeline(db, pipeline):
+    return db.command(
+        {
+            "explain": {
+                "aggregate": COLLECTION_NAME,
+                "pipeline": pipeline,
+                "cursor": {},
+            },
+            "verbosity": "queryPlanner",
+        }
+    )
+
+
+def collect_winning_plan(node, in_winning_plan: bool = False, found=None):
+    """
+    Index names and collection scans of the winning plans of an explain
+    output, rejected plans are skipped
+    """
+    if found is None:
+        found = {"indexes": set(), "collscan": False}
+    if isinstance(node, dict):
+        for k, v in node.items():
+            if k == "rejectedPlans":
+                continue
+            if in_winning_plan and k == "indexName":
+                found["indexes"].add(v)
+            if in_winning_plan and k == "stage" and v == "COLLSCAN":
+                found["collscan"] = True
+            collect_winning_plan(v, in_winning_plan or k == "winningPlan", found)
+    elif isinstance(node, list):
+        for v in node:
+            collect_winning_plan(v, in_winning_plan, found)
+    return found
+
+
+def find_redundant_indexes(index_info: dict):
+    """
+    Non-unique indexes whose key pattern is a prefix of another index, the
+    longer index serves the same queries
+    """
+    redundant = {}
+    for name, info in index_info.items():
+        if name == "_id_" or info.get("unique", False):
+            continue
+        keys = list(info["key"])
+        for other_name, other_info in index_info.items():
+            other_keys = list(other_info["key"])
+            if other_name == name or len(other_keys) < len(keys):
+                continue
+            if other_keys[: len(keys)] == keys and (
+                len(other_keys) > len(keys) or other_name < name
+            ):
+                redundant[name] = other_name
+                break
+    return redundant
+
+
+def build_minimal_plan(index_info: dict, used_indexes: set):
+    """
+    The used indexes and the unique ones, without the non-unique indexes that
+    are a prefix of another planned index
+    """
+    kept = {
+        name: info
+        for name, info in index_info.items()
+        if name != "_id_" and (name in used_indexes or info.get("unique", False))
+    }
+    redundant = find_redundant_indexes(kept)
+    return [
+        {
+            "keys": [[field, direction] for field, direction in info["key"]],
+            "unique": info.get("unique", False),
+        }
+        for name, info in kept.items()
+        if name not in redundant
+    ]
+
+
+def main(args):
+    client = MongoClient(args.mongodb_host_name)
+    db = client[DB_NAME]
+    collection = db[COLLECTION_NAME]
+    qa_collection = db[QA_COLLECTION_NAME]
+
+    all_conditions = list(
+        qa_collection.aggregate(
+            [
+                {"$sample": {"size": args.num_samples}},
+                {"$project": {"_id": 0, "condition_type": 1, "condition_value": 1}},
+            ]
+        )
+    )
+    # the unfiltered visualizer view
+    all_conditions.append({"condition_type": [], "condition_value": []})
+
+    index_usage = {}
+    shape_report = {}
+    for conditions in tqdm(all_conditions, desc="Explaining queries"):
+        for query_name, pipeline in build_query_shapes(
+            conditions["condition_type"], conditions["condition_value"]
+        ):
+            found = collect_winning_plan(explain_pipeline(db, pipeline))
+            shape = "{} [{}]".format(
+                query_name, ",".join(sorted(set(conditions["condition_type"])))
+            )
+            cur_report = shape_report.setdefault(
+                shape, {"count": 0, "collscan": 0, "indexes": {}}
+            )
+            cur_report["count"] += 1
+            cur_report["collscan"] += int(found["collscan"])
+            for name in found["indexes"]:
+                cur_report["indexes"][name] = cur_report["indexes"].get(name, 0) + 1
+                index_usage[name] = index_usage.get(name, 0) + 1
+
+    index_info = collection.index_information()
+    index_stats = {
+        x["name"]: x["accesses"]["ops"]
+        for x in collection.aggregate([{"$indexStats": {}}])
+    }
+    redundant = find_redundant_indexes(index_info)
+
+    print("Query shapes:")
+    for shape, cur_report in sorted(shape_report.items()):
+        print(
+            "  {} x{}, collscan {}, indexes {}".format(
+                shape,
+                cur_report["count"],
+                cur_report["collscan"],
+                cur_report["indexes"],
+            )
+        )
+
+    print("Indexes:")
+    index_report = {}
+    for name, info in sorted(index_info.items()):
+        if name == "_id_":
+            continue
+        if name in redundant:
+            status = "redundant, prefix of {}".format(redundant[name])
+        elif name in index_usage:
+            status = "used"
+        elif info.get("unique", False):
+            status = "unused, kept as unique constraint"
+        else:
+            status = "unused"
+        index_report[name] = {
+            "keys": [[field, direction] for field, direction in info["key"]],
+            "unique": info.get("unique", False),
+            "replayed_uses": index_usage.get(name, 0),
+            "server_ops": index_stats.get(name, 0),
+            "status": status,
+        }
+        print(
+            "  {}: replayed {}, server ops {}, {}".format(
+                name, index_usage.get(name, 0), index_stats.get(name, 0), status
+            )
+        )
+
+    index_plan = build_minimal_plan(index_info, set(index_usage))
+    with open(args.output_plan, "w") as f:
+        json.dump(index_plan, f, indent=2)
+    print(
+        "Index plan with {} of {} indexes written to {}".format(
+            len(index_plan), len(index_info) - 1, args.output_plan
+        )
+    )
+
+    if args.report_path is not None:
+        with open(args.report_path, "w") as f:
+            json.dump({"shapes": shape_report, "indexes": index_report}, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mongodb_host_name", type=str, default="localhost:27017")
+    parser.add_argument(
+        "--num_samples",
+        type=int,
+        default=500,
+        help="Number of generated questions whose conditions are replayed",
+    )
+    parser.add_argument(
+        "--output_plan", type=str, default="dataset/mongo_index_plan.json"
+    )
+    parser.add_argument("--report_path", type=str, default=None)
+    args = parser.parse_args()
+    main(args)
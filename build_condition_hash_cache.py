@@ -0,0 +1,79 @@
+import datetime
+import argparse
+from tqdm import tqdm
+from pymongo import MongoClient
+from build_qa_mongo_db import QA_COLLECTION_NAME
+from build_mongo_db import DB_NAME, COLLECTION_NAME, read_build_marker
+from concurrent.futures import ThreadPoolExecutor
+from utils.mongo_query_utils import get_context_query
+from utils.condition_hash_cache import ConditionHashCache, canonicalize_condition
+
+
+def get_condition_hashes(collection, condition_type, condition_value):
+    return [
+        x["hash"]
+        for x in collection.aggregate(
+            [
+                get_context_query(condition_type, condition_value),
+                {"$project": {"_id": 0, "hash": 1}},
+            ]
+        )
+    ]
+
+
+def main(args):
+    client = MongoClient(args.mongodb_host_name)
+    db = client[DB_NAME]
+    collection = db[COLLECTION_NAME]
+    qa_collection = db[QA_COLLECTION_NAME]
+
+    # read before the queries, a build that lands meanwhile marks it stale
+    build_marker = read_build_marker()
+    # one query per distinct canonical condition query
+    all_conditions = {}
+    for x in qa_collection.find(
+        {}, {"_id": 0, "condition_type": 1, "condition_value": 1}
+    ):
+        key = canonicalize_condition(x["condition_type"], x["condition_value"])
+        all_conditions.setdefault(key, (x["condition_type"], x["condition_value"]))
+    print("Distinct conditions:", len(all_conditions))
+
+    num_documents = collection.count_documents({})
+    with ThreadPoolExecutor(max_workers=args.num_workers) as executor:
+        futures = {
+            key: executor.submit(get_condition_hashes, collection, *conditions)
+            for key, conditions in all_conditions.items()
+        }
+        condition_hashes = {
+            key: future.result()
+            for key, future in tqdm(futures.items(), desc="Querying conditions")
+        }
+
+    ConditionHashCache.write(
+        args.output_path,
+        condition_hashes,
+        {
+            "num_documents": num_documents,
+            "build_marker": build_marker,
+            "num_conditions": len(condition_hashes),
+            "built_at": datetime.datetime.now().isoformat(),
+        },
+    )
+    print(
+        "Cached {} hashes for {} conditions in {}".format(
+            sum(len(x) for x in condition_hashes.values()),
+            len(condition_hashes),
+            args.output_path,
+        )
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mongodb_host_name", type=str, default="localhost:27017")
+    parser.add_argument(
+        "--output_path", type=str, default="dataset/condition_hash_cache"
+    )
+    parser.add_argument("--num_workers", type=int, default=8)
+    args = parser.parse_args()
+    main(args)
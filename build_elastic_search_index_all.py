@@ -1,86 +1,360 @@
 import os
+import sys
+import json
+import time
+import base64
+import threading
 import argparse
 import datasets
 import numpy as np
 import elasticsearch
+import pyarrow.compute as pc
 from tqdm import tqdm
-from elasticsearch import helpers
+from typing import List
+from utils.fingerprint_utils import (
+    FINGERPRINT_FIELD,
+    compute_dataset_fingerprint,
+    compute_fingerprint,
+)
+from utils.elasticsearch_utils import PARTITION_SCHEMES, get_partition_index_name
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, ThreadPoolExecutor, wait
 
+CHECKPOINT_ROOT = "dataset/index_checkpoints"
+EMBEDDING_ENCODINGS = {"json", "base64"}
+VECTOR_INDEX_OPTIONS = {"hnsw", "int8_hnsw", "int4_hnsw", "bbq_hnsw"}
 
-def es_index_worker(data_batch, rank, index_name, embedding_dim):
-    client = elasticsearch.Elasticsearch(
-        "http://elastic:{}".format(os.environ["ELASTIC_PASSWORD"]) + "@localhost:9200",
-        verify_certs=False,
-        ssl_show_warn=False,
-        request_timeout=30,
-    )
-
-    all_documents = data_batch["document"]
-    all_hashes = data_batch["hash"]
-    all_unique_ids = data_batch["unique_id"]
-    all_embeddings = data_batch["embedding"]
-    all_timestamps = data_batch["timestamp"]
-    all_user_names = data_batch["user_name"]
-    all_countries = data_batch["country"]
-
-    actions = (
-        {
-            "_index": index_name,
-            "_id": all_hashes[idx],
-            "_source": {
-                "document": all_documents[idx],
-                "hash": all_hashes[idx],
-                "unique_id": all_unique_ids[idx],
-                "embedding": all_embeddings[idx],
-                "timestamp": all_timestamps[idx].isoformat(),
-                "user_name": all_user_names[idx],
-                "country": all_countries[idx],
-            },
+
+class AdaptiveChunkSizer:
+    """
+    Additive-increase / multiplicative-decrease bulk chunk size: grows while
+    bulk requests finish under `target_latency` seconds, shrinks when they
+    are slow or rejected with 429. Shared by all writer threads, updates are
+    serialized with a lock.
+    """
+
+    def __init__(
+        self,
+        initial_chunk_size: int = 1000,
+        min_chunk_size: int = 100,
+        max_chunk_size: int = 10000,
+        target_latency: float = 2.0,
+    ):
+        self.chunk_size = initial_chunk_size
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.target_latency = target_latency
+        self.step = max(min_chunk_size, initial_chunk_size // 4)
+        self._lock = threading.Lock()
+
+    def on_success(self, num_docs: int, latency: float):
+        with self._lock:
+            if num_docs < self.chunk_size:
+                # a short tail chunk says nothing about the chunk size
+                return
+            if latency < self.target_latency:
+                self.chunk_size = min(
+                    self.chunk_size + self.step, self.max_chunk_size
+                )
+            elif latency > 1.5 * self.target_latency:
+                self.chunk_size = max(
+                    int(self.chunk_size * 0.75), self.min_chunk_size
+                )
+
+    def on_rejected(self):
+        with self._lock:
+            self.chunk_size = max(self.chunk_size // 2, self.min_chunk_size)
+
+
+def encode_embedding(embedding: np.ndarray) -> str:
+    # big-endian float32, the byte order Elasticsearch expects for base64 vectors
+    return base64.b64encode(embedding.astype(">f4").tobytes()).decode("ascii")
+
+
+def build_actions(
+    batch,
+    index_name: str,
+    embedding_encoding: str = "json",
+    partition_by: str = None,
+):
+    all_hashes = batch.column("hash").to_pylist()
+    all_documents = batch.column("document").to_pylist()
+    all_unique_ids = batch.column("unique_id").to_pylist()
+    if embedding_encoding == "base64":
+        # straight from the Arrow buffers, no per-float Python objects
+        all_embeddings = np.asarray(
+            batch.column("embedding").combine_chunks().flatten(), dtype=np.float32
+        ).reshape(len(all_hashes), -1)
+    else:
+        all_embeddings = batch.column("embedding").to_pylist()
+    all_timestamps = batch.column("timestamp").to_pylist()
+    all_user_names = batch.column("user_name").to_pylist()
+    all_countries = batch.column("country").to_pylist()
+
+    actions = []
+    for idx in range(len(all_hashes)):
+        source = {
+            "document": all_documents[idx],
+            "hash": all_hashes[idx],
+            "unique_id": all_unique_ids[idx],
+            "embedding": all_embeddings[idx],
+            "timestamp": all_timestamps[idx].isoformat(),
+            "user_name": all_user_names[idx],
+            "country": all_countries[idx],
         }
-        for idx in range(len(all_hashes))
+        source[FINGERPRINT_FIELD] = compute_fingerprint(
+            source, vector_fields=("embedding",)
+        )
+        if embedding_encoding == "base64":
+            source["embedding"] = encode_embedding(all_embeddings[idx])
+        cur_index_name = index_name
+        if partition_by is not None:
+            cur_index_name = get_partition_index_name(index_name, all_timestamps[idx])
+        actions.append({"index": {"_index": cur_index_name, "_id": all_hashes[idx]}})
+        actions.append(source)
+    return actions
+
+
+def drop_unchanged_actions(client, actions):
+    """
+    Remove the documents whose stored fingerprint matches, the others are
+    new or changed and are (re)indexed under their hash. Also returns the
+    positions of the kept documents in `actions`.
+    """
+    resp = client.mget(
+        docs=[
+            {"_index": x["index"]["_index"], "_id": x["index"]["_id"]}
+            for x in actions[::2]
+        ],
+        source_includes=[FINGERPRINT_FIELD],
     )
+    changed_actions = []
+    changed_positions = []
+    for idx, doc in enumerate(resp["docs"]):
+        source = actions[2 * idx + 1]
+        if (
+            doc.get("found")
+            and doc["_source"].get(FINGERPRINT_FIELD) == source[FINGERPRINT_FIELD]
+        ):
+            continue
+        changed_actions.extend(actions[2 * idx : 2 * idx + 2])
+        changed_positions.append(idx)
+    return changed_actions, changed_positions
+
+
+def index_chunk(
+    client,
+    actions,
+    offsets: List[int],
+    sizer: AdaptiveChunkSizer,
+    incremental: bool = False,
+):
+    """
+    `offsets` are the dataset offsets of the documents in `actions`.
+    Returns (offsets of the failed documents, number of unchanged documents)
+    """
+    num_skipped = 0
+    if incremental:
+        changed_actions, changed_positions = drop_unchanged_actions(client, actions)
+        num_skipped = (len(actions) - len(changed_actions)) // 2
+        actions = changed_actions
+        offsets = [offsets[i] for i in changed_positions]
+        if len(actions) == 0:
+            return [], num_skipped
+    return [offsets[i] for i in send_bulk(client, actions, sizer)], num_skipped
+
+
+def send_bulk(client, actions, sizer: AdaptiveChunkSizer, max_retries: int = 8):
+    """
+    Send one bulk request, documents rejected with 429 are resent with an
+    exponential backoff. Returns the positions in `actions` of the documents
+    that failed with any other error.
+    """
+    failed_positions = []
+    positions = list(range(len(actions) // 2))
+    for attempt in range(max_retries + 1):
+        st = time.time()
+        try:
+            resp = client.bulk(operations=actions)
+        except (elasticsearch.ApiError, elasticsearch.ConnectionTimeout) as e:
+            if isinstance(e, elasticsearch.ApiError) and e.meta.status != 429:
+                raise
+            retry_actions = actions
+            retry_positions = positions
+        else:
+            retry_actions = []
+            retry_positions = []
+            for idx, item in enumerate(resp["items"]):
+                status = item["index"]["status"]
+                if status == 429:
+                    retry_actions.extend(actions[2 * idx : 2 * idx + 2])
+                    retry_positions.append(positions[idx])
+                elif status >= 300:
+                    failed_positions.append(positions[idx])
+            if len(retry_actions) == 0:
+                sizer.on_success(len(actions) // 2, time.time() - st)
+                return failed_positions
+
+        if attempt == max_retries:
+            raise RuntimeError(
+                "Bulk request still rejected after {} retries".format(max_retries)
+            )
+        sizer.on_rejected()
+        time.sleep(min(2**attempt, 60))
+        actions = retry_actions
+        positions = retry_positions
+
 
-    successes = 0
-    for ok, item in tqdm(
-        helpers.parallel_bulk(
-            client, actions, chunk_size=10000, thread_count=16, queue_size=16
-        ),
-        desc="Indexing batch {}".format(rank),
-        position=rank,
-        leave=False,
+def load_checkpoint(
+    checkpoint_path: str,
+    data_path: str,
+    num_docs: int,
+    data_fingerprint: str,
+    incremental: bool = False,
+):
+    if not os.path.exists(checkpoint_path):
+        return None
+    with open(checkpoint_path, "r") as f:
+        checkpoint = json.load(f)
+    if (
+        checkpoint["data_path"] != data_path
+        or checkpoint["num_docs"] != num_docs
+        or checkpoint.get("data_fingerprint") != data_fingerprint
     ):
-        if ok:
-            successes += 1
-    print("Indexed batches:", successes)
+        if incremental:
+            # a previous delta, the new one starts from its first document
+            return None
+        raise ValueError(
+            "Checkpoint {} was written for another dataset, use --restart to "
+            "rebuild the index".format(checkpoint_path)
+        )
+    if incremental and is_checkpoint_complete(checkpoint):
+        # a finished delta, compare every document against the index again
+        return None
+    return checkpoint
 
 
-def main(args):
-    documents = datasets.Dataset.load_from_disk(args.data_path)
-    print("Total documents:", len(documents))
+def is_checkpoint_complete(checkpoint: dict):
+    return (
+        checkpoint["committed_offset"] >= checkpoint["num_docs"]
+        and len(checkpoint.get("failed_offsets", [])) == 0
+    )
 
-    client = elasticsearch.Elasticsearch(
-        "http://elastic:{}".format(os.environ["ELASTIC_PASSWORD"]) + "@localhost:9200",
-        verify_certs=False,
-        ssl_show_warn=False,
-        request_timeout=30,
+
+def save_checkpoint(checkpoint_path: str, checkpoint: dict):
+    tmp_path = checkpoint_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, checkpoint_path)
+
+
+def stream_bulk_index(
+    client,
+    documents: datasets.Dataset,
+    index_name: str,
+    start_offset: int,
+    checkpoint: dict,
+    checkpoint_path: str,
+    sizer: AdaptiveChunkSizer,
+    num_writers: int = 4,
+    read_batch_size: int = 10000,
+    incremental: bool = False,
+    embedding_encoding: str = "json",
+    partition_by: str = None,
+):
+    """
+    Index `documents[start_offset:]` with a pool of `num_writers` bulk
+    writers fed from Arrow record batches. Chunks can finish out of order,
+    the checkpoint holds the end of the contiguous prefix of committed
+    chunks so that a resumed build never skips a document. Documents that
+    failed are kept in the checkpoint's `failed_offsets` and sent again
+    first by the next run. In incremental mode, documents whose fingerprint
+    is unchanged are not sent.
+    """
+    retry_offsets = sorted(checkpoint.get("failed_offsets", []))
+    failed_offsets = set(retry_offsets)
+    remaining = documents.select(range(start_offset, len(documents)))
+    committed_offset = start_offset
+    finished_chunks = {}
+    num_skipped = 0
+
+    progress = tqdm(
+        total=len(documents), initial=start_offset, desc="Indexing documents"
     )
-    client.ping()
-    if client.indices.exists(index="wildchat_aqa_document"):
-        client.indices.delete(index="wildchat_aqa_document")
-    if client.indices.exists(index="wildchat_aqa_summary"):
-        client.indices.delete(index="wildchat_aqa_summary")
-    print("Connected to ElasticSearch")
+    with ThreadPoolExecutor(max_workers=num_writers) as executor:
+        in_flight = {}
+
+        def collect(return_when):
+            nonlocal committed_offset, num_skipped
+            done, _ = wait(in_flight, return_when=return_when)
+            for future in done:
+                chunk_offsets, is_retry = in_flight.pop(future)
+                cur_failed, cur_skipped = future.result()
+                num_skipped += cur_skipped
+                if is_retry:
+                    failed_offsets.difference_update(chunk_offsets)
+                else:
+                    finished_chunks[chunk_offsets[0]] = chunk_offsets[-1] + 1
+                    progress.update(len(chunk_offsets))
+                failed_offsets.update(cur_failed)
+            while committed_offset in finished_chunks:
+                committed_offset = finished_chunks.pop(committed_offset)
+            checkpoint["committed_offset"] = committed_offset
+            checkpoint["failed_offsets"] = sorted(failed_offsets)
+            save_checkpoint(checkpoint_path, checkpoint)
+
+        def submit_batches(batches, all_offsets, is_retry):
+            cur = 0
+            for batch in batches:
+                all_actions = build_actions(
+                    batch, index_name, embedding_encoding, partition_by
+                )
+                st = 0
+                while st < len(batch):
+                    ed = min(st + sizer.chunk_size, len(batch))
+                    while len(in_flight) >= 2 * num_writers:
+                        collect(FIRST_COMPLETED)
+                    chunk_offsets = all_offsets[cur + st : cur + ed]
+                    future = executor.submit(
+                        index_chunk,
+                        client,
+                        all_actions[2 * st : 2 * ed],
+                        chunk_offsets,
+                        sizer,
+                        incremental,
+                    )
+                    in_flight[future] = (chunk_offsets, is_retry)
+                    st = ed
+                cur += len(batch)
+
+        if len(retry_offsets) > 0:
+            print("Retrying {} failed documents".format(len(retry_offsets)))
+            submit_batches(
+                documents.select(retry_offsets)
+                .with_format("arrow")
+                .iter(batch_size=read_batch_size),
+                retry_offsets,
+                is_retry=True,
+            )
+        submit_batches(
+            remaining.with_format("arrow").iter(batch_size=read_batch_size),
+            range(start_offset, len(documents)),
+            is_retry=False,
+        )
+
+        if len(in_flight) > 0:
+            collect(ALL_COMPLETED)
+    progress.close()
+    return committed_offset, sorted(failed_offsets), num_skipped
 
-    if client.indices.exists(index=args.index_name):
-        client.indices.delete(index=args.index_name)
-    print("Existing index deleted.")
 
-    # Disable refresh interval and replicas for faster bulk indexing.
+def create_index(client, args, index_name: str, live: bool = False, alias=None):
+    # Disable refresh interval and replicas for faster bulk indexing, unless
+    # the index is created live by an incremental update.
     index_body = {
         "settings": {
-            "number_of_shards": 1,
-            "number_of_replicas": 0,
-            "refresh_interval": -1,
+            "number_of_shards": args.number_of_shards,
+            "number_of_replicas": args.number_of_replicas if live else 0,
+            "refresh_interval": "1s" if live else -1,
             "analysis": {
                 "tokenizer": {"icu_tokenizer": {"type": "icu_tokenizer"}},
                 "analyzer": {
@@ -109,29 +383,184 @@ def main(args):
                 },
                 "user_name": {"type": "keyword"},
                 "country": {"type": "keyword"},
+                FINGERPRINT_FIELD: {"type": "keyword", "index": False},
             }
         },
     }
-    client.indices.create(index=args.index_name, body=index_body, request_timeout=60)
-    print("Index created.")
+    if args.index_options is not None:
+        # quantized HNSW graph, the raw floats are kept on disk for rescoring
+        index_body["mappings"]["properties"]["embedding"]["index_options"] = {
+            "type": args.index_options
+        }
+    if args.exclude_embedding_from_source:
+        # the vectors stay searchable but are no longer stored in _source
+        index_body["mappings"]["_source"] = {"excludes": ["embedding"]}
+    if alias is not None:
+        index_body["aliases"] = {alias: {}}
+    client.indices.create(index=index_name, body=index_body, request_timeout=60)
+    print("Index {} created.".format(index_name))
+
+
+def get_concrete_indices(client, index_name: str):
+    # `index_name` is either a plain index or the alias over its partitions
+    if client.indices.exists_alias(name=index_name):
+        return sorted(client.indices.get_alias(name=index_name).keys())
+    if client.indices.exists(index=index_name):
+        return [index_name]
+    return []
+
+
+def get_partition_names(documents: datasets.Dataset, index_name: str):
+    months = pc.unique(
+        pc.strftime(documents.data.column("timestamp"), format="%Y.%m")
+    ).to_pylist()
+    return sorted("{}-{}".format(index_name, x) for x in months)
 
-    documents = documents.map(
-        es_index_worker,
-        fn_kwargs={
+
+def create_missing_indices(client, args, documents, live: bool = False):
+    if args.partition_by is None:
+        if not client.indices.exists(index=args.index_name):
+            create_index(client, args, args.index_name, live=live)
+        return
+    if client.indices.exists(index=args.index_name) and not (
+        client.indices.exists_alias(name=args.index_name)
+    ):
+        raise ValueError(
+            "{} is an unpartitioned index, rebuild it without --incremental to "
+            "partition it".format(args.index_name)
+        )
+    for partition_name in get_partition_names(documents, args.index_name):
+        if not client.indices.exists(index=partition_name):
+            create_index(client, args, partition_name, live=live, alias=args.index_name)
+
+
+def main(args):
+    documents = datasets.Dataset.load_from_disk(args.data_path)
+    print("Total documents:", len(documents))
+
+    client = elasticsearch.Elasticsearch(
+        "http://elastic:{}".format(os.environ["ELASTIC_PASSWORD"]) + "@localhost:9200",
+        verify_certs=False,
+        ssl_show_warn=False,
+        request_timeout=args.request_timeout,
+        connections_per_node=args.num_writers,
+    )
+    client.ping()
+    print("Connected to ElasticSearch")
+
+    checkpoint_path = args.checkpoint_path
+    if checkpoint_path is None:
+        checkpoint_path = os.path.join(CHECKPOINT_ROOT, f"{args.index_name}.json")
+    os.makedirs(os.path.dirname(checkpoint_path) or ".", exist_ok=True)
+
+    data_fingerprint = compute_dataset_fingerprint(documents)
+    checkpoint = None
+    if not args.restart:
+        checkpoint = load_checkpoint(
+            checkpoint_path,
+            args.data_path,
+            len(documents),
+            data_fingerprint,
+            args.incremental,
+        )
+        if checkpoint is not None and not client.indices.exists(index=args.index_name):
+            print("Index missing, ignoring checkpoint.")
+            checkpoint = None
+        if checkpoint is not None and is_checkpoint_complete(checkpoint):
+            print(
+                "Checkpoint {} is complete, the index is already built. Use "
+                "--restart to rebuild it or --incremental to upsert changed "
+                "documents.".format(checkpoint_path)
+            )
+            sys.exit(1)
+
+    if args.incremental:
+        # the index stays live: no delete, settings and refresh untouched
+        if client.indices.exists(index=args.index_name):
+            client.indices.put_mapping(
+                index=args.index_name,
+                properties={FINGERPRINT_FIELD: {"type": "keyword", "index": False}},
+            )
+        create_missing_indices(client, args, documents, live=True)
+    elif checkpoint is not None:
+        client.indices.put_settings(
+            index=args.index_name, body={"index": {"refresh_interval": -1}}
+        )
+        create_missing_indices(client, args, documents)
+    else:
+        existing_indices = get_concrete_indices(client, args.index_name)
+        if len(existing_indices) > 0:
+            client.indices.delete(index=",".join(existing_indices))
+            print("Existing indices deleted:", existing_indices)
+        create_missing_indices(client, args, documents)
+
+    if checkpoint is not None:
+        print(
+            "Resuming from offset",
+            checkpoint["committed_offset"],
+            "with",
+            len(checkpoint.get("failed_offsets", [])),
+            "failed documents to retry",
+        )
+    else:
+        checkpoint = {
             "index_name": args.index_name,
-            "embedding_dim": args.embedding_dim,
-        },
-        batched=True,
-        num_proc=16,
-        batch_size=4096,
-        # batch_size=len(documents) // os.cpu_count() + 1,
-        with_rank=True,
+            "data_path": args.data_path,
+            "num_docs": len(documents),
+            "data_fingerprint": data_fingerprint,
+            "committed_offset": 0,
+            "failed_offsets": [],
+        }
+        save_checkpoint(checkpoint_path, checkpoint)
+
+    sizer = AdaptiveChunkSizer(
+        initial_chunk_size=args.initial_chunk_size,
+        min_chunk_size=args.min_chunk_size,
+        max_chunk_size=args.max_chunk_size,
+        target_latency=args.target_latency,
+    )
+    committed_offset, failed_offsets, num_skipped = stream_bulk_index(
+        client,
+        documents,
+        args.index_name,
+        checkpoint["committed_offset"],
+        checkpoint,
+        checkpoint_path,
+        sizer,
+        num_writers=args.num_writers,
+        read_batch_size=args.read_batch_size,
+        incremental=args.incremental,
+        embedding_encoding=args.embedding_encoding,
+        partition_by=args.partition_by,
     )
-    # Re-enable refresh interval after bulk indexing.
-    client.indices.put_settings(
-        index=args.index_name, body={"index": {"refresh_interval": "1s"}}
+    print(
+        "Processed documents:",
+        committed_offset,
+        "unchanged:",
+        num_skipped,
+        "failed:",
+        len(failed_offsets),
     )
-    print("Settings restored.")
+
+    if not args.incremental:
+        # Re-enable refresh interval and replicas after bulk indexing.
+        client.indices.put_settings(
+            index=args.index_name,
+            body={
+                "index": {
+                    "refresh_interval": "1s",
+                    "number_of_replicas": args.number_of_replicas,
+                }
+            },
+        )
+        print("Settings restored.")
+
+    if len(failed_offsets) > 0:
+        print(
+            "{} documents failed, they are kept in {} and retried by the next "
+            "run".format(len(failed_offsets), checkpoint_path)
+        )
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -141,9 +570,68 @@ if __name__ == "__main__":
         type=str,
         default="dataset/wildchat_aqa_document_with_embedding",
     )
+    parser.add_argument("--index_name", type=str, default="wildchat_aqa_document")
+    parser.add_argument("--embedding_dim", type=int, default=3072)
+    parser.add_argument("--number_of_shards", type=int, default=1)
+    parser.add_argument("--number_of_replicas", type=int, default=0)
     parser.add_argument(
-        "--index_name", type=str, default="wildchat_aqa_document"
+        "--partition_by",
+        type=str,
+        default=None,
+        choices=sorted(PARTITION_SCHEMES),
+        help="Write one index per month of timestamp, named <index_name>-YYYY.MM, "
+        "behind an <index_name> alias",
+    )
+    parser.add_argument(
+        "--checkpoint_path",
+        type=str,
+        default=None,
+        help="Defaults to {}/<index_name>.json".format(CHECKPOINT_ROOT),
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Upsert new or changed documents (by hash and fingerprint) into the "
+        "live index instead of rebuilding it",
+    )
+    parser.add_argument(
+        "--restart",
+        action="store_true",
+        help="Ignore the checkpoint, without --incremental the index is rebuilt "
+        "from scratch",
+    )
+    parser.add_argument("--num_writers", type=int, default=4)
+    parser.add_argument("--read_batch_size", type=int, default=10000)
+    parser.add_argument("--initial_chunk_size", type=int, default=1000)
+    parser.add_argument("--min_chunk_size", type=int, default=100)
+    parser.add_argument("--max_chunk_size", type=int, default=10000)
+    parser.add_argument(
+        "--target_latency",
+        type=float,
+        default=2.0,
+        help="Bulk response time in seconds the chunk size is tuned towards",
+    )
+    parser.add_argument("--request_timeout", type=int, default=120)
+    parser.add_argument(
+        "--embedding_encoding",
+        type=str,
+        default="json",
+        choices=sorted(EMBEDDING_ENCODINGS),
+        help="base64 sends big-endian float32 vectors, it needs an "
+        "Elasticsearch release that accepts base64 encoded float vectors",
+    )
+    parser.add_argument(
+        "--index_options",
+        type=str,
+        default=None,
+        choices=sorted(VECTOR_INDEX_OPTIONS),
+        help="Vector index type of the embedding field, server default if unset",
+    )
+    parser.add_argument(
+        "--exclude_embedding_from_source",
+        action="store_true",
+        help="Do not store the embeddings in _source, they can no longer be "
+        "fetched or reindexed from Elasticsearch",
     )
-    parser.add_argument("--embedding_dim", type=int, default=3072)
     args = parser.parse_args()
     main(args)
@@ -0,0 +1,38 @@
+import argparse
+import datasets
+from modeling.local_bm25_index import build_local_bm25_index
+
+
+def main(args):
+    documents = datasets.Dataset.load_from_disk(args.data_path)
+    print("Total documents:", len(documents))
+
+    build_local_bm25_index(
+        documents,
+        args.index_path,
+        k1=args.k1,
+        b=args.b,
+        batch_size=args.batch_size,
+        num_proc=args.num_proc,
+    )
+    print("Local BM25 index saved to", args.index_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--data_path",
+        type=str,
+        default="dataset/wildchat_aqa_document_with_embedding",
+    )
+    parser.add_argument(
+        "--index_path",
+        type=str,
+        default="dataset/local_index/wildchat_aqa_document_bm25",
+    )
+    parser.add_argument("--k1", type=float, default=1.2)
+    parser.add_argument("--b", type=float, default=0.75)
+    parser.add_argument("--batch_size", type=int, default=4096)
+    parser.add_argument("--num_proc", type=int, default=None)
+    args = parser.parse_args()
+    main(args)
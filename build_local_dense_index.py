@@ -0,0 +1,34 @@
+import argparse
+import datasets
+from modeling.local_dense_index import DENSE_ENCODINGS, build_local_dense_index
+
+
+def main(args):
+    documents = datasets.Dataset.load_from_disk(args.data_path)
+    print("Total documents:", len(documents))
+
+    build_local_dense_index(
+        documents,
+        args.index_path,
+        encoding=args.encoding,
+        batch_size=args.batch_size,
+    )
+    print("Local dense index saved to", args.index_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--data_path",
+        type=str,
+        default="dataset/wildchat_aqa_document_with_embedding",
+    )
+    parser.add_argument(
+        "--index_path", type=str, default="dataset/local_index/wildchat_aqa_document"
+    )
+    parser.add_argument(
+        "--encoding", type=str, default="float16", choices=sorted(DENSE_ENCODINGS)
+    )
+    parser.add_argument("--batch_size", type=int, default=4096)
+    args = parser.parse_args()
+    main(args)
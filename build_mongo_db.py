@@ -4,10 +4,84 @@ import datetime
 import argparse
 import datasets
 from tqdm import tqdm
-from pymongo import MongoClient
+from pymongo import MongoClient, ReplaceOne
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from utils.fingerprint_utils import FINGERPRINT_FIELD, compute_fingerprint
 
 DB_NAME = "wildchat-aqa-db"
 COLLECTION_NAME = "wildchat"
+# rewritten after every build, readers caching query results drop them when
+# it changes
+MONGO_BUILD_MARKER_PATH = "dataset/mongo_build_marker.json"
+
+# [field, direction] pairs of every index of the collection, audit_mongo_indexes.py
+# writes reduced plans in the same format
+DEFAULT_INDEX_PLAN = [
+    {
+        "keys": [
+            ["labels", 1],
+            ["language", 1],
+            ["country", 1],
+            ["timestamp", 1],
+            ["user_name", 1],
+            ["time_week", 1],
+            ["hash", 1],
+        ],
+        "unique": True,
+    },
+    {
+        "keys": [
+            ["label_level_1", 1],
+            ["language", 1],
+            ["country", 1],
+            ["timestamp", 1],
+            ["time_week", 1],
+            ["user_name", 1],
+            ["hash", 1],
+        ],
+        "unique": True,
+    },
+    {
+        "keys": [
+            ["label_level_2", 1],
+            ["language", 1],
+            ["country", 1],
+            ["timestamp", 1],
+            ["user_name", 1],
+            ["time_week", 1],
+            ["hash", 1],
+        ],
+        "unique": True,
+    },
+    {
+        "keys": [
+            ["keywords_aggregated.value", 1],
+            ["language", 1],
+            ["country", 1],
+            ["timestamp", 1],
+            ["user_name", 1],
+            ["time_week", 1],
+            ["hash", 1],
+        ],
+        "unique": True,
+    },
+    {"keys": [["hash", 1]], "unique": True},
+    {"keys": [["user_name", 1]]},
+    {"keys": [["timestamp", 1]]},
+    # keyset pagination of the visualizer dialogue list
+    {"keys": [["timestamp", -1], ["hash", -1]]},
+    {"keys": [["time_day", 1]]},
+    {"keys": [["time_week", 1]]},
+    {"keys": [["time_month", 1]]},
+    {"keys": [["labels", 1]]},
+    {"keys": [["language", 1]]},
+    {"keys": [["country", 1]]},
+    {"keys": [["reigon", 1]]},
+    {"keys": [["keywords.value", 1]]},
+    {"keys": [["keywords_aggregated.value", 1]]},
+    {"keys": [["label_level_1", 1]]},
+    {"keys": [["label_level_2", 1]]},
+]
 
 
 def get_start_of_week(date):
@@ -57,7 +131,7 @@ def process_data(data):
             deduped_keywords.append(kw)
     keywords = deduped_keywords
 
-    return {
+    record = {
         "conversation": conversation,
         "user_name": user_name,
         "timestamp": date_time,
@@ -91,89 +165,143 @@ def process_data(data):
         "reigon": reigon,
         "token_count": data["token_count"],
     }
+    record[FINGERPRINT_FIELD] = compute_fingerprint(record)
+    return record
+
 
+def iter_record_batches(result: datasets.Dataset, batch_size: int):
+    for batch in result.iter(batch_size=batch_size):
+        columns = list(batch.keys())
+        yield [dict(zip(columns, values)) for values in zip(*batch.values())]
 
-def create_main_db(collection, result):
-    result_list = list(result)
 
-    print(len(result_list))
+def create_main_db(
+    collection,
+    result,
+    insert_batch_size: int = 1000,
+    num_writers: int = 4,
+    index_plan=None,
+):
+    """
+    Stream `result` into a fresh collection with unordered `insert_many`
+    chunks from `num_writers` threads, at most two chunks per writer are
+    held in memory. Secondary indexes are built once the data is loaded.
+    """
+    print(len(result))
 
     collection.drop()
-    collection.insert_many(result_list)
+    with ThreadPoolExecutor(max_workers=num_writers) as executor:
+        in_flight = set()
+        for records in tqdm(
+            iter_record_batches(result, insert_batch_size),
+            total=(len(result) + insert_batch_size - 1) // insert_batch_size,
+            desc="Inserting records",
+        ):
+            while len(in_flight) >= 2 * num_writers:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+            in_flight.add(
+                executor.submit(collection.insert_many, records, ordered=False)
+            )
+        for future in in_flight:
+            future.result()
 
     print(collection.count_documents({}))
 
-    collection.create_index(
-        {
-            "labels": 1,
-            "language": 1,
-            "country": 1,
-            "timestamp": 1,
-            "user_name": 1,
-            "time_week": 1,
-            "hash": 1,
-        },
-        unique=True,
-    )
+    create_indexes(collection, index_plan)
+    print(collection.count_documents({}))
 
-    collection.create_index(
-        {
-            "label_level_1": 1,
-            "language": 1,
-            "country": 1,
-            "timestamp": 1,
-            "time_week": 1,
-            "user_name": 1,
-            "hash": 1,
-        },
-        unique=True,
-    )
 
-    collection.create_index(
-        {
-            "label_level_2": 1,
-            "language": 1,
-            "country": 1,
-            "timestamp": 1,
-            "user_name": 1,
-            "time_week": 1,
-            "hash": 1,
-        },
-        unique=True,
-    )
+def upsert_batch(collection, records):
+    """
+    Replace the records that are new or whose fingerprint changed, returns
+    (number of upserted records, number of unchanged records)
+    """
+    stored_fingerprints = {
+        x["hash"]: x.get(FINGERPRINT_FIELD)
+        for x in collection.find(
+            {"hash": {"$in": [x["hash"] for x in records]}},
+            {"_id": 0, "hash": 1, FINGERPRINT_FIELD: 1},
+        )
+    }
+    operations = [
+        ReplaceOne({"hash": x["hash"]}, x, upsert=True)
+        for x in records
+        if stored_fingerprints.get(x["hash"]) != x[FINGERPRINT_FIELD]
+    ]
+    if len(operations) > 0:
+        collection.bulk_write(operations, ordered=False)
+    return len(operations), len(records) - len(operations)
 
-    collection.create_index(
-        {
-            "keywords_aggregated.value": 1,
-            "language": 1,
-            "country": 1,
-            "timestamp": 1,
-            "user_name": 1,
-            "time_week": 1,
-            "hash": 1,
-        },
-        unique=True,
-    )
 
-    collection.create_index("hash", unique=True)
-    collection.create_index("user_name")
-    collection.create_index("timestamp")
-    collection.create_index("time_day")
-    collection.create_index("time_week")
-    collection.create_index("time_month")
-    collection.create_index("labels")
-    collection.create_index("language")
-    collection.create_index("country")
-    collection.create_index("reigon")
-    collection.create_index("keywords.value")
-    collection.create_index("keywords_aggregated.value")
-    collection.create_index("label_level_1")
-    collection.create_index("label_level_2")
-    print("Indexing done")
-    print("Creating text index")
+def upsert_main_db(collection, result, batch_size: int = 1000, index_plan=None):
+    # indexes are created first (no-op when they exist) so that the lookups
+    # by hash are indexed, the collection stays live during the update
+    create_indexes(collection, index_plan)
+
+    num_upserted = 0
+    num_unchanged = 0
+    for records in tqdm(
+        iter_record_batches(result, batch_size),
+        total=(len(result) + batch_size - 1) // batch_size,
+        desc="Upserting records",
+    ):
+        cur_upserted, cur_unchanged = upsert_batch(collection, records)
+        num_upserted += cur_upserted
+        num_unchanged += cur_unchanged
+    print("Upserted:", num_upserted, "unchanged:", num_unchanged)
     print(collection.count_documents({}))
 
 
+def load_index_plan(index_plan_path: str = None):
+    if index_plan_path is None:
+        return DEFAULT_INDEX_PLAN
+    with open(index_plan_path, "r") as f:
+        return json.load(f)
+
+
+def create_indexes(collection, index_plan=None):
+    if index_plan is None:
+        index_plan = DEFAULT_INDEX_PLAN
+    for index_spec in index_plan:
+        collection.create_index(
+            [(field, direction) for field, direction in index_spec["keys"]],
+            unique=index_spec.get("unique", False),
+        )
+    print("Indexing done")
+
+
+def write_build_marker(collection_name: str, build_marker_path: str = None):
+    if build_marker_path is None:
+        build_marker_path = MONGO_BUILD_MARKER_PATH
+    os.makedirs(os.path.dirname(build_marker_path), exist_ok=True)
+    tmp_path = build_marker_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(
+            {
+                "collection": collection_name,
+                "built_at": datetime.datetime.now().isoformat(),
+            },
+            f,
+        )
+    os.replace(tmp_path, build_marker_path)
+
+
+def read_build_marker(build_marker_path: str = None):
+    """
+    Content of the marker written by the last collection build, None if no
+    build wrote it
+    """
+    if build_marker_path is None:
+        build_marker_path = MONGO_BUILD_MARKER_PATH
+    try:
+        with open(build_marker_path, "r") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
 def main(args):
     client = MongoClient("localhost", 27017)
     data = datasets.Dataset.load_from_disk(args.data_path)
@@ -184,7 +312,18 @@ def main(args):
     db = client[DB_NAME]
     collection = db[COLLECTION_NAME]
 
-    create_main_db(collection, result)
+    index_plan = load_index_plan(args.index_plan)
+    if args.incremental:
+        upsert_main_db(collection, result, args.upsert_batch_size, index_plan)
+    else:
+        create_main_db(
+            collection,
+            result,
+            args.insert_batch_size,
+            args.num_writers,
+            index_plan,
+        )
+    write_build_marker(COLLECTION_NAME)
 
 
 if __name__ == "__main__":
@@ -194,5 +333,21 @@ if __name__ == "__main__":
         type=str,
         default="dataset/wildchat_aqa_conversations",
     )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Upsert new or changed conversations (by hash and fingerprint) "
+        "instead of dropping the collection",
+    )
+    parser.add_argument("--upsert_batch_size", type=int, default=1000)
+    parser.add_argument("--insert_batch_size", type=int, default=1000)
+    parser.add_argument("--num_writers", type=int, default=4)
+    parser.add_argument(
+        "--index_plan",
+        type=str,
+        default=None,
+        help="JSON index plan, e.g. written by audit_mongo_indexes.py, defaults "
+        "to DEFAULT_INDEX_PLAN",
+    )
     args = parser.parse_args()
     main(args)
@@ -4,7 +4,7 @@ import datetime
 import argparse
 import datasets
 from pymongo import MongoClient
-from build_mongo_db import DB_NAME
+from build_mongo_db import DB_NAME, write_build_marker
 
 QA_COLLECTION_NAME = "wildchat-qa"
 
@@ -27,6 +27,7 @@ def main(args):
     collection.drop()
     collection.insert_many(data_new)
     collection.create_index("hash", unique=True)
+    write_build_marker(QA_COLLECTION_NAME)
 
 
 if __name__ == "__main__":
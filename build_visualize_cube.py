@@ -0,0 +1,113 @@
+import os
+import json
+import datetime
+import argparse
+import numpy as np
+from tqdm import tqdm
+from pymongo import MongoClient
+from build_mongo_db import DB_NAME, COLLECTION_NAME, read_build_marker
+from utils.visualize_cube import (
+    CUBE_DIMENSIONS,
+    CUBE_FACETS,
+    VISUALIZE_CUBE_FILE_NAME,
+    VISUALIZE_CUBE_META_FILE_NAME,
+    get_cube_pipeline,
+)
+
+
+def get_cell_value(dim: str, value):
+    # weeks are keyed like the $dateToString of the visualizer time stats
+    if dim == "time_week" and value is not None:
+        return value.strftime("%Y-%m-%d")
+    return value
+
+
+def build_cube(collection, cube_name: str, vocab: dict):
+    """
+    Group the collection into the cells of `cube_name`, returns the COO
+    arrays of the cube, dimension values are added to `vocab`
+    """
+    dims = CUBE_DIMENSIONS + (["facet"] if CUBE_FACETS[cube_name] else [])
+    vocab_names = {
+        dim: dim if dim in CUBE_DIMENSIONS else f"{cube_name}_{dim}" for dim in dims
+    }
+    vocab_index = {}
+    for dim in dims:
+        vocab.setdefault(vocab_names[dim], [])
+        vocab_index[dim] = {v: i for i, v in enumerate(vocab[vocab_names[dim]])}
+
+    keys = {dim: [] for dim in dims}
+    measures = {}
+    for cell in tqdm(
+        collection.aggregate(get_cube_pipeline(cube_name), allowDiskUse=True),
+        desc=f"Building {cube_name} cube",
+    ):
+        for dim in dims:
+            value = get_cell_value(dim, cell["_id"].get(dim))
+            if value not in vocab_index[dim]:
+                vocab_index[dim][value] = len(vocab[vocab_names[dim]])
+                vocab[vocab_names[dim]].append(value)
+            keys[dim].append(vocab_index[dim][value])
+        for k, v in cell.items():
+            if k != "_id":
+                measures.setdefault(k, []).append(v)
+
+    arrays = {
+        f"{cube_name}_{dim}": np.array(v, dtype=np.int32) for dim, v in keys.items()
+    }
+    for k, v in measures.items():
+        arrays[f"{cube_name}_{k}"] = np.array(v, dtype=np.int64)
+    if len(measures) == 0:
+        arrays[f"{cube_name}_count"] = np.zeros(0, dtype=np.int64)
+    return arrays
+
+
+def main(args):
+    client = MongoClient(args.mongodb_host_name)
+    collection = client[DB_NAME][COLLECTION_NAME]
+
+    # read before the queries, a build that lands meanwhile marks it stale
+    build_marker = read_build_marker()
+    num_documents = collection.count_documents({})
+    vocab = {}
+    arrays = {}
+    for cube_name in CUBE_FACETS:
+        arrays.update(build_cube(collection, cube_name, vocab))
+
+    # weeks are sorted so that date ranges compare as strings
+    weeks = vocab["time_week"]
+    order = sorted(range(len(weeks)), key=lambda i: (weeks[i] is None, weeks[i] or ""))
+    remap = np.zeros(len(weeks), dtype=np.int32)
+    remap[order] = np.arange(len(weeks), dtype=np.int32)
+    vocab["time_week"] = [weeks[i] for i in order]
+    for cube_name in CUBE_FACETS:
+        arrays[f"{cube_name}_time_week"] = remap[arrays[f"{cube_name}_time_week"]]
+
+    os.makedirs(args.output_path, exist_ok=True)
+    np.savez_compressed(
+        os.path.join(args.output_path, VISUALIZE_CUBE_FILE_NAME), **arrays
+    )
+    with open(os.path.join(args.output_path, VISUALIZE_CUBE_META_FILE_NAME), "w") as f:
+        json.dump(
+            {
+                "meta": {
+                    "num_documents": num_documents,
+                    "build_marker": build_marker,
+                    "built_at": datetime.datetime.now().isoformat(),
+                },
+                "vocab": vocab,
+            },
+            f,
+        )
+    print(
+        "Cube cells:",
+        {name: len(arrays[f"{name}_count"]) for name in CUBE_FACETS},
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mongodb_host_name", type=str, default="localhost:27017")
+    parser.add_argument("--output_path", type=str, default="dataset/visualize_cube")
+    args = parser.parse_args()
+    main(args)
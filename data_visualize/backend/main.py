@@ -1,19 +1,49 @@
+import os
+import time
 import yaml
 import json
+import threading
+import functools
 import uvicorn
 import datasets
-from typing import List
-from fastapi import FastAPI
+from typing import List, Literal, Optional
+from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
 from pymongo import MongoClient
-from datetime import datetime, timedelta
 from build_qa_mongo_db import QA_COLLECTION_NAME
 from concurrent.futures import ThreadPoolExecutor
 from fastapi.middleware.cors import CORSMiddleware
-from build_mongo_db import DB_NAME, COLLECTION_NAME
+from build_mongo_db import (
+    DB_NAME,
+    COLLECTION_NAME,
+    MONGO_BUILD_MARKER_PATH,
+    read_build_marker,
+)
+from utils.visualize_cube import VisualizeCube, VISUALIZE_CUBE_META_FILE_NAME
+from utils.query_result_cache import QueryResultCache
+from utils.condition_hash_cache import (
+    CONDITION_META_FILE_NAME,
+    ConditionHashCache,
+    canonicalize_condition,
+)
+from utils.mongo_query_utils import (
+    DIALOGUE_SUMMARY_PROJECTION,
+    build_dialogue_page_pipeline,
+    build_dialogue_query,
+    build_dialogue_stats_pipeline,
+    conditions_to_dialogue_filters,
+    decode_dialogue_cursor,
+    encode_dialogue_cursor,
+    get_context_query,
+)
 
 
 TAXONOMY_CONFIG_PATH = "data_visualize/backend/config.yaml"
+# larger cached hash lists are left to the field query, to keep $in small
+CONDITION_CACHE_MAX_HASHES = 50000
+STARTUP_SNAPSHOT_PATH = "dataset/visualize_startup_snapshot.json"
+# seconds between background checks of the snapshot against the collection
+STARTUP_SNAPSHOT_CHECK_INTERVAL = 600
 
 app = FastAPI()
 
@@ -40,122 +70,246 @@ with open(TAXONOMY_CONFIG_PATH) as f:
 level_1_taxonomy_path = config["level_1_taxonomy_path"]
 level_2_taxonomy_path = config["level_2_taxonomy_path"]
 
-with open(level_1_taxonomy_path) as f:
-    taxonomies = [
-        {"class_name": x["class_name"], "index": str(x["index"])}
-        for x in json.load(f)["classes"]
-    ]
-
-taxonomies = sorted(taxonomies, key=lambda x: int(x["index"]))
-
 client = MongoClient("localhost", 27017)
 db = client[DB_NAME]
 collection = db[COLLECTION_NAME]
 qa_collection = db[QA_COLLECTION_NAME]
 
-# Get all countries order by frequency
-all_countries_with_frequency = collection.aggregate(
-    [
-        {"$unwind": "$country"},
-        {"$group": {"_id": "$country", "count": {"$sum": 1}}},
-        {"$sort": {"count": -1}},
-    ]
+
+class BuildMarkerArtifact:
+    """
+    An optional artifact built from the collection, only used while the
+    build marker recorded in its meta is the current one. It is reloaded
+    when the marker or its meta file changes.
+    """
+
+    def __init__(self, name: str, path: str, meta_file_name: str, load: callable):
+        self.name = name
+        self.path = path
+        self.meta_path = os.path.join(path, meta_file_name) if path else None
+        self.load = load
+        self._state = None
+        self._value = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self.meta_path is None:
+            return None
+        build_marker = read_build_marker()
+        try:
+            state = (build_marker, os.path.getmtime(self.meta_path))
+        except FileNotFoundError:
+            state = (build_marker, None)
+        with self._lock:
+            if state != self._state:
+                self._state = state
+                self._value = None
+                if state[1] is not None:
+                    value = self.load(self.path)
+                    if value.meta.get("build_marker") == build_marker:
+                        self._value = value
+                    else:
+                        print("{} is stale, not using it".format(self.name))
+            return self._value
+
+
+# optional cache written by build_condition_hash_cache.py
+condition_cache = BuildMarkerArtifact(
+    "Condition cache",
+    config.get("condition_cache_path"),
+    CONDITION_META_FILE_NAME,
+    ConditionHashCache,
 )
 
-# Get all languages order by frequency
-all_languages_with_frequency = collection.aggregate(
-    [
-        {"$unwind": "$language"},
-        {"$group": {"_id": "$language", "count": {"$sum": 1}}},
-        {"$sort": {"count": -1}},
-    ]
+# results of the dialogue endpoints, dropped when a builder rewrites the
+# build marker
+query_result_cache = QueryResultCache(
+    max_entries=config.get("query_cache_max_entries", 256),
+    ttl=config.get("query_cache_ttl", 600),
+    disk_path=config.get("query_cache_path"),
+    build_marker_path=MONGO_BUILD_MARKER_PATH,
+    max_disk_entries=config.get("query_cache_max_disk_entries"),
 )
 
-# Get top 20 user list
-initial_users_with_frequency = collection.aggregate(
-    [
-        {"$group": {"_id": "$user_name", "count": {"$sum": 1}}},
-        {"$sort": {"count": -1}},
-        {"$limit": 20},
-    ]
+# optional statistics cube written by build_visualize_cube.py
+visualize_cube = BuildMarkerArtifact(
+    "Visualize cube",
+    config.get("visualize_cube_path"),
+    VISUALIZE_CUBE_META_FILE_NAME,
+    VisualizeCube,
 )
 
-# Get top 50 keywords
 
-initial_keywords_with_frequency = collection.aggregate(
-    [
-        {"$unwind": "$keywords"},
-        {
-            "$group": {
-                "_id": "$keywords.value",
-                "count": {"$sum": 1},
-            }
-        },
-        {"$sort": {"count": -1}},
-        {"$limit": 50},
-    ]
-)
+def compute_startup_lists():
+    # Get all countries order by frequency
+    all_countries_with_frequency = collection.aggregate(
+        [
+            {"$unwind": "$country"},
+            {"$group": {"_id": "$country", "count": {"$sum": 1}}},
+            {"$sort": {"count": -1}},
+        ]
+    )
 
-initial_keywords_aggregated_with_frequency = collection.aggregate(
-    [
-        {"$unwind": "$keywords_aggregated"},
-        {
-            "$group": {
-                "_id": "$keywords_aggregated.value",
-                "count": {"$sum": 1},
-            }
-        },
-        {"$sort": {"count": -1}},
-        {"$limit": 50},
-    ]
-)
+    # Get all languages order by frequency
+    all_languages_with_frequency = collection.aggregate(
+        [
+            {"$unwind": "$language"},
+            {"$group": {"_id": "$language", "count": {"$sum": 1}}},
+            {"$sort": {"count": -1}},
+        ]
+    )
 
+    # Get top 20 user list
+    initial_users_with_frequency = collection.aggregate(
+        [
+            {"$group": {"_id": "$user_name", "count": {"$sum": 1}}},
+            {"$sort": {"count": -1}},
+            {"$limit": 20},
+        ]
+    )
 
-all_countries_tmp = [x["_id"] for x in all_countries_with_frequency]
-all_languages_tmp = [x["_id"] for x in all_languages_with_frequency]
-initial_users_tmp = [x["_id"] for x in initial_users_with_frequency]
-initial_keywords_tmp = [x["_id"] for x in initial_keywords_with_frequency]
-initial_keywords_aggregated_tmp = [
-    x["_id"] for x in initial_keywords_aggregated_with_frequency
-]
+    # Get top 50 keywords
+    initial_keywords_with_frequency = collection.aggregate(
+        [
+            {"$unwind": "$keywords"},
+            {
+                "$group": {
+                    "_id": "$keywords.value",
+                    "count": {"$sum": 1},
+                }
+            },
+            {"$sort": {"count": -1}},
+            {"$limit": 50},
+        ]
+    )
 
-print(all_countries_tmp)
-print("lang", all_languages_tmp)
-print("user", initial_users_tmp)
-print("keywords", initial_keywords_tmp)
-print("keywords_agg", initial_keywords_aggregated_tmp)
-
-all_countries = []
-all_languages = []
-initial_users = []
-
-for country in all_countries_tmp:
-    if country is not None:
-        all_countries.append(country)
-
-for language in all_languages_tmp:
-    if language is not None:
-        all_languages.append(language)
-
-for user in initial_users_tmp:
-    if user is not None:
-        initial_users.append(user)
-
-for idx, x in enumerate(taxonomies):
-    cur_index = x["index"]
-    if cur_index in level_2_taxonomy_path:
-        with open(level_2_taxonomy_path[cur_index]) as f:
-            taxonomies[idx]["sub_classes"] = sorted(
-                [
-                    {"class_name": y["class_name"], "index": str(y["index"])}
-                    for y in json.load(f)["classes"]
-                ],
-                key=lambda y: int(y["index"]),
-            )
-    else:
-        taxonomies[idx]["sub_classes"] = []
+    initial_keywords_aggregated_with_frequency = collection.aggregate(
+        [
+            {"$unwind": "$keywords_aggregated"},
+            {
+                "$group": {
+                    "_id": "$keywords_aggregated.value",
+                    "count": {"$sum": 1},
+                }
+            },
+            {"$sort": {"count": -1}},
+            {"$limit": 50},
+        ]
+    )
+
+    return {
+        "all_countries": [
+            x["_id"] for x in all_countries_with_frequency if x["_id"] is not None
+        ],
+        "all_languages": [
+            x["_id"] for x in all_languages_with_frequency if x["_id"] is not None
+        ],
+        "initial_users": [
+            x["_id"] for x in initial_users_with_frequency if x["_id"] is not None
+        ],
+        "initial_keywords": [x["_id"] for x in initial_keywords_with_frequency],
+        "initial_keywords_aggregated": [
+            x["_id"] for x in initial_keywords_aggregated_with_frequency
+        ],
+    }
 
 
+def get_collection_stats_key():
+    cur_result = collection.aggregate([{"$collStats": {"storageStats": {}}}])
+    storage_stats = list(cur_result)[0]["storageStats"]
+    return {"count": storage_stats["count"], "size": storage_stats["size"]}
+
+
+class StartupSnapshot:
+    """
+    The lists served by the filter endpoints, computed on first use and kept
+    in a JSON snapshot keyed by the collection stats. A served snapshot is
+    checked against the collection in a background thread at most every
+    `check_interval` seconds and recomputed when the collection changed.
+    """
+
+    def __init__(self, snapshot_path: str, check_interval: float):
+        self.snapshot_path = snapshot_path
+        self.check_interval = check_interval
+        self._lists = None
+        self._stats_key = None
+        self._checked_at = 0.0
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "r") as f:
+                snapshot = json.load(f)
+            self._lists = snapshot["lists"]
+            self._stats_key = snapshot["stats_key"]
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.snapshot_path) or ".", exist_ok=True)
+        tmp_path = self.snapshot_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"lists": self._lists, "stats_key": self._stats_key}, f)
+        os.replace(tmp_path, self.snapshot_path)
+
+    def _refresh(self):
+        try:
+            stats_key = get_collection_stats_key()
+            if stats_key != self._stats_key:
+                lists = compute_startup_lists()
+                self._lists, self._stats_key = lists, stats_key
+                self._save()
+        finally:
+            self._refreshing = False
+
+    def get(self):
+        with self._lock:
+            if self._lists is None:
+                self._load()
+            if self._lists is None:
+                self._refreshing = True
+                self._refresh()
+                self._checked_at = time.time()
+            elif (
+                not self._refreshing
+                and time.time() - self._checked_at > self.check_interval
+            ):
+                self._refreshing = True
+                self._checked_at = time.time()
+                threading.Thread(target=self._refresh, daemon=True).start()
+            return self._lists
+
+
+startup_snapshot = StartupSnapshot(
+    config.get("startup_snapshot_path", STARTUP_SNAPSHOT_PATH),
+    config.get("startup_snapshot_check_interval", STARTUP_SNAPSHOT_CHECK_INTERVAL),
+)
+
+
+@functools.lru_cache(maxsize=None)
+def load_taxonomies():
+    with open(level_1_taxonomy_path) as f:
+        taxonomies = [
+            {"class_name": x["class_name"], "index": str(x["index"])}
+            for x in json.load(f)["classes"]
+        ]
+
+    taxonomies = sorted(taxonomies, key=lambda x: int(x["index"]))
+
+    for idx, x in enumerate(taxonomies):
+        cur_index = x["index"]
+        if cur_index in level_2_taxonomy_path:
+            with open(level_2_taxonomy_path[cur_index]) as f:
+                taxonomies[idx]["sub_classes"] = sorted(
+                    [
+                        {"class_name": y["class_name"], "index": str(y["index"])}
+                        for y in json.load(f)["classes"]
+                    ],
+                    key=lambda y: int(y["index"]),
+                )
+        else:
+            taxonomies[idx]["sub_classes"] = []
+    return taxonomies
+
 
 @app.get("/")
 def read_root():
@@ -164,17 +318,17 @@ def read_root():
 
 @app.get("/get_label_hierarchy")
 def get_label_hierarchy():
-    return taxonomies
+    return load_taxonomies()
 
 
 @app.get("/get_all_country")
 def get_all_country():
-    return all_countries
+    return startup_snapshot.get()["all_countries"]
 
 
 @app.get("/get_all_language")
 def get_all_language():
-    return all_languages
+    return startup_snapshot.get()["all_languages"]
 
 
 @app.get("/get_user_list")
@@ -195,8 +349,7 @@ def get_user_list(query: str = None):
         print(cur_user_result)
         return cur_user_result
     else:
-        print(initial_users)
-        return initial_users
+        return startup_snapshot.get()["initial_users"]
 
 
 @app.get("/get_keywords_list")
@@ -218,7 +371,7 @@ def get_keywords_list(query: str = None):
         print(cur_keywords_result)
         return cur_keywords_result
     else:
-        return initial_keywords_tmp
+        return startup_snapshot.get()["initial_keywords"]
 
 
 @app.get("/get_keywords_aggregated_list")
@@ -244,7 +397,7 @@ def get_keywords_aggregated_list(query: str = None):
         print(cur_keywords_result)
         return cur_keywords_result
     else:
-        return initial_keywords_aggregated_tmp
+        return startup_snapshot.get()["initial_keywords_aggregated"]
 
 
 class DialogueRequest(BaseModel):
@@ -259,6 +412,12 @@ class DialogueRequest(BaseModel):
     keywords_aggregated: List[str]
     page: int
     page_size: int
+    # "keyset" returns page_size dialogues after `cursor` (the next_cursor of
+    # the previous page), "legacy" the 200 latest ones
+    pagination_mode: Literal["legacy", "keyset"] = "legacy"
+    cursor: Optional[str] = None
+    # leave the conversation bodies out of the dialogue list
+    summary_only: bool = False
 
 
 @app.get("/get_dialogue_context_by_question_hash")
@@ -274,87 +433,58 @@ def get_dialogue_context_by_question_hash(hash: str):
     condition_value = ret["condition_value"]
 
     dial_req = DialogueRequest(
-        country=[],
-        region=[],
-        user_name=[],
-        language=[],
-        topics=[],
-        start_date="",
-        end_date="",
-        keywords=[],
-        keywords_aggregated=[],
+        **conditions_to_dialogue_filters(condition_type, condition_value),
         page=0,
         page_size=10,
     )
 
-    for i in range(len(condition_type)):
-        if condition_type[i] == "country":
-            dial_req.country.append(condition_value[i])
-        if condition_type[i] == "region":
-            dial_req.region.append(condition_value[i])
-        if condition_type[i] == "user_name":
-            dial_req.user_name.append(condition_value[i])
-        if condition_type[i] == "language":
-            dial_req.language.append(condition_value[i])
-        if condition_type[i] == "label_level_1":
-            dial_req.topics.append(condition_value[i])
-        if condition_type[i] == "label_level_2":
-            dial_req.topics.append(condition_value[i])
-        if condition_type[i] == "keywords":
-            dial_req.keywords.append(condition_value[i])
-        if condition_type[i] == "keywords_aggregated":
-            dial_req.keywords_aggregated.append(condition_value[i])
-        if condition_type[i] == "time_week":
-            if condition_value[i].find(":") != -1:
-                dial_req.start_date = condition_value[i].split()[0]
-                dial_req.end_date = (
-                    datetime.strptime(dial_req.start_date, "%Y-%m-%d")
-                    + timedelta(days=7)
-                ).strftime("%Y-%m-%d")
-            else:
-                dial_req.start_date = condition_value[i]
-                dial_req.end_date = (
-                    datetime.strptime(condition_value[i], "%Y-%m-%d")
-                    + timedelta(days=7)
-                ).strftime("%Y-%m-%d")
-
-    return get_dialogues(dial_req)
+    # the dialogues the retriever sees for this question, the cached hashes
+    # hold the matches of the same get_context_query
+    query = get_context_query(condition_type, condition_value)["$match"]
+    cur_condition_cache = condition_cache.get()
+    if cur_condition_cache is not None:
+        cached_hashes = cur_condition_cache.lookup(condition_type, condition_value)
+        if (
+            cached_hashes is not None
+            and len(cached_hashes) <= CONDITION_CACHE_MAX_HASHES
+        ):
+            query = {"hash": {"$in": cached_hashes}}
+
+    return query_result_cache.get_or_compute(
+        "condition_dialogues",
+        {
+            **dial_req.model_dump(),
+            "condition": canonicalize_condition(condition_type, condition_value),
+        },
+        lambda: query_dialogues(query, dial_req, use_visualize_cube=False),
+    )
 
 
 @app.post("/get_dialgoues")
 def get_dialogues(
     request: DialogueRequest,
 ):
+    if request.pagination_mode == "keyset" and request.cursor is not None:
+        try:
+            decode_dialogue_cursor(request.cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+
     # query mongo db based on the request, each field in the request is a list of values, the values are ORed
-    query = {}
-    if len(request.country) > 0:
-        query["country"] = {"$in": request.country}
-    if len(request.region) > 0:
-        query["region"] = {"$in": request.region}
-    if len(request.user_name) > 0:
-        query["user_name"] = {"$in": request.user_name}
-    if len(request.language) > 0:
-        query["language"] = {"$in": request.language}
-    if len(request.topics) > 0:
-        if len(request.topics) > 1:
-            query["labels"] = {"$all": request.topics}
-        else:
-            query["labels"] = {"$in": request.topics}
-    if len(request.keywords) > 0:
-        query["keywords.value"] = {"$in": request.keywords}
+    query = build_dialogue_query(**request.model_dump())
+    return query_result_cache.get_or_compute(
+        "dialogues", request.model_dump(), lambda: query_dialogues(query, request)
+    )
 
-    if len(request.keywords_aggregated) > 0:
-        query["keywords_aggregated.value"] = {"$in": request.keywords_aggregated}
 
-    if request.start_date and request.end_date:
-        request.start_date = datetime.strptime(request.start_date, "%Y-%m-%d")
-        request.end_date = datetime.strptime(request.end_date, "%Y-%m-%d")
+@app.get("/cache_stats")
+def cache_stats():
+    return query_result_cache.get_stats()
 
-        query["timestamp"] = {
-            "$gte": request.start_date,
-            "$lte": request.end_date,
-        }
 
+def query_dialogues(
+    query: dict, request: DialogueRequest, use_visualize_cube: bool = True
+):
     print(query)
 
     # query.pop("timestamp", None)
@@ -362,219 +492,88 @@ def get_dialogues(
 
     # print(query)
 
-    skip = request.page * request.page_size
-
-    def count_dialogues():
-        return collection.count_documents(query)
-
-    def token_count_dialogues():
-        cur_result = collection.aggregate(
-            [
-                {"$match": query},
-                {"$group": {"_id": None, "total": {"$sum": "$token_count"}}},
-            ]
-        )
-
-        cur_result_list = list(cur_result)
-
-        if len(cur_result_list) == 0:
-            return 0
-        return cur_result_list[0]["total"]
-
     def get_dialogue_result():
-        cur_result = list(
-            collection.aggregate(
-                [
-                    {"$match": query},
-                    {"$sort": {"timestamp": -1}},
-                    {"$limit": 200},
-                ],
-            )
-        )
-        ret = [
-            {
-                "conversation": json.loads(x["conversation"]),
-                "summary": x["summary"],
-                "user_name": x["user_name"],
-                "timestamp": x["timestamp"],
-                "labels": x["labels"],
-                "hash": x["hash"],
-                "keywords": x["keywords"],
-                "keywords_aggregated": x["keywords_aggregated"],
-            }
-            for x in cur_result
-        ]
-        return ret
-
-    def get_country_stats():
-        cur_result = list(
-            collection.aggregate(
-                [
-                    {"$match": query},
-                    {"$group": {"_id": "$country", "count": {"$sum": 1}}},
-                    {"$sort": {"count": -1}},
-                ]
-            )
-        )
-        ret = [(x["_id"], x["count"]) for x in cur_result]
-        return ret
-
-    def get_region_stats():
-        cur_result = list(
-            collection.aggregate(
-                [
-                    {"$match": query},
-                    {"$group": {"_id": "$region", "count": {"$sum": 1}}},
-                    {"$sort": {"count": -1}},
-                ]
-            )
-        )
-        ret = [(x["_id"], x["count"]) for x in cur_result]
-        return ret
-
-    def get_user_stats():
-        cur_result = list(
-            collection.aggregate(
-                [
-                    {"$match": query},
-                    {"$group": {"_id": "$user_name", "count": {"$sum": 1}}},
-                    {"$sort": {"count": -1}},
-                    {"$limit": 100},
-                ]
+        if request.pagination_mode == "keyset":
+            pipeline = build_dialogue_page_pipeline(
+                query, request.page_size, request.cursor, request.summary_only
             )
-        )
-        ret = [(x["_id"], x["count"]) for x in cur_result]
-        return ret
-
-    def get_language_stats():
-        cur_result = list(
-            collection.aggregate(
-                [
-                    {"$match": query},
-                    {"$group": {"_id": "$language", "count": {"$sum": 1}}},
-                    {"$sort": {"count": -1}},
-                ]
+        else:
+            pipeline = [
+                {"$match": query},
+                {"$sort": {"timestamp": -1}},
+                {"$limit": 200},
+            ]
+            if request.summary_only:
+                pipeline.append({"$project": DIALOGUE_SUMMARY_PROJECTION})
+        cur_result = list(collection.aggregate(pipeline))
+        ret = []
+        for x in cur_result:
+            item = {}
+            if not request.summary_only:
+                item["conversation"] = json.loads(x["conversation"])
+            item.update(
+                {
+                    "summary": x["summary"],
+                    "user_name": x["user_name"],
+                    "timestamp": x["timestamp"],
+                    "labels": x["labels"],
+                    "hash": x["hash"],
+                    "keywords": x["keywords"],
+                    "keywords_aggregated": x["keywords_aggregated"],
+                }
             )
-        )
-        ret = [(x["_id"], x["count"]) for x in cur_result]
+            ret.append(item)
         return ret
 
-    def get_label_stats():
-        cur_result = list(
-            collection.aggregate(
-                [
-                    {"$match": query},
-                    {"$unwind": "$labels"},
-                    {"$group": {"_id": "$labels", "count": {"$sum": 1}}},
-                    {"$sort": {"count": -1}},
-                ]
-            )
-        )
-        ret = [(x["_id"], x["count"]) for x in cur_result]
-        return ret
+    def compute_stats():
+        filters = request.model_dump()
+        cur_visualize_cube = visualize_cube.get() if use_visualize_cube else None
+        if cur_visualize_cube is not None and cur_visualize_cube.can_answer(filters):
+            return cur_visualize_cube.get_dialogue_stats(filters)
 
-    def get_keyword_stats():
         cur_result = list(
             collection.aggregate(
-                [
-                    {"$match": query},
-                    {"$unwind": "$keywords"},
-                    {
-                        "$group": {
-                            "_id": {
-                                "$concat": [
-                                    "$keywords.value",
-                                    ":",
-                                    "$keywords.keyword_type",
-                                ]
-                            },
-                            "count": {"$sum": 1},
-                        }
-                    },
-                    {"$sort": {"count": -1}},
-                    {"$limit": 100},
-                ]
+                build_dialogue_stats_pipeline(query), allowDiskUse=True
             )
-        )
-        ret = [(x["_id"], x["count"]) for x in cur_result]
-        return ret
-
-    def get_keyword_aggregated_stats():
-        cur_result = list(
-            collection.aggregate(
-                [
-                    {"$match": query},
-                    {"$unwind": "$keywords_aggregated"},
-                    {
-                        "$group": {
-                            "_id": {
-                                "$concat": [
-                                    "$keywords_aggregated.value",
-                                    ":",
-                                    "$keywords_aggregated.keyword_type",
-                                ]
-                            },
-                            "count": {"$sum": 1},
-                        }
-                    },
-                    {"$sort": {"count": -1}},
-                    {"$limit": 100},
-                ]
-            )
-        )
-        ret = [(x["_id"], x["count"]) for x in cur_result]
-        return ret
-
-    def get_keyword_aggregated_count_stats():
-        curq = {**query, "keywords_aggregated": {"$exists": True, "$not": {"$size": 0}}}
-        ret = collection.count_documents(curq)
-        return ret
+        )[0]
+        return {
+            k: [(x["_id"], x["count"]) for x in v] if k != "totals" else v
+            for k, v in cur_result.items()
+        }
 
-    def get_time_stats():
-        cur_result = list(
-            collection.aggregate(
-                [
-                    {"$match": query},
-                    {
-                        "$group": {
-                            "_id": {
-                                "$dateToString": {
-                                    "format": "%Y-%m-%d",
-                                    "date": "$time_week",
-                                }
-                            },
-                            "count": {"$sum": 1},
-                        }
-                    },
-                    {"$sort": {"_id": 1}},
-                ]
-            )
+    def get_stats():
+        # the statistics only depend on the matched documents, every page of
+        # a keyset walk shares them
+        return query_result_cache.get_or_compute(
+            "dialogue_stats",
+            {
+                "query": json.dumps(query, sort_keys=True, default=str),
+                "use_visualize_cube": use_visualize_cube,
+            },
+            compute_stats,
         )
-        ret = [(x["_id"], x["count"]) for x in cur_result]
-        return ret
 
+    # the page of dialogues uses the timestamp index, every statistic comes
+    # from the cube or from a single pass over the matching documents
     with ThreadPoolExecutor() as executor:
-        token_count_dialogues_future = executor.submit(token_count_dialogues)
-        dialogue_count_future = executor.submit(count_dialogues)
         result = executor.submit(get_dialogue_result)
-        country_stats_future = executor.submit(get_country_stats)
-        user_stats_future = executor.submit(get_user_stats)
-        language_stats_future = executor.submit(get_language_stats)
-        label_stats_future = executor.submit(get_label_stats)
-        keyword_stats_future = executor.submit(get_keyword_stats)
-        keyword_aggregated_stats_future = executor.submit(get_keyword_aggregated_stats)
-        kw_dialogue_cnt_future = executor.submit(get_keyword_aggregated_count_stats)
-        time_stats_future = executor.submit(get_time_stats)
+        stats_future = executor.submit(get_stats)
 
         result = result.result()
-        dialogue_count = dialogue_count_future.result()
-        country_stats = country_stats_future.result()
-        user_stats = user_stats_future.result()
-        language_stats = language_stats_future.result()
-        label_stats = label_stats_future.result()
-        keyword_stats = keyword_stats_future.result()
-        time_stats = time_stats_future.result()
-        kw_dialogue_cnt = kw_dialogue_cnt_future.result()
+        stats = stats_future.result()
+
+    if len(stats["totals"]) > 0:
+        totals = stats["totals"][0]
+    else:
+        totals = {"count": 0, "token_count": 0, "keyword_aggregated_count": 0}
+    dialogue_count = totals["count"]
+    kw_dialogue_cnt = totals["keyword_aggregated_count"]
+    country_stats = stats["country_stats"]
+    user_stats = stats["user_stats"]
+    language_stats = stats["language_stats"]
+    label_stats = stats["label_stats"]
+    keyword_stats = stats["keyword_stats"]
+    time_stats = stats["time_stats"]
 
     level_0_status = []
     level_1_status = {}
@@ -602,14 +601,19 @@ def get_dialogues(
         "keyword_stats": [{"keyword": x[0], "count": x[1]} for x in keyword_stats],
         "keyword_aggregated_stats": [
             {"keyword_aggregated": x[0], "count": x[1]}
-            for x in keyword_aggregated_stats_future.result()
+            for x in stats["keyword_aggregated_stats"]
         ],
         "time_stats": [{"date": time, "count": count} for time, count in time_stats],
         "dialogue_count": dialogue_count,
-        "token_count": token_count_dialogues_future.result(),
+        "token_count": totals["token_count"],
         "num_page": dialogue_count // request.page_size
         + int(dialogue_count % request.page_size > 0),
+        "next_cursor": None,
     }
+    if request.pagination_mode == "keyset" and len(result) == request.page_size:
+        ret["next_cursor"] = encode_dialogue_cursor(
+            result[-1]["timestamp"], result[-1]["hash"]
+        )
 
     # compute percentage for country, user, language, label_0, label_1, keyword
 
@@ -1,4 +1,6 @@
 import os
+import re
+import glob
 import json
 import yaml
 import wandb
@@ -9,8 +11,16 @@ from typing import Dict, List
 from sklearn.metrics import f1_score, ndcg_score
 from utils.logging_utils import init_logger, init_logger_simple
 from utils.utils import seed_everthing, parse_response_single, TOPK_PRED
-from modeling import build_model, build_retriever, build_tokenizer, RAGModel
+from modeling import (
+    build_model,
+    build_retriever,
+    build_tokenizer,
+    get_tokenizer_name,
+    RAGModel,
+)
 
+# retrievers whose ranking at a larger k holds every smaller k as prefix
+PREFIX_SAFE_RAG_TYPES = {"bm25"}
 
 
 def random_predictions(data, max_choice: int):
@@ -166,6 +176,29 @@ def init_wandb_logger(config):
     )
 
 
+def get_retrieve_topk(config: Dict):
+    topk_sweep = config["rag_config"].get("topk_sweep", [])
+    if topk_sweep:
+        return max(topk_sweep)
+    return config["rag_config"].get("topk", 0)
+
+
+def is_prefix_safe_retriever(config: Dict):
+    return (
+        config["rag_config"].get("rag_type", "none") in PREFIX_SAFE_RAG_TYPES
+        and "query_generation_model_config" not in config
+    )
+
+
+def list_cached_topk(data_path: str, real_path: str):
+    all_topk = []
+    for p in glob.glob(os.path.join(data_path, real_path + "_top*")):
+        suffix = os.path.basename(p)[len(real_path + "_top") :]
+        if suffix.isdigit():
+            all_topk.append(int(suffix))
+    return all_topk
+
+
 def get_retrieve_cache_path(config: Dict):
     rag_type = config["rag_config"].get("rag_type", "none")
     data_path = config["rag_config"].get("data_path", "")
@@ -191,8 +224,26 @@ def get_retrieve_cache_path(config: Dict):
         real_path += "_force_no_query"
     if is_force_question_query:
         real_path += "_force_question_query"
+    if config["rag_config"].get("fetch_strategy") == "two_phase":
+        # two-phase fetches are already packed to this tokenizer and budget
+        real_path += "_{}_ctx{}".format(
+            re.sub(r"[^\w\-.]", "_", get_tokenizer_name(config["model_config"])),
+            config["rag_config"].get("max_context_token_count", 1048576),
+        )
+
+    topk = get_retrieve_topk(config)
+    cache_path = os.path.join(data_path, real_path + "_top" + str(topk))
+
+    # a cache built at a larger k holds every smaller k as prefix, but only
+    # for retrievers whose ranking does not depend on k itself
+    if is_prefix_safe_retriever(config):
+        for candidate_topk in sorted(list_cached_topk(data_path, real_path)):
+            if candidate_topk >= topk:
+                cache_path = os.path.join(
+                    data_path, real_path + "_top" + str(candidate_topk)
+                )
+                break
 
-    cache_path = os.path.join(data_path, real_path)
     return cache_path
 
 
@@ -257,7 +308,19 @@ def run_retrieve(args):
     with open(args.config_path, "r") as f:
         config = yaml.load(f, Loader=yaml.FullLoader)
 
-    log_path = get_retrieve_cache_path(config)
+    is_topk_sweep = len(config["rag_config"].get("topk_sweep", [])) > 0
+    if is_topk_sweep and not is_prefix_safe_retriever(config):
+        raise ValueError(
+            "topk_sweep is only supported for plain {} retrievers, the other rankings depend on topk".format(
+                "/".join(sorted(PREFIX_SAFE_RAG_TYPES))
+            )
+        )
+    retrieve_context_path = get_retrieve_cache_path(config)
+    if is_topk_sweep:
+        # the per-k request files go to the run logs, not the dataset cache
+        log_path, logger = init_logger(args.config_path)
+    else:
+        log_path = retrieve_context_path
 
     dataset = datasets.Dataset.load_from_disk(config["rag_config"]["data_path"])
     logger.info("Dataset columns: {}".format(dataset.column_names))
@@ -267,19 +330,21 @@ def run_retrieve(args):
     tokenize_func, chat_template_func = build_tokenizer(model_config)
     all_params = {
         "tokenize_func": tokenize_func,
+        "tokenizer_name": get_tokenizer_name(model_config),
         "is_model_generated_retrieval": "query_generation_model_config" in config,
         **config["rag_config"],
     }
     retriver = build_retriever(**all_params)
     rag_model = RAGModel(
         logging_path=log_path,
-        retrieve_context_path=log_path,
+        retrieve_context_path=retrieve_context_path,
         logger=logger,
         model=None,
         retriever=retriver,
     )
 
-    rag_model.run_context_build(build_prompt=False)
+    # with a top-k sweep the prompts of every k are written to the run logs
+    rag_model.run_context_build(build_prompt=is_topk_sweep)
 
 
 def run_model_response(args):
@@ -329,6 +394,11 @@ def run_full(args):
 
     log_path, logger, config, dataset = seed_and_load(args)
 
+    if config["rag_config"].get("topk_sweep", []):
+        raise ValueError(
+            "topk_sweep is only supported in retrieve mode, run inference on the generated top_<k>/request.json files"
+        )
+
     if args.data_parallel > 1:
         cur_idx = list(range(args.data_parallel_rank, len(dataset), args.data_parallel))
         dataset = dataset.select(cur_idx)
@@ -350,6 +420,7 @@ def run_full(args):
     )
     all_params = {
         "tokenize_func": tokenize_func,
+        "tokenizer_name": get_tokenizer_name(model_config),
         "is_model_generated_retrieval": "query_generation_model_config" in config,
         "data_parallel": args.data_parallel,
         "data_parallel_rank": args.data_parallel_rank,
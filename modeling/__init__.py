@@ -79,6 +79,42 @@ def default_chat_template_func(x):
     return ret
 
 
+def get_tokenizer_name(model_config: dict) -> str:
+    """
+    Identity of the tokenizer returned by `build_tokenizer`, used as the key of
+    the token count cache
+    """
+    model_name = model_config["name"]
+    model_type = model_config.get("type", "vllm")
+    if model_name in {
+        "gpt-4.1",
+        "gpt-4.1-mini",
+        "gpt-4.1-nano",
+        "gpt-4o",
+        "o1-mini",
+        "o1",
+        "o3-mini",
+        "gpt-4o-mini",
+        "o3",
+        "o4-mini",
+    }:
+        try:
+            return "tiktoken/" + tiktoken.encoding_for_model(model_name).name
+        except:
+            return "tiktoken/o200k_base"
+    if model_type == "deepseek":
+        if model_name == "deepseek-chat":
+            return "deepseek-ai/DeepSeek-V3"
+        elif model_name == "deepseek-reasoning":
+            return "deepseek-ai/DeepSeek-R1"
+    elif model_type == "openrouter":
+        if model_name == "microsoft/mai-ds-r1:free":
+            return "deepseek-ai/DeepSeek-R1"
+        elif model_name.find("gemini") != -1:
+            return "whitespace"
+    return model_name
+
+
 def build_tokenizer(model_config: dict):
 
     model_name = model_config["name"]
@@ -1,8 +1,25 @@
 import os
 import datasets
 from tqdm import tqdm
-from elasticsearch import Elasticsearch
-from modeling.rag_model import RetrieverBase
+from modeling.rag_model import RetrieverBase, attach_context
+from modeling.local_index_utils import INDEX_BACKENDS
+from modeling.local_bm25_index import LocalBM25Index
+from utils.async_retrieval_engine import RETRIEVAL_ENGINES, AsyncRetrievalEngine
+from utils.elasticsearch_utils import (
+    SEARCH_MODES,
+    build_context_from_hits,
+    build_elasticsearch_client,
+    build_source_filter,
+    msearch_in_batches,
+)
+
+
+def build_bm25_request(question: str, doc_field_name: str, topk: int):
+    return {
+        "query": {"match": {doc_field_name: question}},
+        "size": topk,  # specify the number of documents you want to return
+        "_source": build_source_filter(doc_field_name),
+    }
 
 
 def build_context_batch_worker(
@@ -12,43 +29,76 @@ def build_context_batch_worker(
     bm25_index_name: str,
     topk: int,
     doc_field_name: str,
+    search_mode: str = "single",
+    msearch_batch_size: int = 64,
 ):
-    retriever = Elasticsearch(
-        "http://elastic:{}".format(os.environ["ELASTIC_PASSWORD"])
-        + "@{}".format(elasticsearch_host_name),
-        verify_certs=False,
-        ssl_show_warn=False,
-    )
+    retriever = build_elasticsearch_client(elasticsearch_host_name)
 
     context_list = []
     context_id_list = []
+    context_score_list = []
     all_questions = data_batch["question"]
-    for i in tqdm(
-        list(range(len(all_questions))),
-        desc="Building context batch {}".format(rank + 1),
-        position=rank + 1,
-        leave=False,
-    ):
-        doc_list = retriever.search(
-            index=bm25_index_name,
-            body={
-                "query": {"match": {doc_field_name: all_questions[i]}},
-                "size": topk,  # specify the number of documents you want to return
-            },
-        )["hits"]["hits"]
+    all_requests = [build_bm25_request(q, doc_field_name, topk) for q in all_questions]
 
-        context_str_list = []
-        cur_context_doc_ids = []
-        for doc in doc_list:
-            cur_doc = doc["_source"][doc_field_name]
-            cur_doc = cur_doc.replace("<|endoftext|>", " ")
-            cur_context_doc_ids.append(doc["_source"]["hash"])
-            context_str_list.append(cur_doc)
+    if search_mode == "msearch":
+        all_doc_lists = msearch_in_batches(
+            retriever,
+            bm25_index_name,
+            all_requests,
+            msearch_batch_size,
+            desc="Building context batch {}".format(rank + 1),
+            position=rank + 1,
+        )
+    else:
+        all_doc_lists = []
+        for i in tqdm(
+            list(range(len(all_questions))),
+            desc="Building context batch {}".format(rank + 1),
+            position=rank + 1,
+            leave=False,
+        ):
+            doc_list = retriever.search(index=bm25_index_name, body=all_requests[i])[
+                "hits"
+            ]["hits"]
+            all_doc_lists.append(doc_list)
 
+    for doc_list in all_doc_lists:
+        context_str_list, cur_context_doc_ids, cur_context_scores = (
+            build_context_from_hits(doc_list, doc_field_name)
+        )
         context_list.append(context_str_list)
         context_id_list.append(cur_context_doc_ids)
+        context_score_list.append(cur_context_scores)
     data_batch["context"] = context_list
     data_batch["context_doc_ids"] = context_id_list
+    data_batch["context_scores"] = context_score_list
+    return data_batch
+
+
+def build_context_local_batch_worker(
+    data_batch: datasets.Dataset,
+    local_index_path: str,
+    topk: int,
+    doc_field_name: str,
+):
+    index = LocalBM25Index(local_index_path)
+    all_requests = [
+        build_bm25_request(q, doc_field_name, topk) for q in data_batch["question"]
+    ]
+
+    context_list = []
+    context_id_list = []
+    context_score_list = []
+    for doc_list in index.search_requests(all_requests, doc_field_name):
+        context_str_list, cur_context_doc_ids, cur_context_scores = (
+            build_context_from_hits(doc_list, doc_field_name)
+        )
+        context_list.append(context_str_list)
+        context_id_list.append(cur_context_doc_ids)
+        context_score_list.append(cur_context_scores)
+    data_batch["context"] = context_list
+    data_batch["context_doc_ids"] = context_id_list
+    data_batch["context_scores"] = context_score_list
     return data_batch
 
 
@@ -56,9 +106,15 @@ class BM25Retriver(RetrieverBase):
     def __init__(
         self,
         topk: int,
-        elasticsearch_index_name: str,
-        elasticsearch_host_name: str,
+        elasticsearch_index_name: str = None,
+        elasticsearch_host_name: str = None,
         doc_field_name: str = "document",
+        search_mode: str = "single",
+        msearch_batch_size: int = 64,
+        retrieval_engine: str = "map",
+        max_in_flight: int = 64,
+        index_backend: str = "elasticsearch",
+        local_index_path: str = None,
         **kwargs
     ):
         super().__init__(**kwargs)
@@ -66,9 +122,75 @@ class BM25Retriver(RetrieverBase):
         self.elasticsearch_host_name = elasticsearch_host_name
         self.bm25_index_name = elasticsearch_index_name
         self.doc_field_name = doc_field_name
+        self.search_mode = search_mode
+        self.msearch_batch_size = msearch_batch_size
+        self.retrieval_engine = retrieval_engine
+        self.max_in_flight = max_in_flight
+        self.index_backend = index_backend
+        self.local_index_path = local_index_path
+
+        if self.index_backend not in INDEX_BACKENDS:
+            raise ValueError(f"Invalid index backend: {self.index_backend}")
+        if self.index_backend == "local" and self.local_index_path is None:
+            raise ValueError("local_index_path is required for the local backend")
+        if self.search_mode not in SEARCH_MODES:
+            raise ValueError(f"Invalid search mode: {self.search_mode}")
+        if self.retrieval_engine not in RETRIEVAL_ENGINES:
+            raise ValueError(f"Invalid retrieval engine: {self.retrieval_engine}")
+
+    def build_context_async(self, full_data: datasets.Dataset) -> datasets.Dataset:
+        engine = AsyncRetrievalEngine(
+            self.elasticsearch_host_name, max_in_flight=self.max_in_flight
+        )
+        request_groups = [
+            [build_bm25_request(q, self.doc_field_name, self.topk)]
+            for q in full_data["question"]
+        ]
+        all_results = engine.search(self.bm25_index_name, request_groups)
+
+        context_list = []
+        context_id_list = []
+        context_score_list = []
+        for (doc_list,) in all_results:
+            context_str_list, cur_context_doc_ids, cur_context_scores = (
+                build_context_from_hits(doc_list, self.doc_field_name)
+            )
+            context_list.append(context_str_list)
+            context_id_list.append(cur_context_doc_ids)
+            context_score_list.append(cur_context_scores)
+        return attach_context(
+            full_data, context_list, context_id_list, context_score_list
+        )
+
+    def build_context_local(self, full_data: datasets.Dataset) -> datasets.Dataset:
+        bs = len(full_data) // os.cpu_count()
+
+        if bs == 0:
+            bs = 1
+
+        if len(full_data) % os.cpu_count() != 0:
+            bs += 1
+
+        return full_data.map(
+            build_context_local_batch_worker,
+            fn_kwargs={
+                "local_index_path": self.local_index_path,
+                "topk": self.topk,
+                "doc_field_name": self.doc_field_name,
+            },
+            batched=True,
+            batch_size=bs,
+            num_proc=os.cpu_count(),
+        )
 
     def build_context(self, full_data: datasets.Dataset) -> datasets.Dataset:
 
+        if self.index_backend == "local":
+            return self.build_context_local(full_data)
+
+        if self.retrieval_engine == "async":
+            return self.build_context_async(full_data)
+
         bs = len(full_data) // os.cpu_count()
 
         if bs == 0:
@@ -84,6 +206,8 @@ class BM25Retriver(RetrieverBase):
                 "bm25_index_name": self.bm25_index_name,
                 "topk": self.topk,
                 "doc_field_name": self.doc_field_name,
+                "search_mode": self.search_mode,
+                "msearch_batch_size": self.msearch_batch_size,
             },
             with_rank=True,
             batched=True,
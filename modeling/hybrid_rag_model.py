@@ -1,7 +1,158 @@
 import os
 import datasets
-from elasticsearch import Elasticsearch
-from modeling.rag_model import RetrieverBase
+from typing import List
+from modeling.rag_model import RetrieverBase, attach_context
+from modeling.rank_fusion import FUSION_METHODS, fuse_hit_lists
+from utils.token_count_cache import TokenCountCache
+from utils.elasticsearch_utils import (
+    build_context_from_hits,
+    build_elasticsearch_client,
+    build_source_filter,
+)
+from utils.async_retrieval_engine import RETRIEVAL_ENGINES, AsyncRetrievalEngine
+
+
+def build_hybrid_request(question: str, question_embedding: List[float], topk: int):
+    return {
+        "query": {"match": {"document": question}},
+        "knn": {
+            "field": "embedding",
+            "query_vector": question_embedding,
+            "num_candidates": 5 * topk,
+            "k": topk,
+        },
+        "size": topk,
+        "_source": build_source_filter("document"),
+    }
+
+
+def build_hybrid_request_list(
+    question: str,
+    question_embedding: List[float],
+    topk: int,
+    fusion_method: str = None,
+):
+    """
+    One combined request scored by Elasticsearch, or separate (knn, bm25)
+    requests when the results are fused client-side with `fusion_method`
+    """
+    if fusion_method is None:
+        return [build_hybrid_request(question, question_embedding, topk)]
+    return [
+        {
+            "knn": {
+                "field": "embedding",
+                "query_vector": question_embedding,
+                "num_candidates": 5 * topk,
+                "k": topk,
+            },
+            "size": topk,
+            "_source": build_source_filter("document"),
+        },
+        {
+            "query": {"match": {"document": question}},
+            "size": topk,
+            "_source": build_source_filter("document"),
+        },
+    ]
+
+
+def fuse_hybrid_hits(
+    doc_lists: List[List[dict]],
+    topk: int,
+    fusion_method: str = None,
+    knn_weight: float = 1.0,
+    bm25_weight: float = 1.0,
+    rank_constant: int = 60,
+):
+    if fusion_method is None:
+        return doc_lists[0]
+    return fuse_hit_lists(
+        doc_lists,
+        [0, 0],
+        [knn_weight, bm25_weight],
+        topk,
+        method=fusion_method,
+        rank_constant=rank_constant,
+    )
+
+
+def pack_context_from_hits(
+    doc_list: List[dict],
+    max_context_token_count: int,
+    tokenize_func: callable,
+    token_count_cache: TokenCountCache = None,
+):
+    all_docs, all_doc_ids, all_scores = build_context_from_hits(doc_list, "document")
+
+    if token_count_cache is not None:
+        cached_counts = token_count_cache.lookup(all_doc_ids).tolist()
+    else:
+        cached_counts = [-1] * len(all_docs)
+
+    # the cache is only read here, this also runs inside `datasets.map`
+    # workers whose copy is never flushed; the counts of the packed documents
+    # are added later by `RAGModel.add_context_token_counts`
+    token_count = 0
+    num_docs = 0
+    for cur_doc, cur_token_count in zip(all_docs, cached_counts):
+        if cur_token_count < 0:
+            cur_token_count = len(tokenize_func(cur_doc))
+
+        if token_count + cur_token_count >= max_context_token_count:
+            break
+        token_count += cur_token_count
+        num_docs += 1
+    return all_docs[:num_docs], all_doc_ids[:num_docs], all_scores[:num_docs]
+
+
+def build_context_batch_worker(
+    data_batch: datasets.Dataset,
+    elasticsearch_host_name: str,
+    index_name: str,
+    topk: int,
+    max_context_token_count: int,
+    tokenize_func: callable,
+    token_count_cache: TokenCountCache = None,
+    fusion_method: str = None,
+    knn_weight: float = 1.0,
+    bm25_weight: float = 1.0,
+    rank_constant: int = 60,
+):
+    retriever = build_elasticsearch_client(elasticsearch_host_name)
+
+    context_list = []
+    context_id_list = []
+    context_score_list = []
+    all_questions = data_batch["question"]
+    all_embeddings = data_batch["question_embedding"]
+    for i in range(len(all_questions)):
+        all_doc_lists = []
+        for body in build_hybrid_request_list(
+            all_questions[i], all_embeddings[i], topk, fusion_method
+        ):
+            all_doc_lists.append(
+                retriever.search(index=index_name, body=body)["hits"]["hits"]
+            )
+        doc_list = fuse_hybrid_hits(
+            all_doc_lists,
+            topk,
+            fusion_method,
+            knn_weight,
+            bm25_weight,
+            rank_constant,
+        )
+
+        context_str_list, context_doc_ids, cur_context_scores = pack_context_from_hits(
+            doc_list, max_context_token_count, tokenize_func, token_count_cache
+        )
+        context_list.append(context_str_list)
+        context_id_list.append(context_doc_ids)
+        context_score_list.append(cur_context_scores)
+    data_batch["context"] = context_list
+    data_batch["context_doc_ids"] = context_id_list
+    data_batch["context_scores"] = context_score_list
+    return data_batch
 
 
 class HybridRetriever(RetrieverBase):
@@ -10,58 +161,73 @@ class HybridRetriever(RetrieverBase):
         topk: int,
         elasticsearch_index_name: str,
         elasticsearch_host_name: str,
+        retrieval_engine: str = "map",
+        max_in_flight: int = 64,
+        fusion_method: str = None,
+        knn_weight: float = 1.0,
+        bm25_weight: float = 1.0,
+        rank_constant: int = 60,
         **kwargs
     ):
         super().__init__(**kwargs)
         self.topk = topk
         self.bm25_index_name = elasticsearch_index_name
         self.elasticsearch_host_name = elasticsearch_host_name
+        self.retrieval_engine = retrieval_engine
+        self.max_in_flight = max_in_flight
+        # None keeps the combined query scored by Elasticsearch
+        self.fusion_method = fusion_method
+        self.knn_weight = knn_weight
+        self.bm25_weight = bm25_weight
+        self.rank_constant = rank_constant
 
-    def build_context(self, full_data: datasets.Dataset) -> str:
-        def build_context_batch_worker(
-            data_batch: datasets.Dataset,
-            max_context_token_count: int,
-            tokenize_func: callable,
-        ):
-            retriever = Elasticsearch(
-                "http://elastic:{}".format(os.environ["ELASTIC_PASSWORD"])
-                + "@{}".format(self.elasticsearch_host_name),
-                verify_certs=False,
-                ssl_show_warn=False,
+        if self.fusion_method is not None and self.fusion_method not in FUSION_METHODS:
+            raise ValueError(f"Invalid fusion method: {self.fusion_method}")
+        if self.retrieval_engine not in RETRIEVAL_ENGINES:
+            raise ValueError(f"Invalid retrieval engine: {self.retrieval_engine}")
+
+    def build_context_async(self, full_data: datasets.Dataset) -> datasets.Dataset:
+        engine = AsyncRetrievalEngine(
+            self.elasticsearch_host_name, max_in_flight=self.max_in_flight
+        )
+        request_groups = [
+            build_hybrid_request_list(q, e, self.topk, self.fusion_method)
+            for q, e in zip(full_data["question"], full_data["question_embedding"])
+        ]
+        all_results = engine.search(self.bm25_index_name, request_groups)
+
+        token_count_cache = self.build_token_count_cache()
+        context_list = []
+        context_id_list = []
+        context_score_list = []
+        for all_doc_lists in all_results:
+            doc_list = fuse_hybrid_hits(
+                all_doc_lists,
+                self.topk,
+                self.fusion_method,
+                self.knn_weight,
+                self.bm25_weight,
+                self.rank_constant,
+            )
+            context_str_list, context_doc_ids, cur_context_scores = (
+                pack_context_from_hits(
+                    doc_list,
+                    self.max_context_token_count,
+                    self.tokenize_func,
+                    token_count_cache,
+                )
             )
+            context_list.append(context_str_list)
+            context_id_list.append(context_doc_ids)
+            context_score_list.append(cur_context_scores)
+        return attach_context(
+            full_data, context_list, context_id_list, context_score_list
+        )
+
+    def build_context(self, full_data: datasets.Dataset) -> str:
 
-            context_list = []
-            for data_sample in data_batch:
-                doc_list = retriever.search(
-                    query={"match": {"document": data_sample["question"]}},
-                    knn={
-                        "field": "embedding",
-                        "query_vector": data_sample["question_embedding"],
-                        "num_candidates": 5 * self.topk,
-                        "k": self.topk,
-                    },
-                    size=self.topk,
-                )["hits"]["hits"]
-
-                context_str = ""
-                token_count = 0
-
-                for doc in doc_list:
-                    cur_doc = doc["_source"]["document"]
-
-                    cur_doc = cur_doc.replace("<|endoftext|>", " ")
-
-                    cur_token_count = len(tokenize_func(cur_doc))
-
-                    if token_count + cur_token_count < max_context_token_count:
-                        token_count += cur_token_count
-                        context_str += cur_doc
-                        context_str += "\n\n"
-                    else:
-                        break
-                context_list.append(context_str)
-            data_batch["context"] = context_list
-            return data_batch
+        if self.retrieval_engine == "async":
+            return self.build_context_async(full_data)
 
         bs = len(full_data) // os.cpu_count()
 
@@ -74,8 +240,16 @@ class HybridRetriever(RetrieverBase):
         dataset_with_ctx = full_data.map(
             build_context_batch_worker,
             fn_kwargs={
+                "elasticsearch_host_name": self.elasticsearch_host_name,
+                "index_name": self.bm25_index_name,
+                "topk": self.topk,
                 "max_context_token_count": self.max_context_token_count,
                 "tokenize_func": self.tokenize_func,
+                "token_count_cache": self.build_token_count_cache(),
+                "fusion_method": self.fusion_method,
+                "knn_weight": self.knn_weight,
+                "bm25_weight": self.bm25_weight,
+                "rank_constant": self.rank_constant,
             },
             batched=True,
             batch_size=bs,
@@ -0,0 +1,294 @@
+import os
+import re
+import json
+import hashlib
+import datasets
+import unicodedata
+import numpy as np
+from tqdm import tqdm
+from typing import List
+from collections import Counter
+from scipy.sparse import csr_matrix
+from modeling.local_index_utils import LocalIndexMetadata, build_index_metadata
+
+BM25_INDEX_FILE_NAME = "bm25_index.json"
+MAX_TOKEN_LENGTH = 255
+CJK_CHARS = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff"
+TOKEN_PATTERN = re.compile(f"[{CJK_CHARS}]|[^\\W{CJK_CHARS}]+")
+
+
+def analyze(text: str) -> List[str]:
+    """
+    Approximation of the `icu_tokenizer` + `icu_folding` analyzer of the
+    Elasticsearch mapping: compatibility decomposition, accents stripped,
+    case folded, split on word boundaries with one token per CJK character
+    """
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    tokens = []
+    for token in TOKEN_PATTERN.findall(text.casefold()):
+        for st in range(0, len(token), MAX_TOKEN_LENGTH):
+            tokens.append(token[st : st + MAX_TOKEN_LENGTH])
+    return tokens
+
+
+def hash_term(term: str) -> int:
+    # terms are stored as signed 64-bit hashes to keep the vocabulary compact
+    digest = hashlib.blake2b(term.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little", signed=True)
+
+
+def analyze_batch(data_batch):
+    all_term_hashes = []
+    all_term_counts = []
+    for doc in data_batch["document"]:
+        counts = Counter(analyze(doc))
+        all_term_hashes.append([hash_term(x) for x in counts])
+        all_term_counts.append(list(counts.values()))
+    return {"term_hashes": all_term_hashes, "term_counts": all_term_counts}
+
+
+def build_local_bm25_index(
+    documents: datasets.Dataset,
+    index_path: str,
+    k1: float = 1.2,
+    b: float = 0.75,
+    batch_size: int = 4096,
+    num_proc: int = None,
+):
+    """
+    Build term-major posting lists of `documents` with precomputed BM25
+    weights (Lucene formula, without the k1 + 1 numerator) and save them as
+    memory-mappable arrays under `index_path`
+    """
+    os.makedirs(index_path, exist_ok=True)
+    analyzed = documents.select_columns(["document"]).map(
+        analyze_batch,
+        batched=True,
+        batch_size=batch_size,
+        remove_columns=["document"],
+        num_proc=num_proc if num_proc is not None else os.cpu_count(),
+        desc="Analyzing documents",
+    )
+
+    num_docs = len(analyzed)
+    doc_lengths = np.zeros(num_docs, dtype=np.int64)
+    indptr = [np.zeros(1, dtype=np.int64)]
+    all_hashes = []
+    all_counts = []
+    st = 0
+    for batch in tqdm(
+        analyzed.iter(batch_size=batch_size),
+        total=(num_docs + batch_size - 1) // batch_size,
+        desc="Collecting postings",
+    ):
+        lengths = [len(x) for x in batch["term_hashes"]]
+        indptr.append(indptr[-1][-1] + np.cumsum(lengths))
+        for term_hashes, term_counts in zip(batch["term_hashes"], batch["term_counts"]):
+            all_hashes.append(np.asarray(term_hashes, dtype=np.int64))
+            all_counts.append(np.asarray(term_counts, dtype=np.float32))
+            doc_lengths[st] = sum(term_counts)
+            st += 1
+
+    all_hashes = np.concatenate(all_hashes)
+    term_hashes, term_ids = np.unique(all_hashes, return_inverse=True)
+    doc_term_matrix = csr_matrix(
+        (np.concatenate(all_counts), term_ids.astype(np.int32), np.concatenate(indptr)),
+        shape=(num_docs, len(term_hashes)),
+    )
+    del all_hashes, all_counts, term_ids
+
+    postings = doc_term_matrix.tocsc()
+    postings.sort_indices()
+    del doc_term_matrix
+
+    doc_freq = np.diff(postings.indptr)
+    idf = np.log(1 + (num_docs - doc_freq + 0.5) / (doc_freq + 0.5))
+    avg_doc_length = float(doc_lengths.mean()) if num_docs > 0 else 0.0
+    tf = postings.data
+    norm = k1 * (1 - b + b * doc_lengths[postings.indices] / avg_doc_length)
+    weights = np.repeat(idf, doc_freq) * tf / (tf + norm)
+
+    np.save(os.path.join(index_path, "term_hashes.npy"), term_hashes)
+    np.save(
+        os.path.join(index_path, "postings_indptr.npy"),
+        postings.indptr.astype(np.int64),
+    )
+    np.save(
+        os.path.join(index_path, "postings_doc_ids.npy"),
+        postings.indices.astype(np.int32),
+    )
+    np.save(
+        os.path.join(index_path, "postings_weights.npy"), weights.astype(np.float32)
+    )
+    with open(os.path.join(index_path, BM25_INDEX_FILE_NAME), "w") as f:
+        json.dump(
+            {
+                "k1": k1,
+                "b": b,
+                "avg_doc_length": avg_doc_length,
+                "num_terms": len(term_hashes),
+            },
+            f,
+        )
+
+    build_index_metadata(documents, index_path)
+
+
+def parse_match_request(body: dict):
+    """
+    Extract (query texts, filters, size, match_all) from the search bodies
+    built by the BM25 retrievers: a single `match` query, or a `bool` query
+    with `filter` clauses and `match` clauses in `should`. `match_all` tells
+    whether documents matching no query term are still hits, as in a `bool`
+    query whose `should` clauses are optional.
+    """
+    size = body.get("size", 10)
+    query = body.get("query", {})
+
+    if "match" in query:
+        return list(query["match"].values()), [], size, False
+
+    bool_query = query.get("bool")
+    if bool_query is None or len(set(bool_query) - {"filter", "should"}) > 0:
+        raise ValueError(f"Unsupported query for local BM25 index: {query}")
+    filters = bool_query.get("filter", [])
+    should = bool_query.get("should", [])
+    if any("match" not in x for x in should):
+        raise ValueError(f"Unsupported query for local BM25 index: {query}")
+    texts = [v for x in should for v in x["match"].values()]
+    return texts, filters, size, len(filters) > 0 or len(should) == 0
+
+
+class LocalBM25Index:
+    """
+    BM25 over the memory-mapped posting lists built by
+    `build_local_bm25_index`. A batch of queries is scored with one sparse
+    matrix product against the posting lists of its terms.
+    """
+
+    def __init__(self, index_path: str, query_batch_size: int = 256):
+        self.term_hashes = np.load(
+            os.path.join(index_path, "term_hashes.npy"), mmap_mode="r"
+        )
+        self.indptr = np.load(
+            os.path.join(index_path, "postings_indptr.npy"), mmap_mode="r"
+        )
+        self.doc_ids = np.load(
+            os.path.join(index_path, "postings_doc_ids.npy"), mmap_mode="r"
+        )
+        self.weights = np.load(
+            os.path.join(index_path, "postings_weights.npy"), mmap_mode="r"
+        )
+        self.metadata = LocalIndexMetadata(index_path)
+        self.num_docs = self.metadata.num_docs
+        self.query_batch_size = query_batch_size
+
+    def lookup_terms(self, tokens: List[str]) -> np.ndarray:
+        """
+        Term ids of `tokens`, -1 for terms that are not in the index
+        """
+        term_ids = np.full(len(tokens), -1, dtype=np.int64)
+        if len(tokens) == 0 or len(self.term_hashes) == 0:
+            return term_ids
+        hashes = np.asarray([hash_term(x) for x in tokens], dtype=np.int64)
+        pos = np.minimum(
+            np.searchsorted(self.term_hashes, hashes), len(self.term_hashes) - 1
+        )
+        found = self.term_hashes[pos] == hashes
+        term_ids[found] = pos[found]
+        return term_ids
+
+    def score(self, query_texts: List[List[str]]) -> csr_matrix:
+        """
+        Sparse (num queries, num docs) BM25 scores, the texts of one query
+        are scored as a single bag of words like `should` match clauses
+        """
+        query_term_ids = []
+        for texts in query_texts:
+            tokens = [x for text in texts for x in analyze(text)]
+            term_ids = self.lookup_terms(tokens)
+            query_term_ids.append(term_ids[term_ids >= 0])
+
+        unique_terms, inverse = np.unique(
+            np.concatenate(query_term_ids + [np.zeros(0, dtype=np.int64)]),
+            return_inverse=True,
+        )
+        query_lengths = [len(x) for x in query_term_ids]
+        query_matrix = csr_matrix(
+            (
+                np.ones(len(inverse), dtype=np.float32),
+                inverse,
+                np.concatenate([[0], np.cumsum(query_lengths)]),
+            ),
+            shape=(len(query_texts), len(unique_terms)),
+        )
+
+        # gather the posting lists of the query terms only
+        starts = np.asarray(self.indptr[unique_terms])
+        ends = np.asarray(self.indptr[unique_terms + 1])
+        posting_doc_ids = [np.asarray(self.doc_ids[s:e]) for s, e in zip(starts, ends)]
+        posting_weights = [np.asarray(self.weights[s:e]) for s, e in zip(starts, ends)]
+        term_matrix = csr_matrix(
+            (
+                np.concatenate(posting_weights + [np.zeros(0, dtype=np.float32)]),
+                np.concatenate(posting_doc_ids + [np.zeros(0, dtype=np.int32)]),
+                np.concatenate([[0], np.cumsum(ends - starts)]),
+            ),
+            shape=(len(unique_terms), self.num_docs),
+        )
+        return (query_matrix @ term_matrix).tocsr()
+
+    def search_requests(
+        self, bodies: List[dict], doc_field_name: str = "document"
+    ) -> List[List[dict]]:
+        """
+        Answer Elasticsearch BM25 search bodies with Elasticsearch-shaped hit
+        lists, in the same order as `bodies`
+        """
+        all_parsed = [parse_match_request(body) for body in bodies]
+        results = [None] * len(bodies)
+
+        filter_groups = {}
+        for i, (_, filters, _, _) in enumerate(all_parsed):
+            key = json.dumps(filters, sort_keys=True)
+            filter_groups.setdefault(key, (filters, []))[1].append(i)
+
+        for filters, rows in filter_groups.values():
+            mask = self.metadata.build_mask(filters)
+            for st in range(0, len(rows), self.query_batch_size):
+                cur_rows = rows[st : st + self.query_batch_size]
+                scores = self.score([all_parsed[i][0] for i in cur_rows])
+                for r, i in enumerate(cur_rows):
+                    _, _, size, match_all = all_parsed[i]
+                    doc_ids = scores.indices[scores.indptr[r] : scores.indptr[r + 1]]
+                    doc_scores = scores.data[scores.indptr[r] : scores.indptr[r + 1]]
+                    if mask is not None:
+                        keep = mask[doc_ids]
+                        doc_ids, doc_scores = doc_ids[keep], doc_scores[keep]
+                    if size == 0:
+                        doc_ids, doc_scores = doc_ids[:0], doc_scores[:0]
+                    elif len(doc_ids) > size:
+                        part = np.argpartition(-doc_scores, size - 1)[:size]
+                        doc_ids, doc_scores = doc_ids[part], doc_scores[part]
+                    order = np.lexsort((doc_ids, -doc_scores))
+                    doc_ids, doc_scores = doc_ids[order], doc_scores[order]
+
+                    if match_all and len(doc_ids) < size:
+                        # documents matching no query term score 0
+                        candidates = (
+                            np.arange(self.num_docs)
+                            if mask is None
+                            else np.nonzero(mask)[0]
+                        )
+                        candidates = candidates[~np.isin(candidates, doc_ids)]
+                        candidates = candidates[: size - len(doc_ids)]
+                        doc_ids = np.concatenate([doc_ids, candidates])
+                        doc_scores = np.concatenate(
+                            [doc_scores, np.zeros(len(candidates), dtype=np.float32)]
+                        )
+
+                    results[i] = self.metadata.build_hits(
+                        doc_ids, doc_scores, doc_field_name
+                    )
+        return results
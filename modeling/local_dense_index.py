@@ -0,0 +1,269 @@
+import os
+import json
+import datasets
+import numpy as np
+from tqdm import tqdm
+from typing import List
+from modeling.local_index_utils import LocalIndexMetadata, build_index_metadata
+
+DENSE_ENCODINGS = {"float16", "int8"}
+DENSE_INDEX_FILE_NAME = "dense_index.json"
+
+
+def build_local_dense_index(
+    documents: datasets.Dataset,
+    index_path: str,
+    encoding: str = "float16",
+    batch_size: int = 4096,
+):
+    """
+    Write the normalized `embedding` column of `documents` to a memory-mapped
+    matrix under `index_path`, either as float16 or as int8 with one scale
+    per row, together with the metadata used for filtering
+    """
+    if encoding not in DENSE_ENCODINGS:
+        raise ValueError(f"Invalid encoding: {encoding}")
+
+    os.makedirs(index_path, exist_ok=True)
+    all_embeddings = documents.select_columns(["embedding"]).with_format("numpy")
+    num_docs = len(documents)
+    embedding_dim = len(all_embeddings[0]["embedding"])
+
+    embeddings = np.lib.format.open_memmap(
+        os.path.join(index_path, "embeddings.npy"),
+        mode="w+",
+        dtype=np.float16 if encoding == "float16" else np.int8,
+        shape=(num_docs, embedding_dim),
+    )
+    scales = np.ones(num_docs, dtype=np.float32)
+
+    for st in tqdm(range(0, num_docs, batch_size), desc="Encoding embeddings"):
+        ed = min(st + batch_size, num_docs)
+        batch = np.asarray(all_embeddings[st:ed]["embedding"], dtype=np.float32)
+        batch /= np.maximum(np.linalg.norm(batch, axis=1, keepdims=True), 1e-12)
+        if encoding == "int8":
+            cur_scales = np.maximum(np.abs(batch).max(axis=1), 1e-12) / 127
+            embeddings[st:ed] = np.round(batch / cur_scales[:, None]).astype(np.int8)
+            scales[st:ed] = cur_scales
+        else:
+            embeddings[st:ed] = batch
+    embeddings.flush()
+    np.save(os.path.join(index_path, "scales.npy"), scales)
+
+    with open(os.path.join(index_path, DENSE_INDEX_FILE_NAME), "w") as f:
+        json.dump({"encoding": encoding, "embedding_dim": embedding_dim}, f)
+
+    build_index_metadata(documents, index_path)
+
+
+def parse_knn_request(body: dict):
+    """
+    Extract (query vector, filters, size) from the kNN search bodies built by
+    the vector retrievers: a top-level `knn` section, or a `bool` query with
+    `filter` clauses and at most one `knn` clause in `should`
+    """
+    size = body.get("size", 10)
+    knn = body.get("knn")
+    filters = []
+
+    query = body.get("query")
+    if query is not None:
+        bool_query = query.get("bool")
+        if bool_query is None or len(set(bool_query) - {"filter", "should"}) > 0:
+            raise ValueError(f"Unsupported query for local dense index: {query}")
+        filters = bool_query.get("filter", [])
+        should = bool_query.get("should", [])
+        if len(should) > 1 or (len(should) == 1 and "knn" not in should[0]):
+            raise ValueError(f"Unsupported query for local dense index: {query}")
+        if len(should) == 1:
+            knn = should[0]["knn"]
+
+    if knn is None:
+        return None, filters, size
+    return knn["query_vector"], filters, min(knn.get("k", size), size)
+
+
+class LocalDenseIndex:
+    """
+    Exact cosine kNN over a memory-mapped embedding matrix built by
+    `build_local_dense_index`. Queries are answered in batches with blocked
+    matrix multiplies, scores follow the Elasticsearch cosine convention
+    (1 + cos) / 2.
+    """
+
+    def __init__(
+        self,
+        index_path: str,
+        block_size: int = 32768,
+        query_batch_size: int = 1024,
+        dense_scan_fraction: float = 0.25,
+    ):
+        with open(os.path.join(index_path, DENSE_INDEX_FILE_NAME), "r") as f:
+            config = json.load(f)
+        self.encoding = config["encoding"]
+        self.embeddings = np.load(
+            os.path.join(index_path, "embeddings.npy"), mmap_mode="r"
+        )
+        self.scales = np.load(os.path.join(index_path, "scales.npy"), mmap_mode="r")
+        self.metadata = LocalIndexMetadata(index_path)
+        self.num_docs = len(self.embeddings)
+        self.block_size = block_size
+        self.query_batch_size = query_batch_size
+        # filters keeping more than this fraction of the documents are applied
+        # as masks during a full scan instead of gathering the candidate rows
+        self.dense_scan_fraction = dense_scan_fraction
+
+    def _score_block(self, queries: np.ndarray, doc_index) -> np.ndarray:
+        block = np.asarray(self.embeddings[doc_index], dtype=np.float32)
+        scores = queries @ block.T
+        if self.encoding == "int8":
+            scores *= self.scales[doc_index]
+        return scores
+
+    def search(
+        self,
+        queries: np.ndarray,
+        topk: int,
+        candidates: np.ndarray = None,
+        query_filters: List[List[dict]] = None,
+    ):
+        """
+        Top-k documents of every query among `candidates` (all documents when
+        None). `query_filters` optionally gives the filter clauses of each
+        query, applied block by block on a full scan. Returns (doc indices,
+        scores) per query.
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        queries = queries / np.maximum(
+            np.linalg.norm(queries, axis=1, keepdims=True), 1e-12
+        )
+        num_candidates = self.num_docs if candidates is None else len(candidates)
+        topk = min(topk, num_candidates)
+        if topk <= 0:
+            return [np.zeros(0, dtype=np.int64)] * len(queries), [
+                np.zeros(0, dtype=np.float32)
+            ] * len(queries)
+
+        filter_groups = {}
+        if query_filters is not None and candidates is None:
+            for row, filters in enumerate(query_filters):
+                key = json.dumps(filters, sort_keys=True)
+                filter_groups.setdefault(key, (filters, []))[1].append(row)
+
+        best_scores = np.zeros((len(queries), 0), dtype=np.float32)
+        best_ids = np.zeros((len(queries), 0), dtype=np.int64)
+        for st in range(0, num_candidates, self.block_size):
+            ed = min(st + self.block_size, num_candidates)
+            if candidates is None:
+                doc_index = slice(st, ed)
+                doc_ids = np.arange(st, ed)
+            else:
+                doc_index = doc_ids = candidates[st:ed]
+
+            scores = self._score_block(queries, doc_index)
+            for filters, rows in filter_groups.values():
+                mask = self.metadata.build_mask(filters, doc_index)
+                if mask is not None:
+                    scores[np.ix_(rows, ~mask)] = -np.inf
+
+            all_scores = np.concatenate([best_scores, scores], axis=1)
+            all_ids = np.concatenate(
+                [best_ids, np.broadcast_to(doc_ids, scores.shape)], axis=1
+            )
+            if all_scores.shape[1] > topk:
+                part = np.argpartition(-all_scores, topk - 1, axis=1)[:, :topk]
+                all_scores = np.take_along_axis(all_scores, part, axis=1)
+                all_ids = np.take_along_axis(all_ids, part, axis=1)
+            best_scores, best_ids = all_scores, all_ids
+
+        order = np.argsort(-best_scores, axis=1, kind="stable")
+        best_scores = np.take_along_axis(best_scores, order, axis=1)
+        best_ids = np.take_along_axis(best_ids, order, axis=1)
+
+        all_doc_ids = []
+        all_scores = []
+        for i in range(len(queries)):
+            valid = np.isfinite(best_scores[i])
+            all_doc_ids.append(best_ids[i][valid])
+            all_scores.append((1 + best_scores[i][valid]) / 2)
+        return all_doc_ids, all_scores
+
+    def _search_rows(self, vectors, sizes, rows, results, doc_field_name, **kwargs):
+        for st in range(0, len(rows), self.query_batch_size):
+            cur_rows = rows[st : st + self.query_batch_size]
+            all_doc_ids, all_scores = self.search(
+                [vectors[i] for i in cur_rows],
+                max(sizes[i] for i in cur_rows),
+                **kwargs,
+            )
+            for i, doc_ids, scores in zip(cur_rows, all_doc_ids, all_scores):
+                results[i] = self.metadata.build_hits(
+                    doc_ids[: sizes[i]], scores[: sizes[i]], doc_field_name
+                )
+
+    def search_requests(
+        self, bodies: List[dict], doc_field_name: str = "document"
+    ) -> List[List[dict]]:
+        """
+        Answer Elasticsearch kNN search bodies with Elasticsearch-shaped hit
+        lists, in the same order as `bodies`
+        """
+        all_parsed = [parse_knn_request(body) for body in bodies]
+        vectors = [x[0] for x in all_parsed]
+        sizes = [x[2] for x in all_parsed]
+        results = [None] * len(bodies)
+
+        filter_groups = {}
+        for i, (_, filters, _) in enumerate(all_parsed):
+            key = json.dumps(filters, sort_keys=True)
+            filter_groups.setdefault(key, (filters, []))[1].append(i)
+
+        full_scan_rows = []
+        full_scan_filters = []
+        for filters, rows in tqdm(filter_groups.values(), desc="Filtering"):
+            mask = self.metadata.build_mask(filters)
+            candidates = None if mask is None else np.nonzero(mask)[0]
+
+            vector_rows = []
+            for i in rows:
+                if vectors[i] is not None:
+                    vector_rows.append(i)
+                    continue
+                # a filter-only query matches with a constant score of 0
+                doc_ids = (
+                    np.arange(min(sizes[i], self.num_docs))
+                    if candidates is None
+                    else candidates[: sizes[i]]
+                )
+                results[i] = self.metadata.build_hits(
+                    doc_ids, [0.0] * len(doc_ids), doc_field_name
+                )
+
+            if candidates is None or len(candidates) > self.dense_scan_fraction * (
+                self.num_docs
+            ):
+                full_scan_rows.extend(vector_rows)
+                full_scan_filters.extend([filters] * len(vector_rows))
+            elif len(vector_rows) > 0:
+                self._search_rows(
+                    vectors,
+                    sizes,
+                    vector_rows,
+                    results,
+                    doc_field_name,
+                    candidates=candidates,
+                )
+
+        for st in tqdm(
+            range(0, len(full_scan_rows), self.query_batch_size), desc="Scanning"
+        ):
+            cur_rows = full_scan_rows[st : st + self.query_batch_size]
+            self._search_rows(
+                vectors,
+                sizes,
+                cur_rows,
+                results,
+                doc_field_name,
+                query_filters=full_scan_filters[st : st + self.query_batch_size],
+            )
+        return results
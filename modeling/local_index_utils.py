@@ -0,0 +1,134 @@
+import os
+import json
+import datasets
+import numpy as np
+import pyarrow as pa
+from calendar import timegm
+from datetime import datetime
+from typing import List
+
+INDEX_BACKENDS = {"elasticsearch", "local"}
+METADATA_FILE_NAME = "metadata.json"
+
+
+def build_index_metadata(documents: datasets.Dataset, index_path: str):
+    """
+    Save the filterable columns of `documents` next to a local index:
+    timestamps as epoch seconds and country / user_name as integer codes.
+    The hash and document columns are kept as an Arrow dataset so hits can be
+    materialized like Elasticsearch `_source` fields.
+    """
+    os.makedirs(index_path, exist_ok=True)
+
+    timestamps = documents.with_format("arrow")["timestamp"]
+    units_per_second = {"s": 1, "ms": 10**3, "us": 10**6, "ns": 10**9}
+    np.save(
+        os.path.join(index_path, "timestamps.npy"),
+        timestamps.cast(pa.int64()).to_numpy()
+        // units_per_second[timestamps.type.unit],
+    )
+
+    vocab = {}
+    for field_name in ["country", "user_name"]:
+        values = documents[field_name]
+        field_vocab = sorted({x for x in values if x is not None})
+        code_map = {x: i for i, x in enumerate(field_vocab)}
+        # missing values get -1 and never match a terms filter
+        np.save(
+            os.path.join(index_path, f"{field_name}_codes.npy"),
+            np.asarray([code_map.get(x, -1) for x in values], dtype=np.int32),
+        )
+        vocab[field_name] = field_vocab
+
+    with open(os.path.join(index_path, METADATA_FILE_NAME), "w") as f:
+        json.dump({"num_docs": len(documents), "vocab": vocab}, f)
+
+    documents.select_columns(["hash", "document"]).save_to_disk(
+        os.path.join(index_path, "documents")
+    )
+
+
+def parse_filter_time(time_str: str) -> int:
+    return timegm(datetime.fromisoformat(time_str.rstrip("Z")).timetuple())
+
+
+class LocalIndexMetadata:
+    def __init__(self, index_path: str):
+        with open(os.path.join(index_path, METADATA_FILE_NAME), "r") as f:
+            meta = json.load(f)
+        self.num_docs = meta["num_docs"]
+        self.vocab = {
+            k: {x: i for i, x in enumerate(v)} for k, v in meta["vocab"].items()
+        }
+        self.timestamps = np.load(
+            os.path.join(index_path, "timestamps.npy"), mmap_mode="r"
+        )
+        self.codes = {
+            k: np.load(os.path.join(index_path, f"{k}_codes.npy"), mmap_mode="r")
+            for k in self.vocab
+        }
+        self.documents = datasets.Dataset.load_from_disk(
+            os.path.join(index_path, "documents")
+        )
+
+    def build_mask(
+        self, filters: List[dict], doc_slice: slice = slice(None)
+    ) -> np.ndarray:
+        """
+        Translate the filter clauses emitted by `build_filter` (a timestamp
+        range and terms on country / user_name) to a boolean mask over the
+        documents in `doc_slice`, None when nothing is filtered
+        """
+        mask = None
+        for clause in filters:
+            if "range" in clause:
+                field_name, bounds = next(iter(clause["range"].items()))
+                if field_name != "timestamp":
+                    raise ValueError(f"Unsupported range field: {field_name}")
+                timestamps = self.timestamps[doc_slice]
+                cur_mask = np.ones(len(timestamps), dtype=bool)
+                for op, value in bounds.items():
+                    value = parse_filter_time(value)
+                    if op == "gte":
+                        cur_mask &= timestamps >= value
+                    elif op == "gt":
+                        cur_mask &= timestamps > value
+                    elif op == "lte":
+                        cur_mask &= timestamps <= value
+                    elif op == "lt":
+                        cur_mask &= timestamps < value
+                    else:
+                        raise ValueError(f"Unsupported range operator: {op}")
+            elif "terms" in clause:
+                field_name, values = next(iter(clause["terms"].items()))
+                if field_name not in self.codes:
+                    raise ValueError(f"Unsupported terms field: {field_name}")
+                field_vocab = self.vocab[field_name]
+                value_codes = [field_vocab[x] for x in values if x in field_vocab]
+                cur_mask = np.isin(self.codes[field_name][doc_slice], value_codes)
+            else:
+                raise ValueError(f"Unsupported filter clause: {clause}")
+            mask = cur_mask if mask is None else mask & cur_mask
+        return mask
+
+    def build_hits(
+        self,
+        doc_indices: List[int],
+        scores: List[float],
+        doc_field_name: str = "document",
+    ):
+        """
+        Elasticsearch-shaped hits, so the retrievers can reuse their
+        `build_context_from_hits` helpers
+        """
+        if len(doc_indices) == 0:
+            return []
+        docs = self.documents[[int(x) for x in doc_indices]]
+        return [
+            {
+                "_id": doc_hash,
+                "_score": float(score),
+                "_source": {doc_field_name: doc, "hash": doc_hash},
+            }
+            for doc_hash, doc, score in zip(docs["hash"], docs["document"], scores)
+        ]
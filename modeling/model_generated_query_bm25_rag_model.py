@@ -2,8 +2,18 @@ import os
 import json
 import datasets
 from tqdm import tqdm
-from datetime import datetime
-from elasticsearch import Elasticsearch
+from modeling.rag_model import attach_context
+from modeling.local_index_utils import INDEX_BACKENDS
+from modeling.local_bm25_index import LocalBM25Index
+from utils.elasticsearch_utils import (
+    PARTITION_SCHEMES,
+    build_context_from_hits,
+    build_elasticsearch_client,
+    build_source_filter,
+    get_search_params,
+    route_partitioned_index,
+)
+from utils.async_retrieval_engine import RETRIEVAL_ENGINES, AsyncRetrievalEngine
 from modeling.model_generated_query_rag_model import (
     ModelGeneratedQueryRAGRetriever,
     build_filter,
@@ -12,13 +22,17 @@ from modeling.model_generated_query_rag_model import (
 
 
 def build_single_elasticsearch_request(
-    x, question: str, force_question_query: bool = False, force_no_query: bool = False
+    x,
+    question: str,
+    force_question_query: bool = False,
+    force_no_query: bool = False,
+    doc_field_name: str = "document",
 ):
     try:
         generated_request = json.loads(x)["query"]
     except:
         print(f"Error parsing JSON: {x}")
-        return {"query": {"bool": {}}}
+        return {"query": {"bool": {}}, "_source": build_source_filter(doc_field_name)}
 
     all_filters = build_filter(generated_request)
 
@@ -46,7 +60,8 @@ def build_single_elasticsearch_request(
     query = {
         "query": {
             "bool": bool_value,
-        }
+        },
+        "_source": build_source_filter(doc_field_name),
     }
     return query
 
@@ -60,18 +75,15 @@ def build_context_batch_worker(
     doc_field_name: str,
     force_question_query: bool = False,
     force_no_query: bool = False,
+    partition_by: str = None,
 ):
-    retriever = Elasticsearch(
-        "http://elastic:{}".format(os.environ["ELASTIC_PASSWORD"])
-        + "@{}".format(elasticsearch_host_name),
-        verify_certs=False,
-        ssl_show_warn=False,
-    )
+    retriever = build_elasticsearch_client(elasticsearch_host_name)
 
     all_generated_requests = data_batch["generated_query"]
     all_questions = data_batch["question"]
     context_list = []
     context_id_list = []
+    context_score_list = []
 
     for i in tqdm(
         list(range(len(all_generated_requests))),
@@ -82,27 +94,71 @@ def build_context_batch_worker(
         generated_request = all_generated_requests[i]
         cur_question = all_questions[i]
         generated_request = build_single_elasticsearch_request(
-            generated_request, cur_question, force_question_query, force_no_query
+            generated_request,
+            cur_question,
+            force_question_query,
+            force_no_query,
+            doc_field_name,
         )
         doc_list = retriever.search(
-            index=bm25_index_name,
+            index=route_partitioned_index(
+                bm25_index_name, generated_request, partition_by
+            ),
             body=generated_request,
             size=topk,
+            **get_search_params(partition_by),
         )["hits"]["hits"]
 
-        cur_context_str_list = []
-        cur_context_doc_ids = []
-        for doc in doc_list:
-            cur_doc = doc["_source"][doc_field_name]
-            cur_doc = cur_doc.replace("<|endoftext|>", " ")
-            cur_context_str_list.append(cur_doc)
-            cur_context_doc_ids.append(doc["_source"]["hash"])
+        cur_context_str_list, cur_context_doc_ids, cur_context_scores = (
+            build_context_from_hits(doc_list, doc_field_name)
+        )
+        context_list.append(cur_context_str_list)
+        context_id_list.append(cur_context_doc_ids)
+        context_score_list.append(cur_context_scores)
+
+    data_batch["context"] = context_list
+    data_batch["context_doc_ids"] = context_id_list
+    data_batch["context_scores"] = context_score_list
+    return data_batch
+
+
+def build_context_local_batch_worker(
+    data_batch: datasets.Dataset,
+    local_index_path: str,
+    topk: int,
+    doc_field_name: str,
+    force_question_query: bool = False,
+    force_no_query: bool = False,
+):
+    index = LocalBM25Index(local_index_path)
+    all_requests = []
+    for generated_request, question in zip(
+        data_batch["generated_query"], data_batch["question"]
+    ):
+        body = build_single_elasticsearch_request(
+            generated_request,
+            question,
+            force_question_query,
+            force_no_query,
+            doc_field_name,
+        )
+        body["size"] = topk
+        all_requests.append(body)
 
+    context_list = []
+    context_id_list = []
+    context_score_list = []
+    for doc_list in index.search_requests(all_requests, doc_field_name):
+        cur_context_str_list, cur_context_doc_ids, cur_context_scores = (
+            build_context_from_hits(doc_list, doc_field_name)
+        )
         context_list.append(cur_context_str_list)
         context_id_list.append(cur_context_doc_ids)
+        context_score_list.append(cur_context_scores)
 
     data_batch["context"] = context_list
     data_batch["context_doc_ids"] = context_id_list
+    data_batch["context_scores"] = context_score_list
     return data_batch
 
 
@@ -110,11 +166,16 @@ class ModelGeneratedQueryBM25RAGRetriever(ModelGeneratedQueryRAGRetriever):
     def __init__(
         self,
         topk: int,
-        elasticsearch_index_name: str,
-        elasticsearch_host_name: str,
+        elasticsearch_index_name: str = None,
+        elasticsearch_host_name: str = None,
         doc_field_name: str = "document",
         force_question_query: bool = False,
         force_no_query: bool = False,
+        retrieval_engine: str = "map",
+        max_in_flight: int = 64,
+        partition_by: str = None,
+        index_backend: str = "elasticsearch",
+        local_index_path: str = None,
         **kwargs,
     ):
         super().__init__(**kwargs)
@@ -124,14 +185,93 @@ class ModelGeneratedQueryBM25RAGRetriever(ModelGeneratedQueryRAGRetriever):
         self.doc_field_name = doc_field_name
         self.force_question_query = force_question_query
         self.force_no_query = force_no_query
+        self.retrieval_engine = retrieval_engine
+        self.max_in_flight = max_in_flight
+        self.partition_by = partition_by
+        self.index_backend = index_backend
+        self.local_index_path = local_index_path
 
         if self.force_question_query and self.force_no_query:
             raise ValueError(
                 "force_question_query and force_no_query cannot be both True"
             )
+        if self.index_backend not in INDEX_BACKENDS:
+            raise ValueError(f"Invalid index backend: {self.index_backend}")
+        if self.index_backend == "local" and self.local_index_path is None:
+            raise ValueError("local_index_path is required for the local backend")
+        if self.partition_by is not None and self.partition_by not in PARTITION_SCHEMES:
+            raise ValueError(f"Invalid partition scheme: {self.partition_by}")
+        if self.retrieval_engine not in RETRIEVAL_ENGINES:
+            raise ValueError(f"Invalid retrieval engine: {self.retrieval_engine}")
+
+    def build_context_async(self, full_data: datasets.Dataset) -> datasets.Dataset:
+        engine = AsyncRetrievalEngine(
+            self.elasticsearch_host_name, max_in_flight=self.max_in_flight
+        )
+        request_groups = []
+        for generated_request, question in zip(
+            full_data["generated_query"], full_data["question"]
+        ):
+            body = build_single_elasticsearch_request(
+                generated_request,
+                question,
+                self.force_question_query,
+                self.force_no_query,
+                self.doc_field_name,
+            )
+            body["size"] = self.topk
+            request_groups.append([body])
+        all_results = engine.search(
+            self.elasticsearch_index_name,
+            request_groups,
+            partition_by=self.partition_by,
+        )
+
+        context_list = []
+        context_id_list = []
+        context_score_list = []
+        for (doc_list,) in all_results:
+            cur_context_str_list, cur_context_doc_ids, cur_context_scores = (
+                build_context_from_hits(doc_list, self.doc_field_name)
+            )
+            context_list.append(cur_context_str_list)
+            context_id_list.append(cur_context_doc_ids)
+            context_score_list.append(cur_context_scores)
+        return attach_context(
+            full_data, context_list, context_id_list, context_score_list
+        )
+
+    def build_context_local(self, full_data: datasets.Dataset) -> datasets.Dataset:
+        bs = len(full_data) // os.cpu_count()
+
+        if bs == 0:
+            bs = 1
+
+        if len(full_data) % os.cpu_count() != 0:
+            bs += 1
+
+        return full_data.map(
+            build_context_local_batch_worker,
+            fn_kwargs={
+                "local_index_path": self.local_index_path,
+                "topk": self.topk,
+                "doc_field_name": self.doc_field_name,
+                "force_question_query": self.force_question_query,
+                "force_no_query": self.force_no_query,
+            },
+            batched=True,
+            batch_size=bs,
+            num_proc=os.cpu_count(),
+        )
 
     def build_context(self, full_data: datasets.Dataset) -> str:
 
+        if self.index_backend == "local":
+            return self.build_context_local(full_data)
+
+        if self.retrieval_engine == "async":
+            return self.build_context_async(full_data)
+
         bs = len(full_data) // os.cpu_count()
 
         if bs == 0:
@@ -149,6 +289,7 @@ class ModelGeneratedQueryBM25RAGRetriever(ModelGeneratedQueryRAGRetriever):
                 "doc_field_name": self.doc_field_name,
                 "force_question_query": self.force_question_query,
                 "force_no_query": self.force_no_query,
+                "partition_by": self.partition_by,
             },
             with_rank=True,
             batched=True,
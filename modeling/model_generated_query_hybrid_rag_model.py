@@ -3,15 +3,27 @@ import json
 import datasets
 from tqdm import tqdm
 from typing import List
-
-from datetime import datetime
-from elasticsearch import Elasticsearch
+from modeling.rag_model import attach_context
+from modeling.vector_rag_model import get_embedding_field_name
+from modeling.rank_fusion import FUSION_METHODS, fuse_hit_lists
+from utils.elasticsearch_utils import (
+    PARTITION_SCHEMES,
+    build_context_from_hits,
+    build_elasticsearch_client,
+    build_source_filter,
+    get_search_params,
+    msearch,
+    route_partitioned_index,
+)
+from utils.async_retrieval_engine import RETRIEVAL_ENGINES, AsyncRetrievalEngine
 from modeling.model_generated_query_rag_model import (
     ModelGeneratedQueryRAGRetriever,
     build_filter,
     MAX_QUERY,
 )
 
+HYBRID_REQUEST_MODES = {"separate", "msearch", "combined", "rrf"}
+
 
 def build_single_elasticsearch_hybrid_request_list(
     x: str,
@@ -75,6 +87,139 @@ def build_single_elasticsearch_hybrid_request_list(
     return all_queries
 
 
+def flatten_hybrid_request_list(hybrid_request_list):
+    all_requests = []
+    for bm25_query_body, knn_query_body in hybrid_request_list:
+        all_requests.append(knn_query_body)
+        all_requests.append(bm25_query_body)
+    return all_requests
+
+
+def combine_hybrid_request(
+    bm25_query_body: dict,
+    knn_query_body: dict,
+    topk: int,
+    hybrid_request_mode: str,
+    knn_weight: float = 0.5,
+    bm25_weight: float = 0.5,
+):
+    """
+    Express a (bm25, knn) pair as one request: `combined` puts a top-level
+    `knn` next to the boosted `match` query so Elasticsearch sums both
+    scores, `rrf` uses the rrf retriever
+    """
+    bm25_bool = bm25_query_body["query"]["bool"]
+    knn_should = knn_query_body["query"]["bool"].get("should", [])
+    if len(knn_should) == 0:
+        # no generated query, only the filters are left
+        return bm25_query_body
+
+    knn_part = dict(knn_should[0]["knn"])
+    if "filter" in bm25_bool:
+        knn_part["filter"] = bm25_bool["filter"]
+
+    if hybrid_request_mode == "combined":
+        bool_value = {k: v for k, v in bm25_bool.items() if k != "should"}
+        bool_value["should"] = [
+            {
+                "match": {
+                    field_name: {"query": text, "boost": bm25_weight}
+                    for field_name, text in x["match"].items()
+                }
+            }
+            for x in bm25_bool["should"]
+        ]
+        knn_part["boost"] = knn_weight
+        return {"query": {"bool": bool_value}, "knn": knn_part}
+    elif hybrid_request_mode == "rrf":
+        return {
+            "retriever": {
+                "rrf": {
+                    "retrievers": [
+                        {"standard": {"query": bm25_query_body["query"]}},
+                        {"knn": knn_part},
+                    ],
+                    "rank_window_size": topk,
+                }
+            },
+        }
+    else:
+        raise ValueError(f"Invalid hybrid request mode: {hybrid_request_mode}")
+
+
+def build_hybrid_request_bodies(
+    hybrid_request_list,
+    topk: int,
+    hybrid_request_mode: str = "separate",
+    knn_weight: float = 0.5,
+    bm25_weight: float = 0.5,
+    doc_field_name: str = "document",
+):
+    """
+    `separate` and `msearch` send the sub-query bodies as the baseline did,
+    without `size`, so each returns the Elasticsearch default of 10 hits.
+    The server-side fused `combined` and `rrf` bodies return `topk` hits.
+    """
+    if hybrid_request_mode in {"separate", "msearch"}:
+        all_bodies = flatten_hybrid_request_list(hybrid_request_list)
+    else:
+        all_bodies = [
+            dict(
+                combine_hybrid_request(
+                    bm25_query_body,
+                    knn_query_body,
+                    topk,
+                    hybrid_request_mode,
+                    knn_weight,
+                    bm25_weight,
+                ),
+                size=topk,
+            )
+            for bm25_query_body, knn_query_body in hybrid_request_list
+        ]
+    return [dict(x, _source=build_source_filter(doc_field_name)) for x in all_bodies]
+
+
+def fuse_sub_query_hits(
+    doc_lists: List[List[dict]],
+    topk: int,
+    alpha: float = 0.5,
+    beta: float = 0.5,
+    fusion_method: str = "rrf_mean",
+):
+    """
+    `doc_lists` holds the (knn, bm25) hit lists of each generated query back
+    to back, as produced by `flatten_hybrid_request_list`
+    """
+    return fuse_hit_lists(
+        doc_lists,
+        [i // 2 for i in range(len(doc_lists))],
+        [alpha if i % 2 == 0 else beta for i in range(len(doc_lists))],
+        topk,
+        method=fusion_method,
+    )
+
+
+def fuse_hybrid_hits(
+    doc_lists: List[List[dict]],
+    topk: int,
+    alpha: float = 0.5,
+    beta: float = 0.5,
+    fusion_method: str = "rrf_mean",
+    hybrid_request_mode: str = "separate",
+):
+    if hybrid_request_mode in {"separate", "msearch"}:
+        return fuse_sub_query_hits(doc_lists, topk, alpha, beta, fusion_method)
+    # one server-side fused list per generated query, sum their scores
+    return fuse_hit_lists(
+        doc_lists,
+        list(range(len(doc_lists))),
+        [1.0] * len(doc_lists),
+        topk,
+        method="weighted_sum",
+    )
+
+
 def build_context_batch_worker(
     data_batch: datasets.Dataset,
     rank: int,
@@ -84,28 +229,21 @@ def build_context_batch_worker(
     doc_field_name: str,
     alpha: float = 0.5,
     beta: float = 0.5,
+    fusion_method: str = "rrf_mean",
+    hybrid_request_mode: str = "separate",
+    partition_by: str = None,
 ):
-    retriever = Elasticsearch(
-        "http://elastic:{}".format(os.environ["ELASTIC_PASSWORD"])
-        + "@{}".format(elasticsearch_host_name),
-        verify_certs=False,
-        ssl_show_warn=False,
-    )
+    retriever = build_elasticsearch_client(elasticsearch_host_name)
 
     all_generated_requests = data_batch["generated_query"]
     # all_questions = data_batch["question"]
     context_list = []
     context_id_list = []
+    context_score_list = []
     all_question_embeddings = data_batch["question_embedding"]
     all_embedding_flag = data_batch["query_embedding_success_flag"]
     all_generated_query_embedding = data_batch["query_embeddings"]
-
-    if doc_field_name == "document":
-        embeddding_name = "embedding"
-    elif doc_field_name == "document_summary":
-        embeddding_name = "summary_embedding"
-    else:
-        raise ValueError("doc_field_name should be either document or summary")
+    embeddding_name = get_embedding_field_name(doc_field_name)
 
     for i in tqdm(
         list(range(len(all_generated_requests))),
@@ -123,107 +261,43 @@ def build_context_batch_worker(
             topk,
         )
 
-        hash_to_score = {}
-        hash_to_doc = {}
-
-        for generated_request in generated_request_list:
-
-            bm25_query_body, knn_query_body = generated_request
-
-            # Combine the two queries into a single query
-            knn_res = retriever.search(index=bm25_index_name, body=knn_query_body)[
-                "hits"
-            ]["hits"]
-
-            # Then, search using BM25
-            bm25_res = retriever.search(index=bm25_index_name, body=bm25_query_body)[
-                "hits"
-            ]["hits"]
-            knn_rank_index_score = {}
-            cur_max_score = {}
-            cur_hash_to_doc = {}
-
-            for idx, doc in enumerate(knn_res):
-                cur_knn_score = 1.0 / (idx + 1)
-                if doc["_source"]["hash"] not in cur_max_score:
-                    cur_max_score[doc["_source"]["hash"]] = cur_knn_score
-                    cur_hash_to_doc[doc["_source"]["hash"]] = doc
-                else:
-                    if cur_knn_score > cur_max_score[doc["_source"]["hash"]]:
-                        cur_max_score[doc["_source"]["hash"]] = cur_knn_score
-                        cur_hash_to_doc[doc["_source"]["hash"]] = doc
-
-                if doc["_source"]["hash"] not in knn_rank_index_score:
-                    knn_rank_index_score[doc["_source"]["hash"]] = cur_knn_score
-                else:
-                    knn_rank_index_score[doc["_source"]["hash"]] += cur_knn_score
-
-            bm25_rank_index_score = {}
-            for idx, doc in enumerate(bm25_res):
-                cur_bm25_score = 1.0 / (idx + 1)
-                if doc["_source"]["hash"] not in cur_max_score:
-                    cur_max_score[doc["_source"]["hash"]] = cur_bm25_score
-                    cur_hash_to_doc[doc["_source"]["hash"]] = doc
-                else:
-                    if cur_bm25_score > cur_max_score[doc["_source"]["hash"]]:
-                        cur_max_score[doc["_source"]["hash"]] = cur_bm25_score
-                        cur_hash_to_doc[doc["_source"]["hash"]] = doc
-
-                if doc["_source"]["hash"] not in bm25_rank_index_score:
-                    bm25_rank_index_score[doc["_source"]["hash"]] = cur_bm25_score
-                else:
-                    bm25_rank_index_score[doc["_source"]["hash"]] += cur_bm25_score
-
-            rrf_score = {}
-
-            all_keys = set(
-                list(knn_rank_index_score.keys()) + list(bm25_rank_index_score.keys())
+        all_bodies = build_hybrid_request_bodies(
+            generated_request_list,
+            topk,
+            hybrid_request_mode,
+            alpha,
+            beta,
+            doc_field_name,
+        )
+        if hybrid_request_mode == "msearch":
+            all_doc_lists = msearch(
+                retriever, bm25_index_name, all_bodies, partition_by
             )
-
-            for k in all_keys:
-                if k in knn_rank_index_score and k in bm25_rank_index_score:
-                    rrf_score[k] = (
-                        knn_rank_index_score[k] * alpha
-                        + bm25_rank_index_score[k] * beta
-                    ) / 2
-                elif k in knn_rank_index_score:
-                    rrf_score[k] = knn_rank_index_score[k] * alpha
-                elif k in bm25_rank_index_score:
-                    rrf_score[k] = bm25_rank_index_score[k] * beta
-                else:
-                    rrf_score[k] = 0
-            # sort the results based on the RRF score
-            rrf_score = sorted(rrf_score.items(), key=lambda x: x[1], reverse=True)
-
-            for doc_hash, score in rrf_score:
-                doc = cur_hash_to_doc[doc_hash]
-                doc["_score"] = score
-
-                if doc_hash not in hash_to_doc:
-                    hash_to_doc[doc_hash] = doc
-                    hash_to_score[doc_hash] = score
-                else:
-                    if score > hash_to_score[doc_hash]:
-                        hash_to_doc[doc_hash] = doc
-                    hash_to_score[doc_hash] += score
-
-        doc_list = list(hash_to_doc.values())
-        doc_list.sort(key=lambda x: hash_to_score[x["_source"]["hash"]], reverse=True)
-        doc_list = doc_list[:topk]
-
-        cur_context_doc_ids = []
-        cur_context_str_list = []
-        for doc in doc_list:
-            cur_doc = doc["_source"][doc_field_name]
-            cur_doc = cur_doc.replace("<|endoftext|>", " ")
-            cur_context_str_list.append(cur_doc)
-            cur_context_doc_ids.append(doc["_source"]["hash"])
-
+        else:
+            all_doc_lists = []
+            for generated_request in all_bodies:
+                doc_list = retriever.search(
+                    index=route_partitioned_index(
+                        bm25_index_name, generated_request, partition_by
+                    ),
+                    body=generated_request,
+                    **get_search_params(partition_by),
+                )["hits"]["hits"]
+                all_doc_lists.append(doc_list)
+
+        doc_list = fuse_hybrid_hits(
+            all_doc_lists, topk, alpha, beta, fusion_method, hybrid_request_mode
+        )
+        cur_context_str_list, cur_context_doc_ids, cur_context_scores = (
+            build_context_from_hits(doc_list, doc_field_name)
+        )
         context_list.append(cur_context_str_list)
         context_id_list.append(cur_context_doc_ids)
+        context_score_list.append(cur_context_scores)
 
     data_batch["context"] = context_list
     data_batch["context_doc_ids"] = context_id_list
+    data_batch["context_scores"] = context_score_list
     return data_batch
 
 
@@ -236,6 +310,11 @@ class ModelGeneratedQueryHybridRAGRetriever(ModelGeneratedQueryRAGRetriever):
         doc_field_name: str = "document",
         knn_weight: float = 0.3,
         bm25_weight: float = 0.7,
+        fusion_method: str = "rrf_mean",
+        hybrid_request_mode: str = "separate",
+        retrieval_engine: str = "map",
+        max_in_flight: int = 64,
+        partition_by: str = None,
         **kwargs,
     ):
         super().__init__(**kwargs)
@@ -245,9 +324,84 @@ class ModelGeneratedQueryHybridRAGRetriever(ModelGeneratedQueryRAGRetriever):
         self.doc_field_name = doc_field_name
         self.knn_weight = knn_weight
         self.bm25_weight = bm25_weight
+        self.fusion_method = fusion_method
+        self.hybrid_request_mode = hybrid_request_mode
+        self.retrieval_engine = retrieval_engine
+        self.max_in_flight = max_in_flight
+        self.partition_by = partition_by
+
+        if self.fusion_method not in FUSION_METHODS:
+            raise ValueError(f"Invalid fusion method: {self.fusion_method}")
+        if self.hybrid_request_mode not in HYBRID_REQUEST_MODES:
+            raise ValueError(f"Invalid hybrid request mode: {self.hybrid_request_mode}")
+        if self.partition_by is not None and self.partition_by not in PARTITION_SCHEMES:
+            raise ValueError(f"Invalid partition scheme: {self.partition_by}")
+        if self.retrieval_engine not in RETRIEVAL_ENGINES:
+            raise ValueError(f"Invalid retrieval engine: {self.retrieval_engine}")
+
+    def build_context_async(self, full_data: datasets.Dataset) -> datasets.Dataset:
+        engine = AsyncRetrievalEngine(
+            self.elasticsearch_host_name, max_in_flight=self.max_in_flight
+        )
+        embeddding_name = get_embedding_field_name(self.doc_field_name)
+        all_question_embeddings = full_data["question_embedding"]
+        all_embedding_flag = full_data["query_embedding_success_flag"]
+        all_generated_query_embedding = full_data["query_embeddings"]
+
+        request_groups = []
+        for i, generated_request in enumerate(full_data["generated_query"]):
+            generated_request_list = build_single_elasticsearch_hybrid_request_list(
+                generated_request,
+                all_generated_query_embedding[i],
+                all_embedding_flag[i],
+                all_question_embeddings[i],
+                embeddding_name,
+                self.topk,
+            )
+            request_groups.append(
+                build_hybrid_request_bodies(
+                    generated_request_list,
+                    self.topk,
+                    self.hybrid_request_mode,
+                    self.knn_weight,
+                    self.bm25_weight,
+                    self.doc_field_name,
+                )
+            )
+        all_results = engine.search(
+            self.elasticsearch_index_name,
+            request_groups,
+            group_as_msearch=self.hybrid_request_mode == "msearch",
+            partition_by=self.partition_by,
+        )
+
+        context_list = []
+        context_id_list = []
+        context_score_list = []
+        for all_doc_lists in all_results:
+            doc_list = fuse_hybrid_hits(
+                all_doc_lists,
+                self.topk,
+                self.knn_weight,
+                self.bm25_weight,
+                self.fusion_method,
+                self.hybrid_request_mode,
+            )
+            cur_context_str_list, cur_context_doc_ids, cur_context_scores = (
+                build_context_from_hits(doc_list, self.doc_field_name)
+            )
+            context_list.append(cur_context_str_list)
+            context_id_list.append(cur_context_doc_ids)
+            context_score_list.append(cur_context_scores)
+        return attach_context(
+            full_data, context_list, context_id_list, context_score_list
+        )
 
     def build_context(self, full_data: datasets.Dataset) -> str:
 
+        if self.retrieval_engine == "async":
+            return self.build_context_async(full_data)
+
         bs = len(full_data) // os.cpu_count()
 
         if bs == 0:
@@ -265,6 +419,9 @@ class ModelGeneratedQueryHybridRAGRetriever(ModelGeneratedQueryRAGRetriever):
                 "doc_field_name": self.doc_field_name,
                 "alpha": self.knn_weight,
                 "beta": self.bm25_weight,
+                "fusion_method": self.fusion_method,
+                "hybrid_request_mode": self.hybrid_request_mode,
+                "partition_by": self.partition_by,
             },
             with_rank=True,
             batched=True,
@@ -3,8 +3,19 @@ import json
 import datasets
 from tqdm import tqdm
 from typing import List
-from datetime import datetime
-from elasticsearch import Elasticsearch
+from modeling.rag_model import attach_context
+from modeling.vector_rag_model import get_embedding_field_name
+from modeling.local_index_utils import INDEX_BACKENDS
+from modeling.local_dense_index import LocalDenseIndex
+from utils.elasticsearch_utils import (
+    PARTITION_SCHEMES,
+    build_context_from_hits,
+    build_elasticsearch_client,
+    build_source_filter,
+    get_search_params,
+    route_partitioned_index,
+)
+from utils.async_retrieval_engine import RETRIEVAL_ENGINES, AsyncRetrievalEngine
 from modeling.model_generated_query_rag_model import (
     ModelGeneratedQueryRAGRetriever,
     build_filter,
@@ -68,6 +79,54 @@ def build_single_elasticsearch_dense_request_list(
     return all_queries
 
 
+def merge_sub_query_hits(doc_lists: List[List[dict]], topk: int):
+    hash_to_score = {}
+    hash_to_doc = {}
+
+    for doc_list in doc_lists:
+        for doc in doc_list:
+            doc_hash = doc["_source"]["hash"]
+            if doc_hash not in hash_to_score:
+                hash_to_score[doc_hash] = 0
+                hash_to_doc[doc_hash] = doc
+
+            score = doc["_score"]
+            hash_to_score[doc_hash] += score
+            if score > hash_to_doc[doc_hash]["_score"]:
+                hash_to_doc[doc_hash] = doc
+
+    doc_list = list(hash_to_doc.values())
+    for doc in doc_list:
+        doc["_score"] = hash_to_score[doc["_source"]["hash"]]
+    doc_list.sort(key=lambda x: x["_score"], reverse=True)
+    return doc_list[:topk]
+
+
+def build_sized_request_list(
+    x: str,
+    embeddings: List[List[float]],
+    embedding_flag: List[int],
+    question_embedding: List[float],
+    emebdding_field_name: str,
+    topk: int,
+    force_question_embedding: bool = False,
+    doc_field_name: str = "document",
+):
+    generated_request_list = build_single_elasticsearch_dense_request_list(
+        x,
+        embeddings,
+        embedding_flag,
+        question_embedding,
+        emebdding_field_name,
+        topk,
+        force_question_embedding=force_question_embedding,
+    )
+    for generated_request in generated_request_list:
+        generated_request["size"] = int(topk // len(generated_request_list) * 2)
+        generated_request["_source"] = build_source_filter(doc_field_name)
+    return generated_request_list
+
+
 def build_context_batch_worker(
     data_batch: datasets.Dataset,
     rank: int,
@@ -76,28 +135,19 @@ def build_context_batch_worker(
     topk: int,
     doc_field_name: str,
     force_question_embedding: bool = False,
+    partition_by: str = None,
 ):
-    retriever = Elasticsearch(
-        "http://elastic:{}".format(os.environ["ELASTIC_PASSWORD"])
-        + "@{}".format(elasticsearch_host_name),
-        verify_certs=False,
-        ssl_show_warn=False,
-    )
+    retriever = build_elasticsearch_client(elasticsearch_host_name)
 
     all_generated_requests = data_batch["generated_query"]
     # all_questions = data_batch["question"]
     context_list = []
     context_id_list = []
+    context_score_list = []
     all_question_embeddings = data_batch["question_embedding"]
     all_embedding_flag = data_batch["query_embedding_success_flag"]
     all_generated_query_embedding = data_batch["query_embeddings"]
-
-    if doc_field_name == "document":
-        embeddding_name = "embedding"
-    elif doc_field_name == "document_summary":
-        embeddding_name = "summary_embedding"
-    else:
-        raise ValueError("doc_field_name should be either document or summary")
+    embeddding_name = get_embedding_field_name(doc_field_name)
 
     for i in tqdm(
         list(range(len(all_generated_requests))),
@@ -105,58 +155,39 @@ def build_context_batch_worker(
         position=rank,
         leave=False,
     ):
-        generated_request_raw = all_generated_requests[i]
-        generated_request_list = build_single_elasticsearch_dense_request_list(
-            generated_request_raw,
+        generated_request_list = build_sized_request_list(
+            all_generated_requests[i],
             all_generated_query_embedding[i],
             all_embedding_flag[i],
             all_question_embeddings[i],
             embeddding_name,
             topk,
             force_question_embedding=force_question_embedding,
+            doc_field_name=doc_field_name,
         )
 
-        hash_to_score = {}
-        hash_to_doc = {}
-
+        all_doc_lists = []
         for generated_request in generated_request_list:
-            generated_request["size"] = int(topk // len(generated_request_list) * 2)
-            doc_list = retriever.search(index=bm25_index_name, body=generated_request)[
-                "hits"
-            ]["hits"]
-
-            doc_list = retriever.search(index=bm25_index_name, body=generated_request)[
-                "hits"
-            ]["hits"]
-
-            for doc in doc_list:
-                doc_hash = doc["_source"]["hash"]
-                if doc_hash not in hash_to_score:
-                    hash_to_score[doc_hash] = 0
-                    hash_to_doc[doc_hash] = doc
-
-                score = doc["_score"]
-                hash_to_score[doc_hash] += score
-                if score > hash_to_doc[doc_hash]["_score"]:
-                    hash_to_doc[doc_hash] = doc
-
-        doc_list = list(hash_to_doc.values())
-        doc_list.sort(key=lambda x: hash_to_score[x["_source"]["hash"]], reverse=True)
-        doc_list = doc_list[:topk]
-
-        cur_context_str_list = []
-        cur_context_doc_ids = []
-        for doc in doc_list:
-            cur_doc = doc["_source"][doc_field_name]
-            cur_doc = cur_doc.replace("<|endoftext|>", " ")
-            cur_context_str_list.append(cur_doc)
-            cur_context_doc_ids.append(doc["_source"]["hash"])
-
+            doc_list = retriever.search(
+                index=route_partitioned_index(
+                    bm25_index_name, generated_request, partition_by
+                ),
+                body=generated_request,
+                **get_search_params(partition_by),
+            )["hits"]["hits"]
+            all_doc_lists.append(doc_list)
+
+        doc_list = merge_sub_query_hits(all_doc_lists, topk)
+        cur_context_str_list, cur_context_doc_ids, cur_context_scores = (
+            build_context_from_hits(doc_list, doc_field_name)
+        )
         context_list.append(cur_context_str_list)
         context_id_list.append(cur_context_doc_ids)
+        context_score_list.append(cur_context_scores)
 
     data_batch["context"] = context_list
     data_batch["context_doc_ids"] = context_id_list
+    data_batch["context_scores"] = context_score_list
     return data_batch
 
 
@@ -164,11 +195,16 @@ class ModelGeneratedQueryVectorRAGRetriever(ModelGeneratedQueryRAGRetriever):
     def __init__(
         self,
         topk: int,
-        elasticsearch_index_name: str,
-        elasticsearch_host_name: str,
+        elasticsearch_index_name: str = None,
+        elasticsearch_host_name: str = None,
         doc_field_name: str = "document",
         force_question_query: bool = False,
         force_no_query: bool = False,
+        retrieval_engine: str = "map",
+        max_in_flight: int = 64,
+        partition_by: str = None,
+        index_backend: str = "elasticsearch",
+        local_index_path: str = None,
         **kwargs,
     ):
         super().__init__(**kwargs)
@@ -178,12 +214,95 @@ class ModelGeneratedQueryVectorRAGRetriever(ModelGeneratedQueryRAGRetriever):
         self.doc_field_name = doc_field_name
         self.force_question_query = force_question_query
         self.force_no_query = force_no_query
+        self.retrieval_engine = retrieval_engine
+        self.max_in_flight = max_in_flight
+        self.partition_by = partition_by
+        self.index_backend = index_backend
+        self.local_index_path = local_index_path
 
         if self.force_no_query:
             raise ValueError("force_question_query cannot be both True")
+        if self.index_backend not in INDEX_BACKENDS:
+            raise ValueError(f"Invalid index backend: {self.index_backend}")
+        if self.index_backend == "local" and self.local_index_path is None:
+            raise ValueError("local_index_path is required for the local backend")
+        if self.partition_by is not None and self.partition_by not in PARTITION_SCHEMES:
+            raise ValueError(f"Invalid partition scheme: {self.partition_by}")
+        if self.retrieval_engine not in RETRIEVAL_ENGINES:
+            raise ValueError(f"Invalid retrieval engine: {self.retrieval_engine}")
+
+    def build_request_groups(self, full_data: datasets.Dataset) -> List[List[dict]]:
+        embeddding_name = get_embedding_field_name(self.doc_field_name)
+        all_question_embeddings = full_data["question_embedding"]
+        all_embedding_flag = full_data["query_embedding_success_flag"]
+        all_generated_query_embedding = full_data["query_embeddings"]
+
+        request_groups = []
+        for i, generated_request in enumerate(full_data["generated_query"]):
+            request_groups.append(
+                build_sized_request_list(
+                    generated_request,
+                    all_generated_query_embedding[i],
+                    all_embedding_flag[i],
+                    all_question_embeddings[i],
+                    embeddding_name,
+                    self.topk,
+                    force_question_embedding=self.force_question_query,
+                    doc_field_name=self.doc_field_name,
+                )
+            )
+        return request_groups
+
+    def attach_search_results(
+        self, full_data: datasets.Dataset, all_results: List[List[List[dict]]]
+    ) -> datasets.Dataset:
+        context_list = []
+        context_id_list = []
+        context_score_list = []
+        for all_doc_lists in all_results:
+            doc_list = merge_sub_query_hits(all_doc_lists, self.topk)
+            cur_context_str_list, cur_context_doc_ids, cur_context_scores = (
+                build_context_from_hits(doc_list, self.doc_field_name)
+            )
+            context_list.append(cur_context_str_list)
+            context_id_list.append(cur_context_doc_ids)
+            context_score_list.append(cur_context_scores)
+        return attach_context(
+            full_data, context_list, context_id_list, context_score_list
+        )
+
+    def build_context_local(self, full_data: datasets.Dataset) -> datasets.Dataset:
+        request_groups = self.build_request_groups(full_data)
+        index = LocalDenseIndex(self.local_index_path)
+        all_doc_lists = index.search_requests(
+            [x for group in request_groups for x in group], self.doc_field_name
+        )
+        all_results = []
+        st = 0
+        for group in request_groups:
+            all_results.append(all_doc_lists[st : st + len(group)])
+            st += len(group)
+        return self.attach_search_results(full_data, all_results)
+
+    def build_context_async(self, full_data: datasets.Dataset) -> datasets.Dataset:
+        engine = AsyncRetrievalEngine(
+            self.elasticsearch_host_name, max_in_flight=self.max_in_flight
+        )
+        all_results = engine.search(
+            self.elasticsearch_index_name,
+            self.build_request_groups(full_data),
+            partition_by=self.partition_by,
+        )
+        return self.attach_search_results(full_data, all_results)
 
     def build_context(self, full_data: datasets.Dataset) -> str:
 
+        if self.index_backend == "local":
+            return self.build_context_local(full_data)
+
+        if self.retrieval_engine == "async":
+            return self.build_context_async(full_data)
+
         bs = len(full_data) // os.cpu_count()
 
         if bs == 0:
@@ -200,6 +319,7 @@ class ModelGeneratedQueryVectorRAGRetriever(ModelGeneratedQueryRAGRetriever):
                 "topk": self.topk,
                 "doc_field_name": self.doc_field_name,
                 "force_question_embedding": self.force_question_query,
+                "partition_by": self.partition_by,
             },
             with_rank=True,
             batched=True,
@@ -1,77 +1,182 @@
 import os
 import json
 import random
+import hashlib
 import datasets
 from tqdm import tqdm
-from pymongo import MongoClient
-from datetime import datetime, timedelta
+from typing import List
 from modeling.rag_model import RetrieverBase
+from utils.token_count_cache import TokenCountCache
+from utils.condition_hash_cache import ConditionHashCache
+from utils.mongo_query_utils import get_context_query
+from utils.mongo_client_utils import get_mongo_client, validate_mongo_client_options
 from utils.utils import conversation_pretty_print_v2, summary_with_meta_data, time_decode
 
 
 DB_NAME = "wildchat-aqa-db"
 COLLECTION_NAME = "wildchat"
+SAMPLING_STRATEGIES = {"client_shuffle", "server_hash"}
+FETCH_STRATEGIES = {"single_phase", "two_phase"}
 
-def get_context_query(condition_type, condition_value):
-    query = {}
 
-    if (
-        len(condition_type) > 1
-        and len(set(condition_type)) == 1
-        and condition_type[0] in {"label_level_1", "label_level_2"}
-    ):
-        real_query = {"$match": {"labels": {"$all": condition_value}}}
+def get_context_projection(doc_field_name: str):
+    fields = {"_id": 0, "user_name": 1, "country": 1, "timestamp": 1, "hash": 1}
+    if doc_field_name == "document":
+        fields["conversation"] = 1
+    elif doc_field_name == "document_summary":
+        fields["summary"] = 1
     else:
-        for i in range(len(condition_type)):
-            cur_cond = condition_type[i]
-            cur_value = condition_value[i]
-
-            if cur_cond == "country":
-                query["country"] = [cur_value]
-            elif cur_cond == "language":
-                query["language"] = [cur_value]
-            elif cur_cond in {"label_level_1", "label_level_2"}:
-                if "labels" not in query:
-                    query["labels"] = [cur_value]
-                else:
-                    query["labels"].append(cur_value)
-            elif cur_cond == "user_name":
-
-                if "user_name" not in query:
-                    query["user_name"] = [cur_value]
-                else:
-                    query["user_name"].append(cur_value)
-            elif cur_cond == "time_week":
-                st = datetime.strptime(cur_value, "%Y-%m-%d %H:%M:%S")
-                query["timestamp"] = {
-                    "$gte": st,
-                    "$lt": st + timedelta(days=7),
-                }
-            elif cur_cond == "keywords":
-                if "keywords" not in query:
-                    query["keywords.value"] = [cur_value]
-                else:
-                    query["keywords.value"].append(cur_value)
-            elif cur_cond == "keywords_aggregated":
-                if "keywords_aggregated" not in query:
-                    query["keywords_aggregated.value"] = [cur_value]
-                else:
-                    query["keywords_aggregated.value"].append(cur_value)
-
-        if len(condition_type) > 0:
-
-            conds = []
-
-            for k, v in query.items():
-                if k == "timestamp":
-                    conds.append({k: v})
-                else:
-                    conds.append({k: {"$in": v}})
-
-            real_query = {"$match": {"$and": conds}}
-        else:
-            real_query = {"$match": {}}
-    return real_query
+        raise ValueError("Invalid doc_field_name")
+    return fields
+
+
+def get_context_pipeline(real_query: dict, doc_field_name: str, projection: dict = None):
+    # every match, the sample is drawn by `sample_hashes` on the client
+    if projection is None:
+        projection = get_context_projection(doc_field_name)
+    return [real_query, {"$project": projection}]
+
+
+def render_context_doc(item: dict, doc_field_name: str):
+    if doc_field_name == "document":
+        res = conversation_pretty_print_v2(
+            json.loads(item["conversation"]),
+            item["user_name"],
+            item["country"],
+            time_decode(item["timestamp"]),
+        )
+    elif doc_field_name == "document_summary":
+        res = summary_with_meta_data(
+            item["summary"],
+            item["user_name"],
+            item["country"],
+            time_decode(item["timestamp"]),
+        )
+    else:
+        raise ValueError("Invalid doc_field_name")
+    return res.replace("<|endoftext|>", " ")
+
+
+def fetch_context_two_phase(
+    collection,
+    real_query: dict,
+    doc_field_name: str,
+    topk: int,
+    max_context_token_count: int,
+    tokenize_func: callable,
+    token_count_cache: TokenCountCache = None,
+    sampling_strategy: str = "client_shuffle",
+    sampling_seed: int = 0,
+    fetch_batch_size: int = 100,
+):
+    """
+    Sample the hashes of the matches first, which the compound indexes
+    ending in `hash` can cover, then fetch only the bodies that fit in
+    `max_context_token_count`
+    """
+    all_hashes = [
+        x["hash"]
+        for x in collection.aggregate(
+            get_context_pipeline(
+                real_query, doc_field_name, projection={"_id": 0, "hash": 1}
+            )
+        )
+    ]
+    return fetch_context_by_hashes(
+        collection,
+        sample_hashes(all_hashes, topk, sampling_strategy, sampling_seed),
+        doc_field_name,
+        max_context_token_count,
+        tokenize_func,
+        token_count_cache,
+        fetch_batch_size,
+    )
+
+
+def sample_hashes(
+    all_hashes: List[str],
+    topk: int,
+    sampling_strategy: str = "client_shuffle",
+    sampling_seed: int = 0,
+):
+    """
+    Sample `topk` of the matching hashes. The hashes are sorted first, so the
+    sample is the same whether they come from the aggregation or from a
+    ConditionHashCache. `server_hash` orders them by a seeded blake2b of the
+    hash, the sample is the same for a given seed.
+    """
+    all_hashes = sorted(all_hashes)
+    if sampling_strategy == "client_shuffle":
+        random.shuffle(all_hashes)
+    else:
+        all_hashes.sort(
+            key=lambda x: hashlib.blake2b(
+                "{}{}".format(x, sampling_seed).encode("utf-8"), digest_size=8
+            ).digest()
+        )
+    return all_hashes[:topk]
+
+
+def fetch_context_by_hashes(
+    collection,
+    all_hashes: List[str],
+    doc_field_name: str,
+    max_context_token_count: int = None,
+    tokenize_func: callable = None,
+    token_count_cache: TokenCountCache = None,
+    fetch_batch_size: int = 100,
+):
+    """
+    Fetch and render the documents of `all_hashes` in order with batched
+    `$in` lookups. With `max_context_token_count`, cached token counts plan
+    each lookup so that documents past the budget are not fetched, documents
+    without a cached count are fetched at most `fetch_batch_size` at a time.
+    """
+    if max_context_token_count is None:
+        max_context_token_count = float("inf")
+        cached_counts = [0] * len(all_hashes)
+    elif token_count_cache is not None:
+        cached_counts = token_count_cache.lookup(all_hashes).tolist()
+    else:
+        cached_counts = [-1] * len(all_hashes)
+
+    context_str_list = []
+    context_doc_ids = []
+    token_count = 0
+    st = 0
+    while st < len(all_hashes):
+        planned_token_count = token_count
+        ed = st
+        while ed < len(all_hashes) and ed - st < fetch_batch_size:
+            if cached_counts[ed] >= 0:
+                if planned_token_count + cached_counts[ed] >= max_context_token_count:
+                    break
+                planned_token_count += cached_counts[ed]
+            ed += 1
+        if ed == st:
+            break
+
+        docs = {
+            x["hash"]: x
+            for x in collection.find(
+                {"hash": {"$in": all_hashes[st:ed]}},
+                get_context_projection(doc_field_name),
+            )
+        }
+        for i in range(st, ed):
+            if all_hashes[i] not in docs:
+                continue
+            cur_doc = render_context_doc(docs[all_hashes[i]], doc_field_name)
+            cur_token_count = cached_counts[i]
+            if cur_token_count < 0:
+                cur_token_count = len(tokenize_func(cur_doc))
+            if token_count + cur_token_count >= max_context_token_count:
+                return context_str_list, context_doc_ids
+            token_count += cur_token_count
+            context_str_list.append(cur_doc)
+            context_doc_ids.append(all_hashes[i])
+        st = ed
+    return context_str_list, context_doc_ids
 
 
 def mongo_db_build_context_worker(
@@ -80,9 +185,26 @@ def mongo_db_build_context_worker(
     mongodb_host_name: str,
     doc_field_name: str,
     topk: int,
+    sampling_strategy: str = "client_shuffle",
+    sampling_seed: int = 0,
+    fetch_strategy: str = "single_phase",
+    fetch_batch_size: int = 100,
+    max_context_token_count: int = 1048576,
+    tokenize_func: callable = None,
+    token_count_cache: TokenCountCache = None,
+    condition_cache: ConditionHashCache = None,
+    mongodb_max_pool_size: int = None,
+    mongodb_compressors: str = None,
+    mongodb_read_preference: str = None,
 ):
 
-    retriever = MongoClient(mongodb_host_name)
+    retriever = get_mongo_client(
+        mongodb_host_name,
+        mongodb_max_pool_size,
+        mongodb_compressors,
+        mongodb_read_preference,
+    )
+    collection = retriever[DB_NAME][COLLECTION_NAME]
     all_conditions = data_batch["condition_type"]
     all_values = data_batch["condition_value"]
     all_contexts = []
@@ -100,46 +222,53 @@ def mongo_db_build_context_worker(
         real_query = get_context_query(condition_type, condition_value)
 
         # query mongodb
-        db = retriever[DB_NAME]
-        collection = db[COLLECTION_NAME]
-        db_result = collection.aggregate([real_query])
-        result = []
-
-        for item in db_result:
-            result.append(
-                {
-                    "conversation": item["conversation"],
-                    "summary": item["summary"],
-                    "user_name": item["user_name"],
-                    "country": item["country"],
-                    "timestamp": time_decode(item["timestamp"]),
-                    "hash": item["hash"],
-                }
+        if condition_cache is not None:
+            cached_hashes = condition_cache.lookup(condition_type, condition_value)
+        else:
+            cached_hashes = None
+
+        if cached_hashes is not None:
+            context_str_list, cur_doc_id_list = fetch_context_by_hashes(
+                collection,
+                sample_hashes(cached_hashes, topk, sampling_strategy, sampling_seed),
+                doc_field_name,
+                max_context_token_count if fetch_strategy == "two_phase" else None,
+                tokenize_func,
+                token_count_cache,
+                fetch_batch_size,
+            )
+            all_contexts.append(context_str_list)
+            context_id_list.append(cur_doc_id_list)
+            continue
+
+        if fetch_strategy == "two_phase" or sampling_strategy == "server_hash":
+            # the seeded sample is drawn from the hashes, bodies come after
+            context_str_list, cur_doc_id_list = fetch_context_two_phase(
+                collection,
+                real_query,
+                doc_field_name,
+                topk,
+                max_context_token_count if fetch_strategy == "two_phase" else None,
+                tokenize_func,
+                token_count_cache,
+                sampling_strategy,
+                sampling_seed,
+                fetch_batch_size,
             )
+            all_contexts.append(context_str_list)
+            context_id_list.append(cur_doc_id_list)
+            continue
+
+        db_result = collection.aggregate(get_context_pipeline(real_query, doc_field_name))
+        # sorted like `sample_hashes` before the shuffle
+        result = sorted(db_result, key=lambda x: x["hash"])
 
         random.shuffle(result)
         context_str_list = []
         cur_doc_id_list = []
 
-        for idx, item in enumerate(result[:topk]):
-            if doc_field_name == "document":
-                res = conversation_pretty_print_v2(
-                    json.loads(item["conversation"]),
-                    item["user_name"],
-                    item["country"],
-                    item["timestamp"],
-                )
-            elif doc_field_name == "document_summary":
-                res = summary_with_meta_data(
-                    item["summary"],
-                    item["user_name"],
-                    item["country"],
-                    item["timestamp"],
-                )
-            else:
-                raise ValueError("Invalid doc_field_name")
-
-            res = res.replace("<|endoftext|>", " ")
+        for item in result[:topk]:
+            res = render_context_doc(item, doc_field_name)
             cur_doc_id_list.append(item["hash"])
             context_str_list.append(res)
 
@@ -152,17 +281,69 @@ def mongo_db_build_context_worker(
 
 
 class MongoDBRetriever(RetrieverBase):
+    doc_source = "mongodb"
+
     def __init__(
         self,
         mongodb_host_name: str,
         topk: int = 1048576,
         doc_field_name: str = "document",
+        sampling_strategy: str = "client_shuffle",
+        sampling_seed: int = 0,
+        fetch_strategy: str = "single_phase",
+        fetch_batch_size: int = 100,
+        condition_cache_path: str = None,
+        mongodb_max_pool_size: int = None,
+        mongodb_compressors: str = None,
+        mongodb_read_preference: str = None,
         **kwargs
     ):
         super().__init__(**kwargs)
         self.mongodb_host_name = mongodb_host_name
         self.doc_field_name = doc_field_name
         self.topk = topk
+        self.sampling_strategy = sampling_strategy
+        self.sampling_seed = sampling_seed
+        # two_phase fetches only the bodies that fit in max_context_token_count
+        self.fetch_strategy = fetch_strategy
+        self.fetch_batch_size = fetch_batch_size
+        # written by build_condition_hash_cache.py
+        self.condition_cache_path = condition_cache_path
+        # shared by all batches of a worker process, see get_mongo_client
+        self.mongodb_max_pool_size = mongodb_max_pool_size
+        self.mongodb_compressors = mongodb_compressors
+        self.mongodb_read_preference = mongodb_read_preference
+
+        if self.sampling_strategy not in SAMPLING_STRATEGIES:
+            raise ValueError(f"Invalid sampling strategy: {self.sampling_strategy}")
+        if self.fetch_strategy not in FETCH_STRATEGIES:
+            raise ValueError(f"Invalid fetch strategy: {self.fetch_strategy}")
+        validate_mongo_client_options(
+            self.mongodb_compressors, self.mongodb_read_preference
+        )
+
+    def build_condition_cache(self) -> ConditionHashCache:
+        if self.condition_cache_path is None:
+            return None
+        condition_cache = ConditionHashCache(self.condition_cache_path)
+        collection = get_mongo_client(
+            self.mongodb_host_name,
+            self.mongodb_max_pool_size,
+            self.mongodb_compressors,
+            self.mongodb_read_preference,
+        )[DB_NAME][COLLECTION_NAME]
+        num_documents = collection.estimated_document_count()
+        if condition_cache.meta["num_documents"] != num_documents:
+            print(
+                "Condition cache {} was built for {} documents, the collection "
+                "has {}, not using it".format(
+                    self.condition_cache_path,
+                    condition_cache.meta["num_documents"],
+                    num_documents,
+                )
+            )
+            return None
+        return condition_cache
 
     def build_context(self, full_data: datasets.Dataset):
         bs = len(full_data) // os.cpu_count()
@@ -179,6 +360,17 @@ class MongoDBRetriever(RetrieverBase):
                 "mongodb_host_name": self.mongodb_host_name,
                 "doc_field_name": self.doc_field_name,
                 "topk": self.topk,
+                "sampling_strategy": self.sampling_strategy,
+                "sampling_seed": self.sampling_seed,
+                "fetch_strategy": self.fetch_strategy,
+                "fetch_batch_size": self.fetch_batch_size,
+                "max_context_token_count": self.max_context_token_count,
+                "tokenize_func": self.tokenize_func,
+                "token_count_cache": self.build_token_count_cache(),
+                "condition_cache": self.build_condition_cache(),
+                "mongodb_max_pool_size": self.mongodb_max_pool_size,
+                "mongodb_compressors": self.mongodb_compressors,
+                "mongodb_read_preference": self.mongodb_read_preference,
             },
             batched=True,
             with_rank=True,
@@ -48,9 +48,13 @@ class OpenAIBatchRequestModel(BatchInferenceModel):
             cur_fd = open(cur_file_path, "w")
             all_file_fds.append(cur_fd)
 
+        # the prompt builder already counted the tokens, reuse them for TPM
+        token_counts = {}
         for i, prompt in enumerate(tqdm(prompts, desc="Writing to files")):
             cur_fd = all_file_fds[i % num_file]
             msg = [{"role": "user", "content": prompt["prompt"]}]
+            if "token_count_prompt" in prompt:
+                token_counts[prompt["custom_id"]] = prompt["token_count_prompt"]
 
             d = {
                 "custom_id": prompt["custom_id"],
@@ -73,6 +77,7 @@ class OpenAIBatchRequestModel(BatchInferenceModel):
             os.environ["OPENAI_API_KEY"],
             rpm_limit=self.rpm_limit,
             tpm_limit=self.tpm_limit,
+            token_counts=token_counts,
         )
 
         if self.request_mode == "online":
@@ -2,8 +2,40 @@ import os
 import json
 import logging
 import datasets
-from typing import Tuple
+from bisect import bisect_left
+from itertools import accumulate
+from typing import List, Tuple
 from modeling.batch_inference_model import BatchInferenceModel
+from utils.token_count_cache import TOKEN_COUNT_CACHE_ROOT, TokenCountCache
+
+
+def count_context_tokens(
+    data_batch, tokenize_func: callable, token_count_cache: TokenCountCache = None
+):
+    # documents shared by several questions of the batch are tokenized once
+    doc_token_counts = {}
+    all_token_counts = []
+    all_context_doc_ids = data_batch.get("context_doc_ids")
+
+    if token_count_cache is not None and all_context_doc_ids is not None:
+        all_doc_ids = list({x for doc_ids in all_context_doc_ids for x in doc_ids})
+        cached_counts = token_count_cache.lookup(all_doc_ids).tolist()
+        for doc_id, count in zip(all_doc_ids, cached_counts):
+            if count >= 0:
+                doc_token_counts[doc_id] = count
+
+    for i, cur_context_list in enumerate(data_batch["context"]):
+        cur_token_counts = []
+        for j, cur_doc in enumerate(cur_context_list):
+            if all_context_doc_ids is not None:
+                doc_key = all_context_doc_ids[i][j]
+            else:
+                doc_key = cur_doc
+            if doc_key not in doc_token_counts:
+                doc_token_counts[doc_key] = len(tokenize_func(cur_doc))
+            cur_token_counts.append(doc_token_counts[doc_key])
+        all_token_counts.append(cur_token_counts)
+    return {"context_token_counts": all_token_counts}
 
 
 def build_single_prompt(
@@ -12,15 +44,24 @@ def build_single_prompt(
     tokenize_func: callable,
     max_token_count: int,
     topk: int,
+    placeholder_token_count: int = None,
 ):
     cur_question = data_sample["question"]
     cur_options = data_sample["options"]
 
     if "context" in data_sample:
-        cur_context_list = data_sample["context"]
+        cur_context_list = data_sample["context"][:topk]
     else:
         cur_context_list = []
 
+    if "context_token_counts" in data_sample:
+        cur_token_counts = data_sample["context_token_counts"][:topk]
+    else:
+        cur_token_counts = [len(tokenize_func(x)) for x in cur_context_list]
+
+    if placeholder_token_count is None:
+        placeholder_token_count = len(tokenize_func("{{conversations}}"))
+
     cur_options_string = ""
     for j, option in enumerate(cur_options):
         cur_options_string += f"{j}. {option}\n"
@@ -28,20 +69,18 @@ def build_single_prompt(
 
     prompt1 = prompt_template.replace("{{question}}", cur_question_string)
 
-    cur_context = ""
-    token_count = len(tokenize_func(prompt1)) - len(tokenize_func("{{conversations}}"))
-    for i in range(min(len(cur_context_list), topk)):
-        cur_doc_token = len(tokenize_func(cur_context_list[i]))
-        if token_count + cur_doc_token >= max_token_count:
-            print("Failed to reach topk {} with max token count".format(topk))
-            break
-        cur_context += cur_context_list[i] + "\n\n"
-        token_count += cur_doc_token
-
-    if cur_context is not None:
-        prompt2 = prompt1.replace("{{conversations}}", cur_context)
-    else:
-        prompt2 = prompt1
+    token_count = len(tokenize_func(prompt1)) - placeholder_token_count
+
+    # keep the longest prefix of documents that stays under max_token_count
+    cumulative_token_counts = list(accumulate(cur_token_counts))
+    num_docs = bisect_left(cumulative_token_counts, max_token_count - token_count)
+    if num_docs < len(cur_context_list):
+        print("Failed to reach topk {} with max token count".format(topk))
+    if num_docs > 0:
+        token_count += cumulative_token_counts[num_docs - 1]
+
+    cur_context = "".join(x + "\n\n" for x in cur_context_list[:num_docs])
+    prompt2 = prompt1.replace("{{conversations}}", cur_context)
 
     return {
         "custom_id": data_sample["hash"],
@@ -50,7 +89,23 @@ def build_single_prompt(
     }
 
 
+def attach_context(
+    data: datasets.Dataset,
+    context_list: List[List[str]],
+    context_id_list: List[List[str]],
+    context_score_list: List[List[float]] = None,
+) -> datasets.Dataset:
+    data = data.add_column("context", context_list)
+    data = data.add_column("context_doc_ids", context_id_list)
+    if context_score_list is not None:
+        data = data.add_column("context_scores", context_score_list)
+    return data
+
+
 class RetrieverBase:
+    # where the context documents come from, part of the token count cache key
+    doc_source = "elasticsearch"
+
     def __init__(
         self,
         rag_type: str,
@@ -62,6 +117,9 @@ class RetrieverBase:
         save_context: bool = False,
         data_parallel: int = 1,
         data_parallel_rank: int = 0,
+        topk_sweep: List[int] = None,
+        tokenizer_name: str = None,
+        token_count_cache_root: str = TOKEN_COUNT_CACHE_ROOT,
     ):
         self.rag_type = rag_type
         with open(prompt_template_path, "r") as f:
@@ -80,6 +138,19 @@ class RetrieverBase:
         self.save_context = save_context
         self.data_parallel = data_parallel
         self.data_parallel_rank = data_parallel_rank
+        self.topk_sweep = sorted(set(topk_sweep)) if topk_sweep else []
+        self.tokenizer_name = tokenizer_name
+        self.token_count_cache_root = token_count_cache_root
+
+    def build_token_count_cache(self) -> TokenCountCache:
+        if self.tokenizer_name is None or not self.token_count_cache_root:
+            return None
+        namespace = "{}_{}".format(
+            self.doc_source, getattr(self, "doc_field_name", "document")
+        )
+        return TokenCountCache(
+            self.tokenizer_name, namespace, cache_root=self.token_count_cache_root
+        )
 
     def build_context(self, data: datasets.Dataset) -> str:
         raise NotImplementedError()
@@ -101,25 +172,110 @@ class RAGModel:
         self.logging_path = logging_path
         self.retrieve_context_path = retrieve_context_path
 
-    def build_prompt(self, dataset_with_context: datasets.Dataset) -> Tuple[str, int]:
+    def build_prompt(
+        self, dataset_with_context: datasets.Dataset, topk: int = None
+    ) -> Tuple[str, int]:
         return dataset_with_context.map(
             build_single_prompt,
             fn_kwargs={
                 "prompt_template": self.retriever.prompt_template,
                 "tokenize_func": self.retriever.tokenize_func,
                 "max_token_count": self.retriever.max_context_token_count,
-                "topk": self.retriever.topk,
+                "topk": self.retriever.topk if topk is None else topk,
+                "placeholder_token_count": len(
+                    self.retriever.tokenize_func("{{conversations}}")
+                ),
             },
             remove_columns=dataset_with_context.column_names,
             num_proc=min(os.cpu_count(), 8),
             desc="Building prompts",
         )
 
+    def add_context_token_counts(
+        self, dataset_with_context: datasets.Dataset
+    ) -> datasets.Dataset:
+        if (
+            "context" not in dataset_with_context.column_names
+            or "context_token_counts" in dataset_with_context.column_names
+        ):
+            return dataset_with_context
+
+        token_count_cache = self.retriever.build_token_count_cache()
+        dataset_with_context = dataset_with_context.map(
+            count_context_tokens,
+            fn_kwargs={
+                "tokenize_func": self.retriever.tokenize_func,
+                "token_count_cache": token_count_cache,
+            },
+            batched=True,
+            num_proc=min(os.cpu_count(), 8),
+            desc="Counting context tokens",
+        )
+
+        if token_count_cache is not None:
+            # workers only read the cache, new counts are written from here
+            for batch in dataset_with_context.select_columns(
+                ["context_doc_ids", "context_token_counts"]
+            ).iter(batch_size=1000):
+                for doc_ids, counts in zip(
+                    batch["context_doc_ids"], batch["context_token_counts"]
+                ):
+                    token_count_cache.add(dict(zip(doc_ids, counts)))
+            num_added = token_count_cache.flush()
+            self.logger.info(
+                f"Added {num_added} documents to token count cache {token_count_cache.cache_path}"
+            )
+
+        return dataset_with_context
+
+    def build_and_save_prompts(
+        self,
+        dataset_with_context: datasets.Dataset,
+        topk: int,
+        output_path: str,
+        save_request: bool,
+    ):
+        prompts = self.build_prompt(dataset_with_context, topk)
+        total_token_count_prompt = sum(prompts["token_count_prompt"])
+
+        self.logger.info(
+            f"Total token count for prompts with top {topk}: {total_token_count_prompt}"
+        )
+
+        if save_request:
+            os.makedirs(output_path, exist_ok=True)
+            p = f"{output_path}/request.json"
+            self.logger.info(f"Writing prompts to file {p}")
+            with open(p, "w") as f:
+                for prompt in prompts:
+                    f.write(json.dumps(prompt) + "\n")
+
+            if self.retriever.rag_type != "none":
+                with open(f"{output_path}/retrieved_doc_ids.json", "w") as f:
+                    for i in range(len(prompts)):
+                        f.write(
+                            json.dumps(
+                                {
+                                    "hash": dataset_with_context[i]["hash"],
+                                    "context_doc_ids": dataset_with_context[i][
+                                        "context_doc_ids"
+                                    ][:topk],
+                                }
+                            )
+                            + "\n"
+                        )
+
+        return prompts
+
     def run_context_build(self, build_prompt: bool = True):
 
         if self.retriever is None:
             raise ValueError("No retriever found")
 
+        if self.retriever.topk_sweep:
+            # retrieve once at the largest k, every smaller k is a prefix of it
+            self.retriever.topk = self.retriever.topk_sweep[-1]
+
         if os.path.exists(self.retrieve_context_path):
             self.logger.info(f"Loading context from {self.retrieve_context_path}")
             dataset_with_context = datasets.Dataset.load_from_disk(
@@ -155,34 +311,28 @@ class RAGModel:
         if not build_prompt:
             return []
 
-        prompts = self.build_prompt(dataset_with_context)
-        total_token_count_prompt = sum(prompts["token_count_prompt"])
-
-        self.logger.info(f"Total token count for prompts: {total_token_count_prompt}")
-
-        if self.retriever.save_request:
-            p = f"{self.logging_path}/request.json"
-            self.logger.info(f"Writing prompts to file {p}")
-            with open(p, "w") as f:
-                for prompt in prompts:
-                    f.write(json.dumps(prompt) + "\n")
-
-            if self.retriever.rag_type != "none":
-                with open(f"{self.logging_path}/retrieved_doc_ids.json", "w") as f:
-                    for i in range(len(prompts)):
-                        f.write(
-                            json.dumps(
-                                {
-                                    "hash": dataset_with_context[i]["hash"],
-                                    "context_doc_ids": dataset_with_context[i][
-                                        "context_doc_ids"
-                                    ],
-                                }
-                            )
-                            + "\n"
-                        )
-
-        return prompts
+        # token counts depend on the model tokenizer, they live in the token
+        # count cache instead of the retrieval cache
+        dataset_with_context = self.add_context_token_counts(dataset_with_context)
+
+        if self.retriever.topk_sweep:
+            # one request file per k under {logging_path}/top_{k}
+            return {
+                k: self.build_and_save_prompts(
+                    dataset_with_context,
+                    k,
+                    os.path.join(self.logging_path, f"top_{k}"),
+                    save_request=True,
+                )
+                for k in self.retriever.topk_sweep
+            }
+
+        return self.build_and_save_prompts(
+            dataset_with_context,
+            self.retriever.topk,
+            self.logging_path,
+            save_request=self.retriever.save_request,
+        )
 
     def run_get_responses(self, prompts):
         if self.model is None:
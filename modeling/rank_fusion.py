@@ -0,0 +1,105 @@
+import numpy as np
+from typing import List
+
+FUSION_METHODS = {"rrf", "rrf_mean", "max", "weighted_sum"}
+
+
+def fuse_rank_lists(
+    doc_ids: List[List[str]],
+    list_query_ids: List[int],
+    list_weights: List[float],
+    method: str = "rrf",
+    rank_constant: int = 0,
+    scores: List[List[float]] = None,
+):
+    """
+    Fuse ranked result lists in one pass over their concatenation.
+
+    `doc_ids[i]` is the ranked list i, produced by sub-query
+    `list_query_ids[i]` and weighted by `list_weights[i]`. Each entry
+    contributes `weight / (rank_constant + rank + 1)`, or `weight * score`
+    for `weighted_sum`. Methods:
+      - rrf: sum of the contributions
+      - rrf_mean: per sub-query, mean of the contributions over the lists
+        that contain the document, then summed over sub-queries
+      - max: largest contribution
+      - weighted_sum: sum of the weighted raw scores
+
+    Returns (fused doc ids, fused scores, index of the first occurrence of
+    each doc in the concatenated lists), sorted by decreasing score with ties
+    kept in order of first occurrence.
+    """
+    if method not in FUSION_METHODS:
+        raise ValueError(f"Invalid fusion method: {method}")
+    if method == "weighted_sum" and scores is None:
+        raise ValueError("weighted_sum fusion requires the raw scores")
+
+    list_lengths = np.asarray([len(x) for x in doc_ids], dtype=np.int64)
+    if list_lengths.sum() == 0:
+        return [], np.zeros(0), np.zeros(0, dtype=np.int64)
+
+    all_doc_ids = np.asarray([x for ids in doc_ids for x in ids])
+    list_index = np.repeat(np.arange(len(doc_ids)), list_lengths)
+    ranks = np.arange(len(all_doc_ids)) - np.repeat(
+        np.cumsum(list_lengths) - list_lengths, list_lengths
+    )
+    weights = np.asarray(list_weights, dtype=np.float64)[list_index]
+
+    if method == "weighted_sum":
+        contributions = weights * np.asarray(
+            [x for s in scores for x in s], dtype=np.float64
+        )
+    else:
+        contributions = weights / (rank_constant + ranks + 1)
+
+    unique_ids, first_index, inverse = np.unique(
+        all_doc_ids, return_index=True, return_inverse=True
+    )
+    num_docs = len(unique_ids)
+
+    if method == "max":
+        fused = np.full(num_docs, -np.inf)
+        np.maximum.at(fused, inverse, contributions)
+    elif method == "rrf_mean":
+        query_ids = np.asarray(list_query_ids, dtype=np.int64)[list_index]
+        pairs, pair_inverse = np.unique(
+            query_ids * num_docs + inverse, return_inverse=True
+        )
+        pair_sum = np.bincount(pair_inverse, weights=contributions)
+        pair_count = np.bincount(pair_inverse)
+        fused = np.bincount(
+            pairs % num_docs, weights=pair_sum / pair_count, minlength=num_docs
+        )
+    else:
+        fused = np.bincount(inverse, weights=contributions, minlength=num_docs)
+
+    order = np.lexsort((first_index, -fused))
+    return unique_ids[order].tolist(), fused[order], first_index[order]
+
+
+def fuse_hit_lists(
+    hit_lists: List[List[dict]],
+    list_query_ids: List[int],
+    list_weights: List[float],
+    topk: int,
+    method: str = "rrf",
+    rank_constant: int = 0,
+) -> List[dict]:
+    """
+    `fuse_rank_lists` over Elasticsearch-shaped hit lists keyed by
+    `_source.hash`, returns the top `topk` hits with `_score` set to the
+    fused score
+    """
+    all_hits = [hit for hits in hit_lists for hit in hits]
+    _, fused_scores, first_index = fuse_rank_lists(
+        [[hit["_source"]["hash"] for hit in hits] for hits in hit_lists],
+        list_query_ids,
+        list_weights,
+        method=method,
+        rank_constant=rank_constant,
+        scores=[[hit["_score"] for hit in hits] for hits in hit_lists],
+    )
+    return [
+        dict(all_hits[idx], _score=float(score))
+        for idx, score in zip(first_index[:topk], fused_scores[:topk])
+    ]
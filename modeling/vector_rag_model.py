@@ -1,8 +1,45 @@
 import os
 import datasets
 from tqdm import tqdm
-from elasticsearch import Elasticsearch
-from modeling.rag_model import RetrieverBase
+from typing import List
+from modeling.rag_model import RetrieverBase, attach_context
+from modeling.local_index_utils import INDEX_BACKENDS
+from modeling.local_dense_index import LocalDenseIndex
+from utils.async_retrieval_engine import RETRIEVAL_ENGINES, AsyncRetrievalEngine
+from utils.elasticsearch_utils import (
+    SEARCH_MODES,
+    build_context_from_hits,
+    build_elasticsearch_client,
+    build_source_filter,
+    msearch_in_batches,
+)
+
+
+def get_embedding_field_name(doc_field_name: str):
+    if doc_field_name == "document":
+        return "embedding"
+    elif doc_field_name == "document_summary":
+        return "summary_embedding"
+    else:
+        raise ValueError("doc_field_name should be either document or summary")
+
+
+def build_knn_request(
+    question_embedding: List[float],
+    embedding_name: str,
+    topk: int,
+    doc_field_name: str = "document",
+):
+    return {
+        "knn": {
+            "field": embedding_name,
+            "query_vector": question_embedding,
+            "num_candidates": topk,
+            "k": topk,
+        },
+        "size": topk,
+        "_source": build_source_filter(doc_field_name),
+    }
 
 
 def build_context_batch_worker(
@@ -12,54 +49,54 @@ def build_context_batch_worker(
     topk: int,
     elasticsearch_host_name: str,
     doc_field_name: str,
+    search_mode: str = "single",
+    msearch_batch_size: int = 64,
 ):
-    retriever = Elasticsearch(
-        "http://elastic:{}".format(os.environ["ELASTIC_PASSWORD"])
-        + "@{}".format(elasticsearch_host_name),
-        verify_certs=False,
-        ssl_show_warn=False,
-    )
+    retriever = build_elasticsearch_client(elasticsearch_host_name)
 
     context_list = []
     context_id_list = []
+    context_score_list = []
     all_questions = data_batch["question"]
     all_embeddings = data_batch["question_embedding"]
-    if doc_field_name == "document":
-        embeddding_name = "embedding"
-    elif doc_field_name == "document_summary":
-        embeddding_name = "summary_embedding"
-    else:
-        raise ValueError("doc_field_name should be either document or summary")
-    for i in tqdm(
-        list(range(len(all_questions))),
-        desc="Building context batch {}".format(rank + 1),
-        position=rank + 1,
-        leave=False,
-    ):
-        doc_list = retriever.search(
-            index=bm25_index_name,
-            knn={
-                "field": embeddding_name,
-                "query_vector": all_embeddings[i],
-                "num_candidates": topk,
-                "k": topk,
-            },
-            size=topk,
-        )["hits"]["hits"]
-
-        cur_context_str_list = []
-        cur_doc_id_list = []
+    embeddding_name = get_embedding_field_name(doc_field_name)
+    all_requests = [
+        build_knn_request(e, embeddding_name, topk, doc_field_name)
+        for e in all_embeddings
+    ]
 
-        for doc in doc_list:
-            cur_doc = doc["_source"][doc_field_name]
-            cur_doc = cur_doc.replace("<|endoftext|>", " ")
-            cur_doc_id_list.append(doc["_id"])
-            cur_context_str_list.append(cur_doc)
+    if search_mode == "msearch":
+        all_doc_lists = msearch_in_batches(
+            retriever,
+            bm25_index_name,
+            all_requests,
+            msearch_batch_size,
+            desc="Building context batch {}".format(rank + 1),
+            position=rank + 1,
+        )
+    else:
+        all_doc_lists = []
+        for i in tqdm(
+            list(range(len(all_questions))),
+            desc="Building context batch {}".format(rank + 1),
+            position=rank + 1,
+            leave=False,
+        ):
+            doc_list = retriever.search(index=bm25_index_name, body=all_requests[i])[
+                "hits"
+            ]["hits"]
+            all_doc_lists.append(doc_list)
 
+    for doc_list in all_doc_lists:
+        cur_context_str_list, cur_doc_id_list, cur_context_scores = (
+            build_context_from_hits(doc_list, doc_field_name)
+        )
         context_list.append(cur_context_str_list)
         context_id_list.append(cur_doc_id_list)
+        context_score_list.append(cur_context_scores)
     data_batch["context"] = context_list
     data_batch["context_doc_ids"] = context_id_list
+    data_batch["context_scores"] = context_score_list
     return data_batch
 
 
@@ -67,9 +104,15 @@ class VectorDenseRetriever(RetrieverBase):
     def __init__(
         self,
         topk: int,
-        elasticsearch_index_name: str,
-        elasticsearch_host_name: str,
+        elasticsearch_index_name: str = None,
+        elasticsearch_host_name: str = None,
         doc_field_name: str = "document",
+        search_mode: str = "single",
+        msearch_batch_size: int = 64,
+        retrieval_engine: str = "map",
+        max_in_flight: int = 64,
+        index_backend: str = "elasticsearch",
+        local_index_path: str = None,
         **kwargs,
     ):
         super().__init__(**kwargs)
@@ -77,9 +120,77 @@ class VectorDenseRetriever(RetrieverBase):
         self.bm25_index_name = elasticsearch_index_name
         self.elasticsearch_host_name = elasticsearch_host_name
         self.doc_field_name = doc_field_name
+        self.search_mode = search_mode
+        self.msearch_batch_size = msearch_batch_size
+        self.retrieval_engine = retrieval_engine
+        self.max_in_flight = max_in_flight
+        self.index_backend = index_backend
+        self.local_index_path = local_index_path
+
+        if self.index_backend not in INDEX_BACKENDS:
+            raise ValueError(f"Invalid index backend: {self.index_backend}")
+        if self.index_backend == "local" and self.local_index_path is None:
+            raise ValueError("local_index_path is required for the local backend")
+        if self.search_mode not in SEARCH_MODES:
+            raise ValueError(f"Invalid search mode: {self.search_mode}")
+        if self.retrieval_engine not in RETRIEVAL_ENGINES:
+            raise ValueError(f"Invalid retrieval engine: {self.retrieval_engine}")
+
+    def build_context_async(self, full_data: datasets.Dataset) -> datasets.Dataset:
+        engine = AsyncRetrievalEngine(
+            self.elasticsearch_host_name, max_in_flight=self.max_in_flight
+        )
+        embeddding_name = get_embedding_field_name(self.doc_field_name)
+        request_groups = [
+            [build_knn_request(e, embeddding_name, self.topk, self.doc_field_name)]
+            for e in full_data["question_embedding"]
+        ]
+        all_results = engine.search(self.bm25_index_name, request_groups)
+
+        context_list = []
+        context_id_list = []
+        context_score_list = []
+        for (doc_list,) in all_results:
+            cur_context_str_list, cur_doc_id_list, cur_context_scores = (
+                build_context_from_hits(doc_list, self.doc_field_name)
+            )
+            context_list.append(cur_context_str_list)
+            context_id_list.append(cur_doc_id_list)
+            context_score_list.append(cur_context_scores)
+        return attach_context(
+            full_data, context_list, context_id_list, context_score_list
+        )
+
+    def build_context_local(self, full_data: datasets.Dataset) -> datasets.Dataset:
+        index = LocalDenseIndex(self.local_index_path)
+        all_requests = [
+            build_knn_request(e, "embedding", self.topk, self.doc_field_name)
+            for e in full_data["question_embedding"]
+        ]
+        all_doc_lists = index.search_requests(all_requests, self.doc_field_name)
+
+        context_list = []
+        context_id_list = []
+        context_score_list = []
+        for doc_list in all_doc_lists:
+            cur_context_str_list, cur_doc_id_list, cur_context_scores = (
+                build_context_from_hits(doc_list, self.doc_field_name)
+            )
+            context_list.append(cur_context_str_list)
+            context_id_list.append(cur_doc_id_list)
+            context_score_list.append(cur_context_scores)
+        return attach_context(
+            full_data, context_list, context_id_list, context_score_list
+        )
 
     def build_context(self, full_data) -> str:
 
+        if self.index_backend == "local":
+            return self.build_context_local(full_data)
+
+        if self.retrieval_engine == "async":
+            return self.build_context_async(full_data)
+
         bs = len(full_data) // os.cpu_count()
 
         if bs == 0:
@@ -95,6 +206,8 @@ class VectorDenseRetriever(RetrieverBase):
                 "topk": self.topk,
                 "bm25_index_name": self.bm25_index_name,
                 "doc_field_name": self.doc_field_name,
+                "search_mode": self.search_mode,
+                "msearch_batch_size": self.msearch_batch_size,
             },
             batched=True,
             with_rank=True,
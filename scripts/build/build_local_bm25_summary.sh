@@ -0,0 +1,3 @@
+#!/bin/bash
+source init.sh
+python3 build_local_bm25_index.py --data_path dataset/wildchat_aqa_summary_with_embedding --index_path dataset/local_index/wildchat_aqa_summary_bm25
\ No newline at end of file
@@ -0,0 +1,3 @@
+#!/bin/bash
+source init.sh
+python3 build_local_dense_index.py --data_path dataset/wildchat_aqa_document_with_embedding --index_path dataset/local_index/wildchat_aqa_document
\ No newline at end of file
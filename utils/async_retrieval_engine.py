@@ -0,0 +1,125 @@
+import asyncio
+from tqdm import tqdm
+from typing import List
+from utils.elasticsearch_utils import (
+    build_async_elasticsearch_client,
+    build_msearch_searches,
+    get_search_params,
+    route_partitioned_index,
+)
+
+RETRIEVAL_ENGINES = {"map", "async"}
+
+
+class AsyncRetrievalEngine:
+    """
+    Run many Elasticsearch searches from a single event loop, sharing one
+    pooled `AsyncElasticsearch` client and keeping at most `max_in_flight`
+    requests outstanding. Results are collected in request order.
+    """
+
+    def __init__(
+        self,
+        elasticsearch_host_name: str,
+        max_in_flight: int = 64,
+        request_timeout: int = 60,
+        max_retries: int = 3,
+    ):
+        if max_in_flight <= 0:
+            raise ValueError("max_in_flight should be positive")
+        self.elasticsearch_host_name = elasticsearch_host_name
+        self.max_in_flight = max_in_flight
+        self.request_timeout = request_timeout
+        self.max_retries = max_retries
+
+    def _build_client(self):
+        return build_async_elasticsearch_client(
+            self.elasticsearch_host_name,
+            connections_per_node=self.max_in_flight,
+            request_timeout=self.request_timeout,
+            max_retries=self.max_retries,
+            retry_on_timeout=True,
+        )
+
+    async def _search_all(
+        self,
+        index: str,
+        request_groups: List[List[dict]],
+        desc: str,
+        group_as_msearch: bool = False,
+        partition_by: str = None,
+    ):
+        results = [[None] * len(group) for group in request_groups]
+        remaining = [len(group) for group in request_groups]
+
+        queue = asyncio.Queue()
+        for group_idx, group in enumerate(request_groups):
+            if group_as_msearch and len(group) > 0:
+                queue.put_nowait((group_idx, None, group))
+                continue
+            for request_idx, body in enumerate(group):
+                queue.put_nowait((group_idx, request_idx, body))
+
+        client = self._build_client()
+        progress = tqdm(total=len(request_groups), desc=desc)
+
+        for group_idx in range(len(request_groups)):
+            if remaining[group_idx] == 0:
+                progress.update(1)
+
+        async def worker():
+            while True:
+                try:
+                    group_idx, request_idx, body = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                if request_idx is None:
+                    searches = build_msearch_searches(index, body, partition_by)
+                    resp = await client.msearch(index=index, searches=searches)
+                    for i, cur_resp in enumerate(resp["responses"]):
+                        if "error" in cur_resp:
+                            raise ValueError(
+                                "msearch request failed: {}".format(cur_resp["error"])
+                            )
+                        results[group_idx][i] = cur_resp["hits"]["hits"]
+                    remaining[group_idx] = 0
+                else:
+                    resp = await client.search(
+                        index=route_partitioned_index(index, body, partition_by),
+                        body=body,
+                        **get_search_params(partition_by),
+                    )
+                    results[group_idx][request_idx] = resp["hits"]["hits"]
+                    remaining[group_idx] -= 1
+                if remaining[group_idx] == 0:
+                    progress.update(1)
+
+        try:
+            num_workers = min(self.max_in_flight, queue.qsize())
+            await asyncio.gather(*[worker() for _ in range(num_workers)])
+        finally:
+            progress.close()
+            await client.close()
+
+        return results
+
+    def search(
+        self,
+        index: str,
+        request_groups: List[List[dict]],
+        desc: str = "Retrieving documents",
+        group_as_msearch: bool = False,
+        partition_by: str = None,
+    ) -> List[List[List[dict]]]:
+        """
+        `request_groups` holds one list of search bodies per question, the
+        returned hit lists have exactly the same nesting and order. With
+        `group_as_msearch` every group is sent as a single `_msearch`. With
+        `partition_by` every body only hits the partitions of `index` its
+        time range overlaps.
+        """
+        return asyncio.run(
+            self._search_all(
+                index, request_groups, desc, group_as_msearch, partition_by
+            )
+        )
@@ -0,0 +1,107 @@
+import os
+import json
+import numpy as np
+from typing import Dict, List
+from utils.mongo_query_utils import get_context_query
+
+CONDITION_KEYS_FILE_NAME = "condition_keys.npy"
+CONDITION_OFFSETS_FILE_NAME = "condition_offsets.npy"
+CONDITION_HASHES_FILE_NAME = "condition_hashes.npy"
+CONDITION_META_FILE_NAME = "meta.json"
+
+
+def canonicalize_condition(condition_type: List[str], condition_value: List[str]):
+    # key on the query that is actually run, the condition order matters
+    # there since later country / language / time_week / keywords values
+    # overwrite earlier ones
+    return json.dumps(
+        get_context_query(condition_type, condition_value),
+        sort_keys=True,
+        default=str,
+    )
+
+
+class ConditionHashCache:
+    """
+    On-disk mapping from a canonicalized condition query to the sorted hashes
+    of the conversations matching `get_context_query`. Keys are kept sorted
+    with the hashes of all conditions concatenated in one array, `offsets`
+    delimits the hashes of every key. Arrays are memory-mapped on load.
+    """
+
+    def __init__(self, cache_path: str):
+        self.cache_path = cache_path
+        self._keys = None
+        self._offsets = None
+        self._hashes = None
+        with open(os.path.join(cache_path, CONDITION_META_FILE_NAME), "r") as f:
+            self.meta = json.load(f)
+
+    def __getstate__(self):
+        # workers re-open the memory maps instead of receiving a copy
+        state = self.__dict__.copy()
+        state["_keys"] = None
+        state["_offsets"] = None
+        state["_hashes"] = None
+        return state
+
+    def _load(self):
+        if self._keys is None:
+            self._keys = np.load(
+                os.path.join(self.cache_path, CONDITION_KEYS_FILE_NAME), mmap_mode="r"
+            )
+            self._offsets = np.load(
+                os.path.join(self.cache_path, CONDITION_OFFSETS_FILE_NAME),
+                mmap_mode="r",
+            )
+            self._hashes = np.load(
+                os.path.join(self.cache_path, CONDITION_HASHES_FILE_NAME),
+                mmap_mode="r",
+            )
+
+    def __len__(self):
+        self._load()
+        return len(self._keys)
+
+    def lookup(self, condition_type: List[str], condition_value: List[str]):
+        """
+        Return the sorted hashes matching the conditions, None when the
+        conditions are not cached
+        """
+        self._load()
+        key = canonicalize_condition(condition_type, condition_value)
+        if len(self._keys) == 0 or len(key) > self._keys.dtype.itemsize // 4:
+            return None
+        pos = int(np.searchsorted(self._keys, key))
+        if pos >= len(self._keys) or self._keys[pos] != key:
+            return None
+        return self._hashes[self._offsets[pos] : self._offsets[pos + 1]].tolist()
+
+    @staticmethod
+    def write(cache_path: str, condition_hashes: Dict[str, List[str]], meta: dict):
+        """
+        Write `condition_hashes`, keyed by `canonicalize_condition`, to
+        `cache_path`
+        """
+        all_keys = sorted(condition_hashes)
+        all_hashes = [sorted(condition_hashes[k]) for k in all_keys]
+        offsets = np.zeros(len(all_keys) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(x) for x in all_hashes])
+        key_width = max([len(k) for k in all_keys], default=1)
+        hash_width = max([len(h) for x in all_hashes for h in x], default=1)
+
+        os.makedirs(cache_path, exist_ok=True)
+        for file_name, array in [
+            (CONDITION_KEYS_FILE_NAME, np.array(all_keys, dtype=f"U{key_width}")),
+            (CONDITION_OFFSETS_FILE_NAME, offsets),
+            (
+                CONDITION_HASHES_FILE_NAME,
+                np.array([h for x in all_hashes for h in x], dtype=f"U{hash_width}"),
+            ),
+        ]:
+            tmp_path = os.path.join(cache_path, file_name + ".tmp")
+            with open(tmp_path, "wb") as f:
+                np.save(f, array)
+            os.replace(tmp_path, os.path.join(cache_path, file_name))
+        with open(os.path.join(cache_path, CONDITION_META_FILE_NAME), "w") as f:
+            json.dump(meta, f, indent=2)
@@ -0,0 +1,182 @@
+import os
+from tqdm import tqdm
+from typing import List
+from datetime import datetime, timedelta
+from elasticsearch import AsyncElasticsearch, Elasticsearch
+
+SEARCH_MODES = {"single", "msearch"}
+PARTITION_SCHEMES = {"month"}
+
+
+def get_elasticsearch_url(elasticsearch_host_name: str):
+    return "http://elastic:{}@{}".format(
+        os.environ["ELASTIC_PASSWORD"], elasticsearch_host_name
+    )
+
+
+def build_elasticsearch_client(elasticsearch_host_name: str, **kwargs):
+    return Elasticsearch(
+        get_elasticsearch_url(elasticsearch_host_name),
+        verify_certs=False,
+        ssl_show_warn=False,
+        **kwargs,
+    )
+
+
+def build_async_elasticsearch_client(elasticsearch_host_name: str, **kwargs):
+    return AsyncElasticsearch(
+        get_elasticsearch_url(elasticsearch_host_name),
+        verify_certs=False,
+        ssl_show_warn=False,
+        **kwargs,
+    )
+
+
+def build_context_from_hits(doc_list: List[dict], doc_field_name: str):
+    context_str_list = []
+    context_doc_ids = []
+    context_scores = []
+    for doc in doc_list:
+        cur_doc = doc["_source"][doc_field_name]
+        cur_doc = cur_doc.replace("<|endoftext|>", " ")
+        context_str_list.append(cur_doc)
+        context_doc_ids.append(doc["_source"]["hash"])
+        context_scores.append(doc["_score"])
+    return context_str_list, context_doc_ids, context_scores
+
+
+def build_source_filter(doc_field_name: str):
+    # the retrievers only read the text and the hash of a hit, leaving the
+    # embeddings out of the response
+    return [doc_field_name, "hash"]
+
+
+def get_partition_index_name(index_name: str, timestamp: datetime):
+    # monthly partitions of `index_name`, which is kept as an alias over them
+    return "{}-{}".format(index_name, timestamp.strftime("%Y.%m"))
+
+
+def find_timestamp_range(body):
+    if isinstance(body, dict):
+        if "range" in body and "timestamp" in body["range"]:
+            return body["range"]["timestamp"]
+        values = body.values()
+    elif isinstance(body, list):
+        values = body
+    else:
+        return None
+    for value in values:
+        found = find_timestamp_range(value)
+        if found is not None:
+            return found
+    return None
+
+
+def parse_range_time(value: str):
+    return datetime.fromisoformat(value.rstrip("Z"))
+
+
+def route_partitioned_index(index_name: str, body: dict, partition_by: str = None):
+    """
+    The indices a search body has to hit: `index_name` itself when the index
+    is not partitioned or the body has no bounded `timestamp` range, else the
+    comma-separated partitions overlapping the range. Partitions that do not
+    exist are skipped with `ignore_unavailable`.
+    """
+    if partition_by is None:
+        return index_name
+    if partition_by not in PARTITION_SCHEMES:
+        raise ValueError(f"Invalid partition scheme: {partition_by}")
+
+    time_range = find_timestamp_range(body)
+    if time_range is None:
+        return index_name
+    start = time_range.get("gte", time_range.get("gt"))
+    if "lte" in time_range:
+        end = parse_range_time(time_range["lte"])
+    elif "lt" in time_range:
+        end = parse_range_time(time_range["lt"]) - timedelta(microseconds=1)
+    else:
+        end = None
+    if start is None or end is None:
+        return index_name
+    start = parse_range_time(start)
+
+    partitions = []
+    year, month = start.year, start.month
+    while (year, month) <= (end.year, end.month):
+        partitions.append(
+            get_partition_index_name(index_name, datetime(year, month, 1))
+        )
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    if len(partitions) == 0:
+        # empty range, any partition answers with no hits
+        partitions.append(get_partition_index_name(index_name, start))
+    return ",".join(partitions)
+
+
+def get_search_params(partition_by: str = None):
+    return {"ignore_unavailable": True} if partition_by is not None else {}
+
+
+def build_msearch_searches(index: str, bodies: List[dict], partition_by: str = None):
+    """
+    `_msearch` header/body pairs, with `partition_by` every body is routed to
+    the partitions of `index` its time range overlaps
+    """
+    searches = []
+    for body in bodies:
+        if partition_by is None:
+            searches.append({})
+        else:
+            searches.append(
+                {
+                    "index": route_partitioned_index(index, body, partition_by),
+                    **get_search_params(partition_by),
+                }
+            )
+        searches.append(body)
+    return searches
+
+
+def msearch(
+    client: Elasticsearch,
+    index: str,
+    bodies: List[dict],
+    partition_by: str = None,
+):
+    """
+    Send `bodies` to `index` as one `_msearch` request, the hit lists are
+    returned in the same order as `bodies`
+    """
+    searches = build_msearch_searches(index, bodies, partition_by)
+
+    all_hits = []
+    for resp in client.msearch(index=index, searches=searches)["responses"]:
+        if "error" in resp:
+            raise ValueError("msearch request failed: {}".format(resp["error"]))
+        all_hits.append(resp["hits"]["hits"])
+    return all_hits
+
+
+def msearch_in_batches(
+    client: Elasticsearch,
+    index: str,
+    bodies: List[dict],
+    batch_size: int,
+    desc: str = "Searching",
+    position: int = 0,
+):
+    """
+    Send `bodies` to `index` as `_msearch` requests of at most `batch_size`
+    searches each, the hit lists are returned in the same order as `bodies`
+    """
+    all_hits = []
+    for st in tqdm(
+        list(range(0, len(bodies), batch_size)),
+        desc=desc,
+        position=position,
+        leave=False,
+    ):
+        all_hits.extend(msearch(client, index, bodies[st : st + batch_size]))
+    return all_hits
@@ -0,0 +1,33 @@
+import json
+import hashlib
+import numpy as np
+
+FINGERPRINT_FIELD = "fingerprint"
+
+
+def compute_fingerprint(record: dict, vector_fields=()) -> str:
+    """
+    Content hash of a stored record, used by the incremental builders to
+    skip records whose stored copy is already up to date. Vector fields are
+    hashed as float32 bytes instead of being serialized to JSON.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    scalar_fields = {
+        k: v
+        for k, v in record.items()
+        if k not in vector_fields and k != FINGERPRINT_FIELD
+    }
+    h.update(json.dumps(scalar_fields, sort_keys=True, default=str).encode("utf-8"))
+    for k in sorted(vector_fields):
+        h.update(np.asarray(record[k], dtype=np.float32).tobytes())
+    return h.hexdigest()
+
+
+def compute_dataset_fingerprint(dataset) -> str:
+    """
+    Fingerprint of a whole `datasets.Dataset`, stored in the build
+    checkpoints. `save_to_disk` persists the fingerprint of the saved
+    content, so a dataset rewritten in place under the same path and with
+    the same row count still gets a new one.
+    """
+    return dataset._fingerprint
@@ -0,0 +1,71 @@
+import os
+import atexit
+import multiprocessing.util
+import multiprocess.util
+from typing import Dict, Tuple
+from pymongo import MongoClient
+
+MONGO_COMPRESSORS = {"zstd", "snappy", "zlib"}
+MONGO_READ_PREFERENCES = {
+    "primary",
+    "primaryPreferred",
+    "secondary",
+    "secondaryPreferred",
+    "nearest",
+}
+
+# clients of this process keyed by their settings, a forked process does not
+# reuse the clients of its parent
+_mongo_clients: Dict[Tuple, MongoClient] = {}
+_close_registered_pids = set()
+
+
+def validate_mongo_client_options(compressors: str = None, read_preference: str = None):
+    if compressors is not None:
+        for compressor in compressors.split(","):
+            if compressor not in MONGO_COMPRESSORS:
+                raise ValueError(f"Invalid MongoDB compressor: {compressor}")
+    if read_preference is not None and read_preference not in MONGO_READ_PREFERENCES:
+        raise ValueError(f"Invalid MongoDB read preference: {read_preference}")
+
+
+def get_mongo_client(
+    mongodb_host_name: str,
+    max_pool_size: int = None,
+    compressors: str = None,
+    read_preference: str = None,
+) -> MongoClient:
+    """
+    Return the client of this process for the given settings, created on
+    first use and closed when the process exits. `compressors` is a
+    comma-separated list in order of preference, e.g. "zstd,snappy".
+    """
+    key = (os.getpid(), mongodb_host_name, max_pool_size, compressors, read_preference)
+    if key not in _mongo_clients:
+        validate_mongo_client_options(compressors, read_preference)
+        kwargs = {}
+        if max_pool_size is not None:
+            kwargs["maxPoolSize"] = max_pool_size
+        if compressors is not None:
+            kwargs["compressors"] = compressors
+        if read_preference is not None:
+            kwargs["readPreference"] = read_preference
+        if os.getpid() not in _close_registered_pids:
+            _register_close_at_exit()
+        _mongo_clients[key] = MongoClient(mongodb_host_name, **kwargs)
+    return _mongo_clients[key]
+
+
+def close_mongo_clients():
+    pid = os.getpid()
+    for key in [x for x in _mongo_clients if x[0] == pid]:
+        _mongo_clients.pop(key).close()
+
+
+def _register_close_at_exit():
+    # pool workers leave through os._exit, which skips atexit but runs the
+    # multiprocessing finalizers, these are cleared in a new process
+    _close_registered_pids.add(os.getpid())
+    atexit.register(close_mongo_clients)
+    multiprocessing.util.Finalize(None, close_mongo_clients, exitpriority=10)
+    multiprocess.util.Finalize(None, close_mongo_clients, exitpriority=10)
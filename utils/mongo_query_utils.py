@@ -0,0 +1,301 @@
+from typing import List
+from datetime import datetime, timedelta
+
+# expression form of {"$exists": True, "$not": {"$size": 0}} on
+# keywords_aggregated, $and short-circuits before $size
+HAS_KEYWORDS_AGGREGATED = {
+    "$and": [
+        {"$ne": [{"$type": "$keywords_aggregated"}, "missing"]},
+        {
+            "$not": [
+                {
+                    "$and": [
+                        {"$isArray": "$keywords_aggregated"},
+                        {"$eq": [{"$size": "$keywords_aggregated"}, 0]},
+                    ]
+                }
+            ]
+        },
+    ]
+}
+
+
+def get_context_query(condition_type, condition_value):
+    query = {}
+
+    if (
+        len(condition_type) > 1
+        and len(set(condition_type)) == 1
+        and condition_type[0] in {"label_level_1", "label_level_2"}
+    ):
+        real_query = {"$match": {"labels": {"$all": condition_value}}}
+    else:
+        for i in range(len(condition_type)):
+            cur_cond = condition_type[i]
+            cur_value = condition_value[i]
+
+            if cur_cond == "country":
+                query["country"] = [cur_value]
+            elif cur_cond == "language":
+                query["language"] = [cur_value]
+            elif cur_cond in {"label_level_1", "label_level_2"}:
+                if "labels" not in query:
+                    query["labels"] = [cur_value]
+                else:
+                    query["labels"].append(cur_value)
+            elif cur_cond == "user_name":
+
+                if "user_name" not in query:
+                    query["user_name"] = [cur_value]
+                else:
+                    query["user_name"].append(cur_value)
+            elif cur_cond == "time_week":
+                st = datetime.strptime(cur_value, "%Y-%m-%d %H:%M:%S")
+                query["timestamp"] = {
+                    "$gte": st,
+                    "$lt": st + timedelta(days=7),
+                }
+            elif cur_cond == "keywords":
+                if "keywords" not in query:
+                    query["keywords.value"] = [cur_value]
+                else:
+                    query["keywords.value"].append(cur_value)
+            elif cur_cond == "keywords_aggregated":
+                if "keywords_aggregated" not in query:
+                    query["keywords_aggregated.value"] = [cur_value]
+                else:
+                    query["keywords_aggregated.value"].append(cur_value)
+
+        if len(condition_type) > 0:
+
+            conds = []
+
+            for k, v in query.items():
+                if k == "timestamp":
+                    conds.append({k: v})
+                else:
+                    conds.append({k: {"$in": v}})
+
+            real_query = {"$match": {"$and": conds}}
+        else:
+            real_query = {"$match": {}}
+    return real_query
+
+
+def conditions_to_dialogue_filters(
+    condition_type: List[str], condition_value: List[str]
+) -> dict:
+    """
+    Translate the conditions of a generated question into the filter fields
+    of the visualizer's dialogue request
+    """
+    filters = {
+        "country": [],
+        "region": [],
+        "user_name": [],
+        "language": [],
+        "topics": [],
+        "start_date": "",
+        "end_date": "",
+        "keywords": [],
+        "keywords_aggregated": [],
+    }
+    for i in range(len(condition_type)):
+        if condition_type[i] == "country":
+            filters["country"].append(condition_value[i])
+        if condition_type[i] == "region":
+            filters["region"].append(condition_value[i])
+        if condition_type[i] == "user_name":
+            filters["user_name"].append(condition_value[i])
+        if condition_type[i] == "language":
+            filters["language"].append(condition_value[i])
+        if condition_type[i] == "label_level_1":
+            filters["topics"].append(condition_value[i])
+        if condition_type[i] == "label_level_2":
+            filters["topics"].append(condition_value[i])
+        if condition_type[i] == "keywords":
+            filters["keywords"].append(condition_value[i])
+        if condition_type[i] == "keywords_aggregated":
+            filters["keywords_aggregated"].append(condition_value[i])
+        if condition_type[i] == "time_week":
+            if condition_value[i].find(":") != -1:
+                filters["start_date"] = condition_value[i].split()[0]
+            else:
+                filters["start_date"] = condition_value[i]
+            # the end date is inclusive, the last day of the week
+            filters["end_date"] = (
+                datetime.strptime(filters["start_date"], "%Y-%m-%d") + timedelta(days=6)
+            ).strftime("%Y-%m-%d")
+    return filters
+
+
+def build_dialogue_query(
+    country: List[str],
+    region: List[str],
+    user_name: List[str],
+    language: List[str],
+    topics: List[str],
+    keywords: List[str],
+    keywords_aggregated: List[str],
+    start_date: str,
+    end_date: str,
+    **kwargs,
+) -> dict:
+    # each field is a list of values, the values are ORed
+    query = {}
+    if len(country) > 0:
+        query["country"] = {"$in": country}
+    if len(region) > 0:
+        query["region"] = {"$in": region}
+    if len(user_name) > 0:
+        query["user_name"] = {"$in": user_name}
+    if len(language) > 0:
+        query["language"] = {"$in": language}
+    if len(topics) > 0:
+        if len(topics) > 1:
+            query["labels"] = {"$all": topics}
+        else:
+            query["labels"] = {"$in": topics}
+    if len(keywords) > 0:
+        query["keywords.value"] = {"$in": keywords}
+
+    if len(keywords_aggregated) > 0:
+        query["keywords_aggregated.value"] = {"$in": keywords_aggregated}
+
+    if start_date and end_date:
+        # both days are included, the end date matches up to its midnight
+        query["timestamp"] = {
+            "$gte": datetime.strptime(start_date, "%Y-%m-%d"),
+            "$lt": datetime.strptime(end_date, "%Y-%m-%d") + timedelta(days=1),
+        }
+    return query
+
+
+def build_keyword_stats_facet(field: str):
+    return [
+        {"$unwind": "$" + field},
+        {
+            "$group": {
+                "_id": {"$concat": [f"${field}.value", ":", f"${field}.keyword_type"]},
+                "count": {"$sum": 1},
+            }
+        },
+        {"$sort": {"count": -1}},
+        {"$limit": 100},
+    ]
+
+
+def build_dialogue_stats_pipeline(query: dict):
+    """
+    All statistics of the visualizer for `query` in one `$match` + `$facet`
+    pass, the output document holds one list of {"_id", "count"} groups per
+    statistic and the totals
+    """
+    return [
+        {"$match": query},
+        {
+            "$facet": {
+                "totals": [
+                    {
+                        "$group": {
+                            "_id": None,
+                            "count": {"$sum": 1},
+                            "token_count": {"$sum": "$token_count"},
+                            "keyword_aggregated_count": {
+                                "$sum": {"$cond": [HAS_KEYWORDS_AGGREGATED, 1, 0]}
+                            },
+                        }
+                    }
+                ],
+                "country_stats": [
+                    {"$group": {"_id": "$country", "count": {"$sum": 1}}},
+                    {"$sort": {"count": -1}},
+                ],
+                "user_stats": [
+                    {"$group": {"_id": "$user_name", "count": {"$sum": 1}}},
+                    {"$sort": {"count": -1}},
+                    {"$limit": 100},
+                ],
+                "language_stats": [
+                    {"$group": {"_id": "$language", "count": {"$sum": 1}}},
+                    {"$sort": {"count": -1}},
+                ],
+                "label_stats": [
+                    {"$unwind": "$labels"},
+                    {"$group": {"_id": "$labels", "count": {"$sum": 1}}},
+                    {"$sort": {"count": -1}},
+                ],
+                "keyword_stats": build_keyword_stats_facet("keywords"),
+                "keyword_aggregated_stats": build_keyword_stats_facet(
+                    "keywords_aggregated"
+                ),
+                "time_stats": [
+                    {
+                        "$group": {
+                            "_id": {
+                                "$dateToString": {
+                                    "format": "%Y-%m-%d",
+                                    "date": "$time_week",
+                                }
+                            },
+                            "count": {"$sum": 1},
+                        }
+                    },
+                    {"$sort": {"_id": 1}},
+                ],
+            }
+        },
+    ]
+
+
+# fields of a dialogue list item without the conversation body
+DIALOGUE_SUMMARY_PROJECTION = {
+    "_id": 0,
+    "summary": 1,
+    "user_name": 1,
+    "timestamp": 1,
+    "labels": 1,
+    "hash": 1,
+    "keywords": 1,
+    "keywords_aggregated": 1,
+}
+
+
+def encode_dialogue_cursor(timestamp: datetime, hash_val: str):
+    return "{}|{}".format(timestamp.isoformat(), hash_val)
+
+
+def decode_dialogue_cursor(cursor: str):
+    timestamp, hash_val = cursor.split("|", 1)
+    return datetime.fromisoformat(timestamp), hash_val
+
+
+def build_dialogue_page_pipeline(
+    query: dict, page_size: int, cursor: str = None, summary_only: bool = False
+):
+    """
+    Keyset page of the dialogues matching `query`, newest first, starting
+    after the (timestamp, hash) `cursor` of the previous page. The sort is
+    served by the {timestamp: -1, hash: -1} index.
+    """
+    if cursor is not None:
+        timestamp, hash_val = decode_dialogue_cursor(cursor)
+        query = {
+            "$and": [
+                query,
+                {
+                    "$or": [
+                        {"timestamp": {"$lt": timestamp}},
+                        {"timestamp": timestamp, "hash": {"$lt": hash_val}},
+                    ]
+                },
+            ]
+        }
+    pipeline = [
+        {"$match": query},
+        {"$sort": {"timestamp": -1, "hash": -1}},
+        {"$limit": page_size},
+    ]
+    if summary_only:
+        pipeline.append({"$project": DIALOGUE_SUMMARY_PROJECTION})
+    return pipeline
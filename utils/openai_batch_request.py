@@ -5,7 +5,7 @@ import openai
 import datetime
 import tiktoken
 from tqdm import tqdm
-from typing import List
+from typing import Dict, List
 from collections import deque
 import signal
 import threading
@@ -19,9 +19,12 @@ class OpenAIBatchRequest:
         rpm_limit: int = -1,
         tpm_limit: int = -1,
         tokenizer_encoding: str = "o200k_base",
+        token_counts: Dict[str, int] = None,
     ):
         self._file_name_list = file_name_list
         self._tokenizer = tiktoken.get_encoding(tokenizer_encoding)
+        # prompt token counts known by the caller, keyed by custom_id
+        self._token_counts = token_counts if token_counts is not None else {}
         self._open_ai_client = openai.OpenAI(api_key=api_key)
         self._task_queue = deque()
         self._rpm_limit = rpm_limit
@@ -70,9 +73,12 @@ class OpenAIBatchRequest:
                 cur = json.loads(line)
                 cur_batch_requests.append(cur["body"])
                 cur_batch_custom_ids.append(cur["custom_id"])
-                token_count = 0
-                for message in cur["body"]["messages"]:
-                    token_count += len(self._tokenizer.encode(message["content"]))
+                if cur["custom_id"] in self._token_counts:
+                    token_count = self._token_counts[cur["custom_id"]]
+                else:
+                    token_count = 0
+                    for message in cur["body"]["messages"]:
+                        token_count += len(self._tokenizer.encode(message["content"]))
                 cur_token_counts.append(token_count + 504)
 
             # List to hold threads and responses.
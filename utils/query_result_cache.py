@@ -0,0 +1,206 @@
+import os
+import json
+import time
+import pickle
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+def normalize_request(namespace: str, request: dict):
+    """
+    Cache key of a request, list filters are ORed or ANDed as sets so their
+    order and duplicates do not matter
+    """
+    normalized = {
+        k: sorted(set(v)) if isinstance(v, list) else v for k, v in request.items()
+    }
+    return hashlib.blake2b(
+        json.dumps([namespace, normalized], sort_keys=True).encode("utf-8"),
+        digest_size=16,
+    ).hexdigest()
+
+
+class QueryResultCache:
+    """
+    In-process LRU cache of endpoint results with a TTL, optionally backed
+    by pickled results under `disk_path`, which is an LRU of its own capped
+    at `max_disk_entries` files. Every entry belongs to the build marker
+    written by the collection builders when it was computed, all entries are
+    dropped once the marker changes.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 256,
+        ttl: float = 600,
+        disk_path: str = None,
+        build_marker_path: str = None,
+        max_disk_entries: int = None,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disk_path = disk_path
+        self.build_marker_path = build_marker_path
+        if max_disk_entries is None:
+            max_disk_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self._entries = OrderedDict()
+        # key -> created_at of the pickles under disk_path, in LRU order
+        self._disk_entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._build_marker = self._read_build_marker()
+        self._stats = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "expired": 0,
+            "evicted": 0,
+            "disk_evicted": 0,
+            "invalidations": 0,
+            "hit_seconds": 0.0,
+            "miss_seconds": 0.0,
+        }
+        self._load_disk_entries()
+
+    def _read_build_marker(self):
+        if self.build_marker_path is None:
+            return None
+        try:
+            with open(self.build_marker_path, "r") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _disk_file(self, key: str):
+        return os.path.join(self.disk_path, key + ".pkl")
+
+    def _load_disk_entries(self):
+        # pickles left by a previous process, oldest first, the expired ones
+        # and those over the cap are removed
+        if self.disk_path is None or not os.path.isdir(self.disk_path):
+            return
+        now = time.time()
+        all_files = []
+        for file_name in os.listdir(self.disk_path):
+            if file_name.endswith(".pkl"):
+                file_path = os.path.join(self.disk_path, file_name)
+                all_files.append((os.path.getmtime(file_path), file_name[:-4]))
+        for mtime, key in sorted(all_files):
+            if now - mtime > self.ttl:
+                os.remove(self._disk_file(key))
+                continue
+            self._disk_entries[key] = mtime
+        self._evict_disk()
+
+    def _evict_disk(self):
+        while len(self._disk_entries) > self.max_disk_entries:
+            key, _ = self._disk_entries.popitem(last=False)
+            if os.path.exists(self._disk_file(key)):
+                os.remove(self._disk_file(key))
+            self._stats["disk_evicted"] += 1
+
+    def _check_build_marker(self):
+        build_marker = self._read_build_marker()
+        if build_marker == self._build_marker:
+            return
+        self._build_marker = build_marker
+        self._entries.clear()
+        self._disk_entries.clear()
+        if self.disk_path is not None and os.path.isdir(self.disk_path):
+            for file_name in os.listdir(self.disk_path):
+                if file_name.endswith(".pkl"):
+                    os.remove(os.path.join(self.disk_path, file_name))
+        self._stats["invalidations"] += 1
+
+    def _get(self, key: str):
+        now = time.time()
+        expired = False
+        if key in self._entries:
+            created_at, value = self._entries[key]
+            if now - created_at <= self.ttl:
+                self._entries.move_to_end(key)
+                self._stats["memory_hits"] += 1
+                return True, value
+            del self._entries[key]
+            expired = True
+
+        if key in self._disk_entries and os.path.exists(self._disk_file(key)):
+            with open(self._disk_file(key), "rb") as f:
+                created_at, value = pickle.load(f)
+            if now - created_at <= self.ttl:
+                self._disk_entries.move_to_end(key)
+                self._put_memory(key, created_at, value)
+                self._stats["disk_hits"] += 1
+                return True, value
+            os.remove(self._disk_file(key))
+            expired = True
+        self._disk_entries.pop(key, None)
+        self._stats["expired"] += int(expired)
+        return False, None
+
+    def _put_memory(self, key: str, created_at: float, value):
+        self._entries[key] = (created_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._stats["evicted"] += 1
+
+    def _put(self, key: str, value):
+        created_at = time.time()
+        self._put_memory(key, created_at, value)
+        if self.disk_path is not None:
+            os.makedirs(self.disk_path, exist_ok=True)
+            tmp_path = self._disk_file(key) + ".{}.tmp".format(threading.get_ident())
+            with open(tmp_path, "wb") as f:
+                pickle.dump((created_at, value), f)
+            os.replace(tmp_path, self._disk_file(key))
+            self._disk_entries[key] = created_at
+            self._disk_entries.move_to_end(key)
+            self._evict_disk()
+
+    def get_or_compute(self, namespace: str, request: dict, compute: callable):
+        key = normalize_request(namespace, request)
+        st = time.time()
+        with self._lock:
+            self._check_build_marker()
+            build_marker = self._build_marker
+            found, value = self._get(key)
+            if found:
+                self._stats["hit_seconds"] += time.time() - st
+                return value
+
+        # computed outside of the lock, concurrent misses of one key may
+        # both compute it
+        value = compute()
+        with self._lock:
+            self._check_build_marker()
+            # a result computed across a rebuild may predate it, not cached
+            if self._build_marker == build_marker:
+                self._put(key, value)
+            self._stats["misses"] += 1
+            self._stats["miss_seconds"] += time.time() - st
+        return value
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            num_entries = len(self._entries)
+            num_disk_entries = len(self._disk_entries)
+        num_hits = stats["memory_hits"] + stats["disk_hits"]
+        num_requests = num_hits + stats["misses"]
+        return {
+            **{k: v for k, v in stats.items() if not k.endswith("_seconds")},
+            "entries": num_entries,
+            "max_entries": self.max_entries,
+            "disk_entries": num_disk_entries,
+            "max_disk_entries": self.max_disk_entries,
+            "ttl": self.ttl,
+            "hit_rate": num_hits / num_requests if num_requests > 0 else 0.0,
+            "mean_hit_ms": stats["hit_seconds"] / num_hits * 1000 if num_hits else 0.0,
+            "mean_miss_ms": (
+                stats["miss_seconds"] / stats["misses"] * 1000
+                if stats["misses"]
+                else 0.0
+            ),
+        }
@@ -0,0 +1,111 @@
+import os
+import re
+import numpy as np
+from typing import Dict, List
+
+TOKEN_COUNT_CACHE_ROOT = "dataset/token_count_cache"
+TOKEN_COUNT_FILE_NAME = "token_counts.npy"
+
+
+class TokenCountCache:
+    """
+    On-disk store of document token counts keyed by tokenizer identity,
+    document namespace and document hash. Entries are kept in one sorted
+    structured numpy array that is memory-mapped on load, so lookups from
+    many worker processes share the page cache. New counts are buffered with
+    `add` and merged into the file by `flush`.
+    """
+
+    def __init__(
+        self,
+        tokenizer_name: str,
+        namespace: str,
+        cache_root: str = TOKEN_COUNT_CACHE_ROOT,
+    ):
+        self.tokenizer_name = tokenizer_name
+        self.namespace = namespace
+        self.cache_path = os.path.join(
+            cache_root, re.sub(r"[^\w\-.]", "_", tokenizer_name), namespace
+        )
+        self._entries = None
+        self._pending = {}
+
+    def __getstate__(self):
+        # workers re-open the memory map instead of receiving a copy
+        state = self.__dict__.copy()
+        state["_entries"] = None
+        state["_pending"] = {}
+        return state
+
+    def _file_path(self):
+        return os.path.join(self.cache_path, TOKEN_COUNT_FILE_NAME)
+
+    def _read_entries(self):
+        if os.path.exists(self._file_path()):
+            return np.load(self._file_path(), mmap_mode="r")
+        return np.zeros(0, dtype=[("key", "U1"), ("count", "i4")])
+
+    def _get_entries(self):
+        if self._entries is None:
+            self._entries = self._read_entries()
+        return self._entries
+
+    def lookup(self, keys: List[str]) -> np.ndarray:
+        """
+        Return the cached token count of every key, -1 for unknown keys
+        """
+        counts = np.full(len(keys), -1, dtype=np.int64)
+        entries = self._get_entries()
+        if len(keys) == 0 or len(entries) == 0:
+            return counts
+
+        all_keys = entries["key"]
+        query = np.asarray(keys, dtype=all_keys.dtype)
+        pos = np.searchsorted(all_keys, query)
+        pos = np.minimum(pos, len(all_keys) - 1)
+        found = all_keys[pos] == np.asarray(keys)
+        counts[found] = entries["count"][pos[found]]
+        return counts
+
+    def get_token_counts(
+        self, keys: List[str], texts: List[str], tokenize_func: callable
+    ) -> List[int]:
+        counts = self.lookup(keys)
+        for i in np.nonzero(counts < 0)[0]:
+            counts[i] = len(tokenize_func(texts[i]))
+            self._pending[keys[i]] = int(counts[i])
+        return counts.tolist()
+
+    def add(self, token_counts: Dict[str, int]):
+        self._pending.update(token_counts)
+
+    def flush(self):
+        if len(self._pending) == 0:
+            return 0
+
+        # merge with the latest file, another run may have flushed meanwhile
+        entries = self._read_entries()
+        merged = dict(zip(entries["key"].tolist(), entries["count"].tolist()))
+        new_keys = [k for k in self._pending if k not in merged]
+        self._pending, pending = {}, self._pending
+        if len(new_keys) == 0:
+            return 0
+        for k in new_keys:
+            merged[k] = pending[k]
+
+        all_keys = sorted(merged)
+        key_width = max(len(k) for k in all_keys)
+        new_entries = np.zeros(
+            len(all_keys), dtype=[("key", f"U{key_width}"), ("count", "i4")]
+        )
+        new_entries["key"] = all_keys
+        new_entries["count"] = [merged[k] for k in all_keys]
+
+        os.makedirs(self.cache_path, exist_ok=True)
+        tmp_path = self._file_path() + ".{}.tmp".format(os.getpid())
+        with open(tmp_path, "wb") as f:
+            np.save(f, new_entries)
+        os.replace(tmp_path, self._file_path())
+
+        self._entries = None
+        return len(new_keys)
@@ -0,0 +1,189 @@
+import os
+import json
+import numpy as np
+from datetime import datetime, timedelta
+from utils.mongo_query_utils import HAS_KEYWORDS_AGGREGATED
+
+VISUALIZE_CUBE_FILE_NAME = "cube.npz"
+VISUALIZE_CUBE_META_FILE_NAME = "meta.json"
+
+# every cube is a sparse COO array over these dimensions plus an optional
+# facet dimension, cells hold counts of the documents (or of the unwound
+# facet values) of a week, country and language
+CUBE_DIMENSIONS = ["time_week", "country", "language"]
+CUBE_FACETS = {
+    "base": None,
+    "label": "labels",
+    "user": "user_name",
+    "keyword": "keywords",
+    "keyword_aggregated": "keywords_aggregated",
+}
+# dialogue request filters the cubes cannot answer, requests using them go to
+# MongoDB
+MONGO_ONLY_FILTERS = {
+    "region",
+    "user_name",
+    "topics",
+    "keywords",
+    "keywords_aggregated",
+}
+
+
+def get_cube_pipeline(cube_name: str):
+    """
+    Aggregation grouping the collection into the cells of `cube_name`
+    """
+    group_id = {
+        "time_week": "$time_week",
+        "country": "$country",
+        "language": "$language",
+    }
+    pipeline = []
+    facet_field = CUBE_FACETS[cube_name]
+    if facet_field in {"keywords", "keywords_aggregated"}:
+        pipeline.append({"$unwind": "$" + facet_field})
+        group_id["facet"] = {
+            "$concat": [f"${facet_field}.value", ":", f"${facet_field}.keyword_type"]
+        }
+    elif facet_field == "labels":
+        pipeline.append({"$unwind": "$labels"})
+        group_id["facet"] = "$labels"
+    elif facet_field is not None:
+        group_id["facet"] = "$" + facet_field
+
+    group = {"_id": group_id, "count": {"$sum": 1}}
+    if cube_name == "base":
+        group["token_count"] = {"$sum": "$token_count"}
+        group["keyword_aggregated_count"] = {
+            "$sum": {"$cond": [HAS_KEYWORDS_AGGREGATED, 1, 0]}
+        }
+    pipeline.append({"$group": group})
+    return pipeline
+
+
+class VisualizeCube:
+    """
+    Pre-aggregated statistics of the visualizer written by
+    build_visualize_cube.py. Dimension values are stored once in `vocab`,
+    the cubes hold int32 indices into them (`{cube}_{dim}` arrays) and int64
+    measures (`{cube}_count`, ...). The facet vocabulary of a cube is
+    `{cube}_facet`.
+    """
+
+    def __init__(self, cube_path: str):
+        self.cube_path = cube_path
+        with open(os.path.join(cube_path, VISUALIZE_CUBE_META_FILE_NAME), "r") as f:
+            meta = json.load(f)
+        self.meta = meta["meta"]
+        self.vocab = meta["vocab"]
+        with np.load(os.path.join(cube_path, VISUALIZE_CUBE_FILE_NAME)) as f:
+            self.arrays = {k: f[k] for k in f.files}
+
+    def can_answer(self, filters: dict):
+        return (
+            not any(filters.get(k) for k in MONGO_ONLY_FILTERS)
+            and self._week_range(filters) is not None
+        )
+
+    def _week_range(self, filters: dict):
+        # the cube is weekly, only ranges from a Monday to a Sunday are exact.
+        # The end date is inclusive, the range ends before the next Monday
+        start_date = filters.get("start_date")
+        end_date = filters.get("end_date")
+        if not (start_date and end_date):
+            return (None, None)
+        start = datetime.strptime(start_date, "%Y-%m-%d")
+        end = datetime.strptime(end_date, "%Y-%m-%d") + timedelta(days=1)
+        if start.weekday() != 0 or end.weekday() != 0:
+            return None
+        return (start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d"))
+
+    def _get_vocab(self, cube_name: str, dim: str):
+        return self.vocab[dim if dim in CUBE_DIMENSIONS else f"{cube_name}_{dim}"]
+
+    def _value_mask(self, dim: str, values: list):
+        index = {v: i for i, v in enumerate(self.vocab[dim])}
+        mask = np.zeros(len(self.vocab[dim]), dtype=bool)
+        mask[[index[v] for v in values if v in index]] = True
+        return mask
+
+    def _cell_mask(self, cube_name: str, filters: dict):
+        """
+        Boolean mask of the cells of `cube_name` matching the filters
+        """
+        dim_masks = {}
+        for dim in ["country", "language"]:
+            if filters.get(dim):
+                dim_masks[dim] = self._value_mask(dim, filters[dim])
+        start_week, end_week = self._week_range(filters)
+        if start_week is not None:
+            dim_masks["time_week"] = np.array(
+                [
+                    x is not None and start_week <= x < end_week
+                    for x in self.vocab["time_week"]
+                ],
+                dtype=bool,
+            )
+
+        mask = np.ones(len(self.arrays[f"{cube_name}_count"]), dtype=bool)
+        for dim, dim_mask in dim_masks.items():
+            mask &= dim_mask[self.arrays[f"{cube_name}_{dim}"]]
+        return mask
+
+    def _group(self, cube_name: str, dim: str, mask: np.ndarray, limit: int = None):
+        """
+        (value, count) pairs of `dim` over the masked cells, by descending
+        count
+        """
+        vocab = self._get_vocab(cube_name, dim)
+        counts = np.bincount(
+            self.arrays[f"{cube_name}_{dim}"][mask],
+            weights=self.arrays[f"{cube_name}_count"][mask],
+            minlength=len(vocab),
+        ).astype(np.int64)
+        order = np.argsort(-counts, kind="stable")
+        order = order[counts[order] > 0]
+        if limit is not None:
+            order = order[:limit]
+        return [(vocab[i], int(counts[i])) for i in order]
+
+    def get_dialogue_stats(self, filters: dict):
+        """
+        Statistics for the dialogue request `filters` in the format of the
+        $facet pipeline of build_dialogue_stats_pipeline
+        """
+        base_mask = self._cell_mask("base", filters)
+        totals = []
+        if base_mask.any():
+            totals.append(
+                {
+                    "_id": None,
+                    **{
+                        k: int(self.arrays[f"base_{k}"][base_mask].sum())
+                        for k in ["count", "token_count", "keyword_aggregated_count"]
+                    },
+                }
+            )
+
+        time_stats = self._group("base", "time_week", base_mask)
+        return {
+            "totals": totals,
+            "country_stats": self._group("base", "country", base_mask),
+            "user_stats": self._group(
+                "user", "facet", self._cell_mask("user", filters), 100
+            ),
+            "language_stats": self._group("base", "language", base_mask),
+            "label_stats": self._group(
+                "label", "facet", self._cell_mask("label", filters)
+            ),
+            "keyword_stats": self._group(
+                "keyword", "facet", self._cell_mask("keyword", filters), 100
+            ),
+            "keyword_aggregated_stats": self._group(
+                "keyword_aggregated",
+                "facet",
+                self._cell_mask("keyword_aggregated", filters),
+                100,
+            ),
+            "time_stats": sorted(time_stats),
+        }